@@ -11,7 +11,7 @@ from common.attributes import AttributeHelper
 from common.editwizard import EditWizard
 from common.general import getNeverDate, dateStr
 from common.general import logger
-from common.storage import Storage
+from common.storage import Storage, getBackend
 from common.globals import DATADIR
 import common.security
 
@@ -22,6 +22,7 @@ class Account(Storage, AttributeHelper, EditWizard):
     attributesThatShouldntBeSaved = ["client"]
 
     validEmailRegex = r"^[A-Za-z0-9_\-\.]+@[A-Za-z0-9_\-]+\.[A-Za-z0-9_\-]+$"
+    emailPrompt = "Enter email address or [enter] to quit: "
 
     wizardAttributes = ["_email", "_password", "_displayName", "admin"]
 
@@ -58,14 +59,18 @@ class Account(Storage, AttributeHelper, EditWizard):
     def getType(self):
         return self.__class__.__name__
 
-    def login(self):
-        """ login and return the acctObj - acct created if needed """
+    def login(self, email=None):
+        """ login and return the acctObj - acct created if needed
+            * email may be provided (already prompted for) by the caller """
 
         if not self.client.isRunning():
             # Abort if client is not connected/reachable
             return False
 
-        self.getUserEmailAddress()  # prompt user for email address
+        if email is None:
+            self.getUserEmailAddress()  # prompt user for email address
+        else:
+            self.email = email
         email = self.getEmail()
 
         if email == "" or email == "exit" or email == "quit":
@@ -185,9 +190,8 @@ class Account(Storage, AttributeHelper, EditWizard):
 
     def getUserEmailAddress(self):
         """ Prompt user for email address and validate input """
-        prompt = "Enter email address or [enter] to quit: "
         self.email = self.client.promptForInput(
-            prompt, self.validEmailRegex, "Invalid Email address\n"
+            self.emailPrompt, self.validEmailRegex, "Invalid Email address\n"
         )
         if self.email != "":
             return True
@@ -510,8 +514,8 @@ class Account(Storage, AttributeHelper, EditWizard):
         if id == "":
             id = str(self.getId())
         mypath = os.path.abspath(DATADIR + "/Account/" + id)
-        for f in os.listdir(mypath):
-            if os.path.isfile(os.path.join(mypath, f)):
+        for f in getBackend().listDir(mypath):
+            if getBackend().exists(os.path.join(mypath, f)):
                 [charName, junk] = f.split(".")
                 charList.append(charName)
         return charList
@@ -521,8 +525,6 @@ class Account(Storage, AttributeHelper, EditWizard):
             * walks the account tree checking to see if a file matching the
               character name exists """
         filename = name + ".pickle"
-        for dirpath, dirnames, files in os.walk(DATADIR + "/Account"):
-            for name in files:
-                if name == filename:
-                    return False
+        if getBackend().findFiles(os.path.abspath(DATADIR + "/Account"), filename):
+            return False
         return True
@@ -0,0 +1,69 @@
+""" microbenchmark - output spool with many queued messages
+
+    Compares the old spool (queue.Queue, string concatenation, and an
+    encode before sendall) with OutputBuffer + sendChunks.  Each round
+    spools <count> messages, pops the spool, and sends it over a local
+    socketpair.
+
+    Usage: python bench_spool.py [count] [rounds]
+"""
+import queue
+import socket
+import sys
+import threading
+import time
+sys.path.append('../')
+
+from common.ioLib import OutputBuffer, sendChunks  # noqa: E402
+
+MSG = "The ogre hits you for 12 damage!\n"
+
+
+def drain(sock):
+    """ read and discard everything sent to the socket """
+    while sock.recv(1024 * 1024):
+        pass
+
+
+def oldSpool(sock, count):
+    spool = queue.Queue()
+    for num in range(count):
+        spool.put(MSG)
+    data = ""
+    while not spool.empty():
+        data += spool.get()
+    sock.sendall(str.encode(data))
+
+
+def newSpool(sock, count):
+    spool = OutputBuffer()
+    for num in range(count):
+        spool.put(MSG)
+    sendChunks(sock, spool.popChunks())
+
+
+def bench(func, count, rounds):
+    sendSock, recvSock = socket.socketpair()
+    threading.Thread(target=drain, args=(recvSock,), daemon=True).start()
+    start = time.perf_counter()
+    for num in range(rounds):
+        func(sendSock, count)
+    elapsed = time.perf_counter() - start
+    sendSock.close()
+    return elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    oldTime = bench(oldSpool, count, rounds)
+    newTime = bench(newSpool, count, rounds)
+    print("{} messages x {} rounds".format(count, rounds))
+    print("  queue + concat + encode : {:8.2f} ms/round".format(
+        oldTime * 1000 / rounds))
+    print("  OutputBuffer + sendmsg  : {:8.2f} ms/round".format(
+        newTime * 1000 / rounds))
+    print("  speedup                 : {:8.2f}x".format(oldTime / newTime))
+
+
+main()
@@ -33,6 +33,8 @@ class Character(Item):
         "_lastInputDate",
         "_lastLoginDate",
         "_lastRegenDate",
+        "_onPoisoned",
+        "_persister",
         "_roomObj",
         "_secondsUntilNextAttack",
         "_spoolOut",
@@ -223,6 +225,7 @@ class Character(Item):
     def __init__(self, client=None, acctName=""):
         self.client = client
         self._acctName = acctName
+        self.setGameHooks()
 
         super().__init__()
         Storage.__init__(self)
@@ -802,6 +805,24 @@ class Character(Item):
             return True
         return False
 
+    def setGameHooks(self, persister=None, onPoisoned=None):
+        """ set by the game while the character is playing (see
+            game.Game.addToActivePlayerList), and cleared when they leave
+            * persister - saves the character (see persist)
+            * onPoisoned(charObj) - called when the character is poisoned """
+        self._persister = persister
+        self._onPoisoned = onPoisoned
+
+    def persist(self):
+        """ save the character through the game's write-behind persister,
+            so that saves made from any thread are written in order, and
+            coalesced with the save at the end of the command
+            * characters that aren't in a game are saved now """
+        if not self._persister:
+            return self.save()
+        self._persister.markDirty(self)
+        return True
+
     def getCoins(self):
         return self._coins
 
@@ -810,11 +831,11 @@ class Character(Item):
 
     def addCoins(self, num):
         self._coins += int(num)
-        self.save()
+        self.persist()
 
     def subtractCoins(self, num):
         self._coins -= int(num)
-        self.save()
+        self.persist()
 
     def canAffordAmount(self, num):
         if self._coins >= int(num):
@@ -856,7 +877,7 @@ class Character(Item):
             bankfee, remainingCoin = self.calculateBankFees(num, feeRate)
             self.bankAccountAdd(remainingCoin)
             self.bankFeeAdd(bankfee)
-            self.save()
+            self.persist()
             logger.info(
                 "bank - "
                 + self.getName()
@@ -880,7 +901,7 @@ class Character(Item):
             bankfee, remainingCoin = self.calculateBankFees(num, feeRate)
             self.addCoins(remainingCoin)
             self.bankFeeAdd(bankfee)
-            self.save()
+            self.persist()
             logger.info(
                 "bank - "
                 + self.getName()
@@ -904,7 +925,7 @@ class Character(Item):
             characters to recoup their paid taxes (lottery?)
              """
         self._taxesPaid += max(0, int(num))
-        self.save()
+        self.persist()
         return True
 
     def getTax(self):
@@ -996,10 +1017,11 @@ class Character(Item):
     def setDoubleUpStatLevels(self):
         """ set _doubleUpStatLevels based on class and randomness """
 
-        # There are two double up stat levels per class
-        self._doubleUpStatLevels = self.classDict[self.getClassKey()][
+        # There are two double up stat levels per class.  Copy them, since
+        # the class list is shared by every character
+        self._doubleUpStatLevels = list(self.classDict[self.getClassKey()][
             "doubleUpStatLevels"
-        ]
+        ])
 
         # Randomly select an additional unused double up stat level
         #   keep selecting a random number until we find an unused one
@@ -1384,7 +1406,11 @@ class Character(Item):
         self._plagued = val
 
     def setPoisoned(self, val=True):
+        """ poison is due as soon as we're poisoned, so let the game know """
+        wasPoisoned = self._poisoned
         self._poisoned = val
+        if val and not wasPoisoned and self._onPoisoned:
+            self._onPoisoned(self)
 
     def setRoom(self, roomObj):
         self._roomObj = roomObj
@@ -1868,7 +1894,7 @@ class Character(Item):
             self.setNearDeathExperience()
         condition = self.condition()
         dLog(self.getName() + " takes " + str(damage) + " damage", self._instanceDebug)
-        self.save()
+        self.persist()
         if self.getHitPoints() <= 0:
             if self.isDm():
                 self._spoolOut(
@@ -1901,7 +1927,7 @@ class Character(Item):
         self.setPoisoned(False)
         self.setPlagued(False)
 
-        self.save()
+        self.persist()
         if not silent:  # primarily used for testing hundreds of deaths
             self._spoolOut("You are dead!\n")
             self.obituary()
@@ -2099,12 +2125,16 @@ class Character(Item):
 
     def processPoisonAndRegen(self, regenInterval=90, poisonInterval=60):
         """ At certain intervals, poison and hp regeneration kick in
-            * poison should be faster and/or stronger than regen """
+            * poison should be faster and/or stronger than regen
+            * returns the secs until one of them is due again.  If we aren't
+              poisoned, it's no longer than poisonInterval, since we could
+              be poisoned in the meantime """
         conAdj = self.getConstitution() - 12
         intAdj = self.getIntelligence() - 12
         regenHp = max(1, int(self.getMaxHP() / 10) + conAdj)
         regenMana = max(1, int(self.getMaxMana() / 8) + intAdj)
         poisonHp = max(1, int(self.getLevel() - conAdj))
+        nextDue = poisonInterval
 
         if not self.isPlagued():  # no regen if plagued
             # Check the time
@@ -2127,6 +2157,8 @@ class Character(Item):
                 self.addHP(regenHp)
                 self.addMana(regenMana)
                 self.setLastRegen()
+                regenSecsRemaining = regenInterval
+            nextDue = min(nextDue, regenSecsRemaining)
 
         if self.isPoisoned():  # take damage if poisoned
             # Check the time
@@ -2136,14 +2168,18 @@ class Character(Item):
                 poisonSecsRemaining = poisonInterval - secsSinceDate(
                     self.getLastPoisonDate()
                 )
-            dLog("poison cntr: " + str(regenSecsRemaining) + " secs", False)
+            dLog("poison cntr: " + str(poisonSecsRemaining) + " secs", False)
 
             if poisonSecsRemaining <= 0:
                 self._spoolOut(
-                    "As the poison circulates, you take " + poisonHp + " damage.\n"
+                    "As the poison circulates, you take " + str(poisonHp)
+                    + " damage.\n"
                 )
                 self.takeDamage(poisonHp)
                 self.setLastPoison()
+                poisonSecsRemaining = poisonInterval
+            nextDue = min(nextDue, poisonSecsRemaining)
+        return nextDue
 
     def resistsPoison(self, chanceToPoison=80):
         """ Returns true/false if the player resists poison """
@@ -25,6 +25,10 @@ def main():
     parser.add_argument("--host", type=str, help="ip of server")
     parser.add_argument("--port", type=str, help="port of server")
     parser.add_argument("--debug", action="store_true", help="turn debugging on")
+    parser.add_argument("--legacy", action="store_true",
+                        help="use the legacy raw protocol instead of framing")
+    parser.add_argument("--blocking", action="store_true",
+                        help="wait for input before reading server output")
 
     args = parser.parse_args()
 
@@ -32,6 +36,10 @@ def main():
     clientObj.setDebug(False)
     if args.debug:
         clientObj.setDebug(True)
+    if args.legacy:
+        clientObj.setFraming(False)
+    if args.blocking:
+        clientObj.setSelectMode(False)
     clientObj.start(args)
 
 
@@ -0,0 +1,139 @@
+""" actors - serial work queues, one per key (i.e. one per active room)
+
+   * ActorQueues - work for a key runs one item at a time, in the order
+     that it was posted.  Work for different keys runs in parallel on a
+     pool of worker threads.
+"""
+
+import collections
+import contextlib
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+
+from common.general import logger
+
+
+class _Entry:
+    """ a pending item in a key's queue
+        * posted work has a future, and is run by a worker
+        * called work has an event, which is set when it's the caller's
+          turn to run it on its own thread """
+
+    def __init__(self, func, caller=False):
+        self.func = func
+        self.future = None if caller else Future()
+        self.turn = threading.Event() if caller else None
+
+
+class ActorQueues:
+    """ A serial queue for each key, drained by a shared pool of workers
+        * post(key, func) - queue func to be run by a worker.  Returns a
+          concurrent.futures.Future
+        * call(key, func) - wait for our turn, then run func on this thread
+          and return its result.  Used by client threads, so that a command
+          that is waiting for its room doesn't hold up a worker
+        * yieldTurn() - a block that gives up this thread's turns while it
+          waits (i.e. for a player to answer a prompt) and takes them back
+          afterwards, so that the rest of the key's work isn't held up
+        * work that is running for a key can call() the same key - it runs
+          right away, since it already has the turn
+        * a key only uses a queue while it has work, so there is nothing to
+          clean up when a room goes away """
+
+    def __init__(self, workers=4):
+        self._lock = threading.Lock()
+        self._queues = {}  # key -> deque of waiting entries, while key is busy
+        self._local = threading.local()  # keys that this thread has the turn for
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="actor")
+
+    def post(self, key, func):
+        entry = _Entry(func)
+        self._enqueue(key, entry)
+        return entry.future
+
+    def call(self, key, func):
+        if key in self._heldKeys():
+            return func()
+        entry = _Entry(func, caller=True)
+        self._enqueue(key, entry)
+        entry.turn.wait()
+        try:
+            return self._runHeld(key, func)
+        finally:
+            self._advance(key)
+
+    @contextlib.contextmanager
+    def yieldTurn(self):
+        """ give up the turns that this thread has for the block, then wait
+            for them again - work for the keys can run in the meantime, so
+            whatever the caller looked at before may have changed """
+        heldKeys = self._heldKeys()
+        keys = list(heldKeys)
+        for key in keys:
+            heldKeys.discard(key)
+            self._advance(key)
+        try:
+            yield
+        finally:
+            for key in keys:
+                entry = _Entry(None, caller=True)
+                self._enqueue(key, entry)
+                entry.turn.wait()
+                heldKeys.add(key)
+
+    def isBusy(self, key):
+        with self._lock:
+            return key in self._queues
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+    def _heldKeys(self):
+        if not hasattr(self._local, "keys"):
+            self._local.keys = set()
+        return self._local.keys
+
+    def _runHeld(self, key, func):
+        heldKeys = self._heldKeys()
+        heldKeys.add(key)
+        try:
+            return func()
+        finally:
+            heldKeys.discard(key)
+
+    def _enqueue(self, key, entry):
+        with self._lock:
+            waiting = self._queues.get(key)
+            if waiting is not None:  # key is busy - wait our turn
+                waiting.append(entry)
+                return None
+            self._queues[key] = collections.deque()
+        self._giveTurn(key, entry)
+
+    def _giveTurn(self, key, entry):
+        if entry.turn:
+            entry.turn.set()
+        else:
+            self._pool.submit(self._runPosted, key, entry)
+
+    def _runPosted(self, key, entry):
+        try:
+            if entry.future.set_running_or_notify_cancel():
+                try:
+                    entry.future.set_result(self._runHeld(key, entry.func))
+                except Exception as e:
+                    logger.exception("ActorQueues: work for {} failed".format(key))
+                    entry.future.set_exception(e)
+        finally:
+            self._advance(key)
+
+    def _advance(self, key):
+        """ pass the turn for a key to its next entry, if there is one """
+        with self._lock:
+            waiting = self._queues[key]
+            if not waiting:
+                del self._queues[key]
+                return None
+            entry = waiting.popleft()
+        self._giveTurn(key, entry)
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+""" SoG asyncio server library module
+   * asyncServer - runs the asyncio server, including exception handler
+   * AsyncClient - a client connection that is driven by the event loop
+   * Opt-in alternative to serverLib.server (see globals.SERVER_ENGINE)
+
+   All connections share a single event loop.  Network i/o and waiting for
+   input happen on the event loop, so an idle client at a command prompt
+   doesn't tie up a thread.  Login, commands, and any prompts inside of a
+   command are run in a bounded pool of worker threads, which keeps the
+   existing LobbyCmd/GameCmd code unchanged.
+"""
+
+import asyncio
+import concurrent.futures
+import os
+import re
+import socket
+import sys
+import threading
+
+import account
+import common.framing
+import common.globals
+from common.general import Terminator, logger
+from common.serverLib import createAndStartAsyncThread, haltAsyncThread
+from common.serverLib import haltPersister, threadIsRunning, exitProg
+import game
+from threads import NetworkClient
+
+
+class AsyncClient(NetworkClient):
+    """ Client connection for the asyncio server
+        * The top level lobby/game cmd loops are run one command at a time by
+          driveCmdLoops, instead of blocking inside cmd.cmdloop
+        * Blocking code calls _sendAndReceive from a worker thread, which
+          hands the i/o off to the event loop and waits for the result
+    """
+
+    def __init__(self, reader, writer, loop, executor, id):
+        NetworkClient.__init__(self, writer.get_extra_info("peername"), id)
+        self.reader = reader
+        self.writer = writer
+        self.socket = None
+        self._loop = loop
+        self._loopThreadId = threading.get_ident()  # created on the event loop
+        self._executor = executor
+        self._cmdLoops = []  # stack of (cmdObj, cleanupFunc)
+        self.identifier = "AC" + str(id) + str(self.address)
+
+    def __str__(self):
+        """ Connection ID Str - often used as a prefix for logging """
+        return self.identifier
+
+    def is_alive(self):
+        """ Mimic threading.Thread, which the game uses for timeouts """
+        return self.isRunning()
+
+    async def runBlocking(self, func, *args):
+        """ Run blocking game code in a worker thread and return the result """
+        return await self._loop.run_in_executor(self._executor, func, *args)
+
+    async def sessionLoop(self):
+        """ This is the main entry point for an asyncio client connection """
+        logger.info(str(self) + " Client connection established")
+        try:
+            await self.negotiateFramingAsync()
+            while self.isRunning():  # Server loop
+                self.welcome("Sog Server\n")
+                self.acctObj = account.Account(self)
+                # Prompt for the email address here, so that connections
+                # sitting at the login prompt don't tie up a worker thread
+                email = await self.promptForInputAsync(
+                    self.acctObj.emailPrompt, self.acctObj.validEmailRegex,
+                    "Invalid Email address\n")
+                if await self.runBlocking(self.acctLogin, email):
+                    await self.runBlocking(self.lobbyObj.joinLobby, self)
+                    await self.driveCmdLoops()
+                    if self.acctObj:
+                        await self.runBlocking(self.acctObj.logout)
+                    self.acctObj = None
+                    common.globals.connections.setAccount(self, None)
+                elif self.isRunning():
+                    await asyncio.sleep(1)
+        finally:
+            await self.closeSessionAsync()
+        return None
+
+    async def closeSessionAsync(self):
+        """ Leave the game and close the connection
+            * the game cleanup (leaveGame, saving the room and character)
+              runs in a worker thread, so that it doesn't hold up the other
+              connections.  It's shielded, so it still finishes if the
+              session is cancelled (i.e. the server is stopping) """
+        try:
+            cleanup = self._loop.run_in_executor(self._executor, self.closeSession)
+        except RuntimeError:  # worker pool was shut down - server is stopping
+            self.closeSession()
+            return None
+        await asyncio.shield(cleanup)
+        return None
+
+    def closeSession(self):
+        self.exitAllCmdLoops()
+        self.terminateClientConnection()
+
+    async def promptForInputAsync(self, promptStr, regex="", requirementsTxt=""):
+        """ Event loop version of Spooler.promptForInput """
+        for x in range(1, self.getMaxPromptRetries()):
+            self.spoolOut(promptStr)
+            oneStr = ""
+            if self._handleClientData(await self._exchange()):
+                oneStr = self.getInputStr()
+
+            if oneStr == "" or not self.isRunning():
+                return ""
+            elif regex == "" or re.search(regex, oneStr):
+                return oneStr
+            else:
+                self.spoolOut(requirementsTxt)
+        return ""
+
+    def runCmdLoop(self, cmdObj, cleanupFunc=None):
+        """ Override ClientBase - instead of blocking in cmdObj.cmdloop, push
+            the shell onto the stack that driveCmdLoops works through """
+        cmdObj.preloop()
+        self._cmdLoops.append((cmdObj, cleanupFunc))
+
+    async def driveCmdLoops(self):
+        """ Run the pushed cmd shells, one command at a time
+            * The top of the stack is the active shell (i.e. game on top of
+              the lobby).  When it exits, we fall back to the one below it.
+            * Waiting for input happens here, on the event loop """
+        while self._cmdLoops and self.isRunning():
+            cmdObj = self._cmdLoops[-1][0]
+            self.spoolOut(cmdObj.getCmdPrompt())
+            received = await self._exchange()
+            stop = await self.runBlocking(self._runOneCmd, cmdObj, received)
+            if stop:
+                await self.runBlocking(self.exitCmdLoop)
+        return None
+
+    def _runOneCmd(self, cmdObj, received):
+        """ process the input and run a single command - True means stop """
+        if not self._handleClientData(received):
+            return True
+        return cmdObj.runcmd(self.getInputStr())
+
+    def exitCmdLoop(self):
+        """ Pop the active shell off of the stack and clean up after it """
+        if not self._cmdLoops:
+            return False
+        cmdObj, cleanupFunc = self._cmdLoops.pop()
+        cmdObj.postloop()
+        if cleanupFunc:
+            cleanupFunc(self)
+        return True
+
+    def exitAllCmdLoops(self):
+        while self.exitCmdLoop():
+            pass
+
+    async def negotiateFramingAsync(self):
+        """ Event loop version of ServerIo.negotiateFraming """
+        data = b""
+        status = None
+        try:
+            while status is None:
+                chunk = await asyncio.wait_for(
+                    self.reader.read(common.globals.BYTES_TO_TRANSFER),
+                    common.globals.FRAME_HANDSHAKE_TIMEOUT)
+                if not chunk:
+                    break
+                data += chunk
+                status = common.framing.preambleStatus(data)
+            if status:
+                self.writer.write(common.framing.PREAMBLE)  # acknowledge
+                await self.writer.drain()
+        except (asyncio.TimeoutError, ConnectionError, OSError):
+            pass
+        return self._startProtocol(bool(status), data)
+
+    async def _exchange(self):
+        """ Send the output spool to the client and wait for the client's
+            reply - returns False if the connection was closed
+            * must run on the event loop """
+        try:
+            self._sendOutput()
+            await asyncio.wait_for(self.writer.drain(),
+                                   common.globals.SEND_TIMEOUT)
+            if self._debugServer:
+                logger.debug(str(self) + " REC: Waiting for input")
+            while not self._clientMsgs:
+                clientdata = await self.reader.read(
+                    common.globals.BYTES_TO_TRANSFER)
+                if not clientdata:
+                    return False
+                self._bufferClientData(clientdata)
+        except (asyncio.TimeoutError, socket.timeout):
+            self._dropClient()
+            return False
+        except (ConnectionError, OSError):
+            return False
+        except common.framing.FrameError as e:
+            logger.warning("{} Invalid frame - {}".format(self, e))
+            return False
+        finally:
+            self._inputReceived()
+        return True
+
+    def _writeToClient(self, chunks):
+        """ Override ServerIo - must run on the event loop
+            * writes don't block - the transport holds whatever the client
+              hasn't read yet.  If that grows past SPOOL_HIGH_WATER bytes,
+              socket.timeout is raised, and the client is dropped, so that a
+              client that has stopped reading can't use up server memory """
+        self.writer.writelines(chunks)
+        if (self.writer.transport.get_write_buffer_size() >
+                common.globals.SPOOL_HIGH_WATER):
+            raise socket.timeout("client isn't reading")
+
+    def _writeNoWait(self, chunks):
+        """ Override ServerIo - the transport takes everything (see above) """
+        self._writeToClient(chunks)
+        return []
+
+    def _dropClient(self):
+        """ Override ServerIo - there is no socket to shut down.  Aborting
+            the transport throws away the unsent output and closes the
+            connection, which ends the read in _exchange, and the session
+            cleans up as if the client had disconnected """
+        logger.warning("{} Client isn't reading its output - disconnecting".format(
+            self))
+        self.callOnLoop(self.writer.transport.abort)
+
+    def requestPush(self):
+        """ Override ServerIo - push from the event loop """
+        self.callOnLoop(self.pushOutput)
+
+    def _sendAndReceive(self):
+        """ Override ServerIo - called from a worker thread, such as when
+            prompting for input in the middle of a command """
+        if not self.isRunning():
+            return False
+        try:
+            future = asyncio.run_coroutine_threadsafe(self._exchange(), self._loop)
+            received = future.result()
+        except (RuntimeError, concurrent.futures.CancelledError):
+            # event loop has been shut down
+            return False
+        return self._handleClientData(received)
+
+    def _handleClientData(self, received):
+        if not received:  # connection was closed by the client
+            self.terminateClientConnection()
+            return False
+        return self._processClientMsg()
+
+    def terminateClientConnection(self):
+        """ terminate the connection and clean up loose ends
+            * can be called from the event loop or from a worker thread """
+        if self._running:
+            self.removeConnectionFromList()
+            self._running = False
+            self.releaseGameObjs()
+            self.callOnLoop(self._closeConnection)
+        return None
+
+    def _closeConnection(self):
+        try:
+            self.writer.write(self._encodeForClient(common.framing.TERM))
+            self.writer.close()
+        except (ConnectionError, OSError, RuntimeError):
+            if self._debugServer:
+                logger.debug("{} Server term - ".format(self) +
+                             "Couldn't close non-existent connection")
+
+    def callOnLoop(self, func):
+        """ Run func on the event loop thread, regardless of caller """
+        if self._loop.is_closed():
+            return None
+        if threading.get_ident() == self._loopThreadId:
+            func()
+        else:
+            try:
+                self._loop.call_soon_threadsafe(func)
+            except RuntimeError:
+                pass  # loop closed in the meantime
+        return None
+
+
+class _AsyncServer:
+    """ Holds the state of the running asyncio server """
+
+    def __init__(self):
+        self.loop = None
+        self.executor = None
+        self.asyncThread = None
+        self.stopEvent = None
+        self.port = None
+        self.ready = threading.Event()  # set once we are accepting connections
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopEvent = asyncio.Event()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=common.globals.ASYNC_WORKERS,
+            thread_name_prefix="sogWorker")
+
+        serverHandle = await asyncio.start_server(
+            self.handleConnection,
+            common.globals.HOST,
+            common.globals.PORT,
+            backlog=common.globals.LISTEN_BACKLOG,
+            reuse_address=True)
+        self.port = serverHandle.sockets[0].getsockname()[1]
+        watchdog = self.loop.create_task(self.superviseAsyncThread())
+        self.ready.set()
+        try:
+            await self.stopEvent.wait()
+        finally:
+            watchdog.cancel()
+            serverHandle.close()
+            haltClients()
+            self.executor.shutdown(wait=False)
+        raise Terminator
+
+    def stop(self):
+        """ Stop the server - can be called from any thread """
+        self.loop.call_soon_threadsafe(self.stopEvent.set)
+
+    async def handleConnection(self, reader, writer):
+        client = AsyncClient(reader, writer, self.loop, self.executor,
+                             common.globals.connections.nextId())
+        common.globals.connections.add(client)
+        try:
+            await client.sessionLoop()
+        except Terminator:
+            # a client sent the server stop string
+            self.stopEvent.set()
+
+    async def superviseAsyncThread(self):
+        """ Restart the game's async thread if it dies """
+        while True:
+            if not threadIsRunning(self.asyncThread):
+                self.asyncThread = createAndStartAsyncThread()
+            await asyncio.sleep(common.globals.THREAD_CHECK_INTERVAL)
+
+
+def asyncServer():
+    svr = _AsyncServer()
+    logger.info("-------------------------------------------------------")
+    logger.info("SVR Async Server Start {} (pid:{})".format(
+        sys.argv[0], os.getpid()))
+    logger.info("SVR Listening on {}:{}".format(common.globals.HOST,
+                                                common.globals.PORT))
+    try:
+        asyncio.run(svr.main())
+    except Terminator:
+        haltAsyncThread(game.Game(), svr.asyncThread)
+        haltClients()
+        haltPersister(game.Game())
+        exitProg()
+
+
+def haltClients():
+    for client in common.globals.connections:
+        logger.info("SVR Halting client " + str(client))
+        client.terminateClientConnection()
@@ -3,6 +3,12 @@
 
    * runs a simple client that connect to a SoG server
    * connection is persistent
+   * uses the framed protocol (see common/framing), unless legacy raw mode
+     is requested
+   * in framed mode, a receiver thread reads from the server so that output
+     pushed by the server is shown while we are waiting for user input
+   * on posix, selectLoop multiplexes stdin and the socket instead, so
+     output is shown as soon as it arrives and input is sent without delay
 
  ToDo:
    * improve connection timeout
@@ -10,12 +16,20 @@
    *
  """
 
+import collections
 import getpass
+import os
+import queue
+import selectors
+import sys
 import time
 import socket
+import threading
 import traceback
 
 from common.attributes import AttributeHelper
+import common.framing
+import common.globals
 from common.globals import HOST, PORT, BYTES_TO_TRANSFER
 from common.globals import NOOP_STR, TERM_STR, STOP_STR
 from common.general import dateStr
@@ -29,6 +43,16 @@ class Client(AttributeHelper):
         self.listenTimeout = 10
         self.socketTimeout = 30
         self._debugIO = False
+        self._framed = True  # False = legacy raw protocol
+        self._frameDecoder = None
+        self._serverMsgs = queue.Queue()  # received (frameType, text)
+        self._receiver = None
+        # select() doesn't work on stdin on windows
+        self._selectMode = os.name != "nt"
+        self._selector = None
+        self._pendingInput = collections.deque()  # lines waiting to be sent
+        self._awaitingOutput = False
+        self._stdinBuf = b""
 
         self._running = True
         self._receivedInput = False  # gets set the first time input is entered
@@ -37,7 +61,10 @@ class Client(AttributeHelper):
         if self.connect(args):
             print("Client: Started at {}.  ".format(dateStr("now")) +
                   "Enter [term] to perform a hard stop")
-            self.dataLoop(args)
+            if self._selectMode:
+                self.selectLoop(args)
+            else:
+                self.dataLoop(args)
             print("Client: Finished.")
         self.disconnect()
 
@@ -46,11 +73,23 @@ class Client(AttributeHelper):
         try:
             if self.getDebug():
                 print("Client: REC: Waiting to receive data")
+            if self._framed:
+                # frames are read by the receiver thread
+                msg = self._serverMsgs.get(timeout=self.socketTimeout)
+                if not msg:  # connection was closed
+                    return False
+                self.output = common.framing.toLegacy(*msg)
+                return True
+            if not self._serverMsgs.empty():  # received during handshake
+                self.output = common.framing.toLegacy(*self._serverMsgs.get())
+                return True
             data = self.socket.recv(BYTES_TO_TRANSFER)
             if self.getDebug():
                 print("Client: REC: Data received ({})".format(len(data)))
             self.output = str(data.decode("utf-8"))
             return True
+        except queue.Empty:
+            return False
         except OSError:
             if self.getDebug():
                 print("Client: OSError")
@@ -64,7 +103,10 @@ class Client(AttributeHelper):
         try:
             if self.getDebug():
                 print("Client: SEND: " + self.input)
-            self.socket.sendall(str.encode(self.input))
+            if self._framed:
+                self.socket.sendall(common.framing.encodeLegacy(self.input))
+            else:
+                self.socket.sendall(str.encode(self.input))
             if self.getDebug():
                 print("Client: SEND: Data Sent")
             self.input = ""
@@ -98,12 +140,105 @@ class Client(AttributeHelper):
             print("Client: Server is refusing connections at {}:{}".format(svrhost,
                                                                            svrport))
             return False
+        if self._framed:
+            return self.startFraming()
         return True
 
+    def startFraming(self):
+        """ Send the framing preamble and wait for the server to echo it
+            * a framed server doesn't send anything until it gets the
+              preamble, but an older server sends its output right away.
+              So we listen briefly first, and if output shows up, we use
+              the raw protocol without ever sending the preamble, which an
+              older server would take as the answer to its first prompt
+            * an older server that is slower than that has already been
+              sent the preamble.  Its output shows up instead of the echo,
+              and we fall back to the raw protocol then """
+        data = b""
+        status = None
+        try:
+            data = self._listenBeforeFraming()
+            if data is None:
+                print("Client: Connection closed by server")
+                return False
+            if data:
+                status = common.framing.preambleStatus(data)
+            if status is not False:
+                self.socket.sendall(common.framing.PREAMBLE)
+            while status is None:
+                chunk = self.socket.recv(BYTES_TO_TRANSFER)
+                if not chunk:
+                    print("Client: Connection closed by server")
+                    return False
+                data += chunk
+                status = common.framing.preambleStatus(data)
+        except OSError:
+            print("Client: Framing handshake failed")
+            return False
+
+        if status:
+            self._frameDecoder = common.framing.FrameDecoder()
+            data = data[len(common.framing.PREAMBLE):]
+            self._queueFrames(self._frameDecoder.feed(data))
+            if not self._selectMode:
+                self._receiver = threading.Thread(target=self._receiveLoop,
+                                                  daemon=True)
+                self._receiver.start()
+        else:
+            print("Client: Server doesn't support framing.  Using raw mode")
+            self._framed = False
+            self._serverMsgs.put(
+                common.framing.fromLegacy(str(data.decode("utf-8"))))
+        if self.getDebug():
+            print("Client: Framing handshake complete")
+        return True
+
+    def _listenBeforeFraming(self):
+        """ Return what the server sends on its own, within a fraction of
+            the server's handshake timeout - b"" if it's quiet, or None if
+            it hung up """
+        oldTimeout = self.socket.gettimeout()
+        self.socket.settimeout(common.globals.FRAME_HANDSHAKE_TIMEOUT / 5)
+        try:
+            return self.socket.recv(BYTES_TO_TRANSFER) or None
+        except socket.timeout:
+            return b""
+        finally:
+            self.socket.settimeout(oldTimeout)
+
+    def _receiveLoop(self):
+        """ Receiver thread - read frames from the server until it hangs up
+            * pushed output is displayed immediately
+            * everything else is queued for receiveData """
+        try:
+            while self.isRunning():
+                try:
+                    data = self.socket.recv(BYTES_TO_TRANSFER)
+                except socket.timeout:
+                    continue  # idle at the prompt - keep waiting
+                if self.getDebug():
+                    print("Client: REC: Data received ({})".format(len(data)))
+                if not data:
+                    break
+                self._queueFrames(self._frameDecoder.feed(data))
+        except common.framing.FrameError as e:
+            print("Client: Invalid data from server - {}".format(e))
+        except (OSError, AttributeError):  # socket closed/disconnected
+            pass
+        finally:
+            self._serverMsgs.put(None)
+
+    def _queueFrames(self, frames):
+        for ftype, text in frames:
+            if ftype == common.framing.PUSH:
+                print(text, end="", flush=True)
+            else:
+                self._serverMsgs.put((ftype, text))
+
     def dataLoop(self, args):
         """ Recieve data, get input, send data """
         while self.isRunning:
-            time.sleep(1)
+            self.pause()
             if self.receiveData():
                 if not self.postProcessOutput(args):
                     break
@@ -112,12 +247,8 @@ class Client(AttributeHelper):
                 print("Client: No data received from server")
 
             if self.isRunning():
-                if (
-                    self.output == "Enter Password: "
-                    or self.output == "Verify Password: "
-                    or self.output == "Enter Account Password: "
-                ):
-                    time.sleep(1)
+                if self.isPasswordPrompt():
+                    self.pause()
                     self.input = getpass.getpass("")
                 else:
                     self.input = input()
@@ -129,9 +260,129 @@ class Client(AttributeHelper):
                 print("Client: Error while sending data.  Aborting")
                 break
 
+    def selectLoop(self, args):
+        """ Wait on both the server and stdin, and handle whichever is ready
+            * server output is displayed as soon as it arrives
+            * each line typed is sent right away, unless we're still
+              waiting for the server to respond to the last one, in which
+              case it is held until the response arrives """
+        self._awaitingOutput = True  # the server talks first
+        if args.username:  # autofill login - sent once the prompts arrive
+            self._pendingInput.append(args.username)
+            if args.password:
+                self._pendingInput.append(args.password)
+            args.username = ""
+            args.password = ""
+            self._receivedInput = True
+
+        self.socket.settimeout(None)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.socket, selectors.EVENT_READ,
+                                self._readSocket)
+        self._selector.register(sys.stdin, selectors.EVENT_READ, self._readStdin)
+        try:
+            if not self._handleServerMsgs(self._takeQueuedMsgs(), args):
+                return None
+            while self.isRunning():
+                for key, mask in self._selector.select():
+                    if not key.data(args):
+                        return None
+        finally:
+            self._selector.close()
+        return None
+
+    def _takeQueuedMsgs(self):
+        """ messages that arrived before the loop started (i.e. handshake) """
+        msgs = []
+        while not self._serverMsgs.empty():
+            msgs.append(self._serverMsgs.get())
+        return msgs
+
+    def _readSocket(self, args):
+        """ selectLoop callback - returns False when we're done """
+        try:
+            data = self.socket.recv(BYTES_TO_TRANSFER)
+        except OSError:
+            data = b""
+        if not data:
+            print("Client: Connection closed by server")
+            return False
+        if self._framed:
+            try:
+                msgs = self._frameDecoder.feed(data)
+            except common.framing.FrameError as e:
+                print("Client: Invalid data from server - {}".format(e))
+                return False
+        else:
+            msgs = [common.framing.fromLegacy(str(data.decode("utf-8")))]
+        return self._handleServerMsgs(msgs, args)
+
+    def _handleServerMsgs(self, msgs, args):
+        for ftype, text in msgs:
+            if ftype == common.framing.PUSH:
+                print(text, end="", flush=True)
+                continue
+            self.output = common.framing.toLegacy(ftype, text)
+            if not self.postProcessOutput(args):
+                return False
+            print(self.output, end="", flush=True)
+            self._awaitingOutput = False
+            if self.isPasswordPrompt():
+                self._pendingInput.appendleft(getpass.getpass(""))
+            if self._pendingInput and not self._sendInput(
+                    self._pendingInput.popleft()):
+                return False
+        return True
+
+    def _readStdin(self, args):
+        """ selectLoop callback - returns False when we're done """
+        data = os.read(sys.stdin.fileno(), BYTES_TO_TRANSFER)
+        if not data:  # end of input
+            self._selector.unregister(sys.stdin)
+            self._pendingInput.append("term")
+        self._stdinBuf += data
+        while b"\n" in self._stdinBuf:
+            line, self._stdinBuf = self._stdinBuf.split(b"\n", 1)
+            self._pendingInput.append(line.decode("utf-8").rstrip("\r"))
+        self._receivedInput = True
+        if self._pendingInput and not self._awaitingOutput:
+            return self._sendInput(self._pendingInput.popleft())
+        return True
+
+    def _sendInput(self, line):
+        """ send a line of input - returns False when we're done """
+        self.input = line
+        self.preProcessInput()
+        if not self.isRunning():  # terminate already sent it
+            return False
+        if not self.sendData():
+            print("Client: Error while sending data.  Aborting")
+            return False
+        self._awaitingOutput = True
+        return True
+
+    def isPasswordPrompt(self):
+        return self.output in ["Enter Password: ", "Verify Password: ",
+                               "Enter Account Password: "]
+
     def isRunning(self):
         return self._running
 
+    def pause(self):
+        """ raw mode gives the server time to send all of its output before
+            we read it.  Framed messages arrive whole, so there's no need """
+        if not self._framed:
+            time.sleep(1)
+
+    def setFraming(self, framedBool=True):
+        self._framed = bool(framedBool)
+
+    def setSelectMode(self, selectBool=True):
+        self._selectMode = bool(selectBool) and os.name != "nt"
+
+    def isFramed(self):
+        return self._framed
+
     def terminate(self, outStr):
         self.sendData()
         time.sleep(1)
@@ -163,14 +414,14 @@ class Client(AttributeHelper):
         elif args.username and not self._receivedInput:
             self.input = args.username
             self.sendData()
-            time.sleep(1)
+            self.pause()
             self.receiveData()
             print("Autofilled username")
             args.username = ""  # single use
             if args.password:
                 self.input = args.password
                 self.sendData()
-                time.sleep(1)
+                self.pause()
                 self.receiveData()
                 print("Autofilled password")
                 args.password = ""  # single use
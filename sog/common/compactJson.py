@@ -0,0 +1,277 @@
+""" compactJson - a compact json format for Storage objects
+
+   The jsonpickle format tags every nested object and re-indents the whole
+   tree.  The compact format is a flat json object, one attribute per line,
+   driven by the attributes that the class declares (see
+   common.attributes.AttributeHelper):
+     * intAttributes, boolAttributes and strAttributes are written as a
+       plain json int, bool or str, and are cast back to that type when
+       they are read, so a value that was saved as the wrong type is fixed
+     * listAttributes are written as a json list.  Items that aren't plain
+       json (i.e. inventory objects) are encoded one at a time
+     * nested objects that declare attributes (i.e. the objects in a room's
+       inventory) are written the same way, as a json object that starts
+       with their "py/class".  Like a saved object, they leave out
+       _datafile, _instanceDebug and their attributesThatShouldntBeSaved
+     * any other attribute that is a plain value (str, int, float, bool,
+       None, and lists and dicts of them) is written as plain json
+     * datetimes are written as {"sog/datetime": "<iso format>"}
+     * anything else (values of types that don't declare attributes) is
+       flattened by jsonpickle, on its own, and wrapped in
+       {"sog/pickled": ...}
+     * the first attribute is the format marker, so files in the old
+       jsonpickle format can still be read - see decode()
+   Values are encoded one attribute (or list item) at a time, so an object
+   that is shared by two attributes is loaded as two copies.
+"""
+
+from datetime import datetime
+import json
+import time
+
+import jsonpickle
+
+from common.metrics import latencySummary
+
+FORMAT_KEY = "sog/compact"
+FORMAT_VERSION = 1
+PICKLED_KEY = "sog/pickled"
+DATETIME_KEY = "sog/datetime"
+CLASS_KEY = "py/class"
+
+# same depth as common.storage.Storage.encodeJson
+MAX_DEPTH = 10
+
+# left out of nested objects, as common.storage.Storage.freeze does for the
+# object that is saved
+_UNSAVED_ATTRIBUTES = ["_datafile", "_instanceDebug"]
+
+_PLAIN_SCALARS = (str, int, float, bool, type(None))
+
+
+def isPlain(value):
+    """ True if value round trips through json unchanged """
+    if isinstance(value, _PLAIN_SCALARS):
+        return True
+    if type(value) is list:
+        return all(isPlain(oneVal) for oneVal in value)
+    if type(value) is dict:
+        if PICKLED_KEY in value or DATETIME_KEY in value or CLASS_KEY in value:
+            return False
+        return all(
+            isinstance(key, str) and isPlain(oneVal) for key, oneVal in value.items()
+        )
+    return False
+
+
+# declared attribute list -> the type that its attributes are saved as
+_DECLARED_TYPES = [
+    ("intAttributes", int), ("boolAttributes", bool), ("strAttributes", str),
+    ("listAttributes", list)]
+
+
+def declaredTypes(cls):
+    """ {attribute name: type} for the attributes that cls declares """
+    types = {}
+    for listName, attType in _DECLARED_TYPES:
+        for attName in getattr(cls, listName, []):
+            types.setdefault(attName, attType)
+    return types
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+def _className(cls):
+    return cls.__module__ + "." + cls.__qualname__
+
+
+def _encodeValue(value, depth=0):
+    """ a json-able version of a value that isn't declared """
+    if isPlain(value):
+        return value
+    if type(value) is datetime:
+        return {DATETIME_KEY: value.isoformat()}
+    if depth < MAX_DEPTH and hasattr(value, "__dict__") and declaredTypes(
+            type(value)):
+        return _encodeObject(value, depth + 1)
+    pickler = jsonpickle.pickler.Pickler(max_depth=MAX_DEPTH)
+    return {PICKLED_KEY: pickler.flatten(value)}
+
+
+def _encodeObject(obj, depth):
+    """ a nested object, as a json object of its attributes """
+    unsaved = list(_UNSAVED_ATTRIBUTES)
+    if hasattr(obj, "getAttributesThatShouldntBeSaved"):
+        unsaved += obj.getAttributesThatShouldntBeSaved()
+    encoded = {CLASS_KEY: _className(type(obj))}
+    for attName, value in _encodeAttributes(obj, depth):
+        if attName not in unsaved:
+            encoded[attName] = value
+    return encoded
+
+
+def _encodeAttributes(obj, depth=0):
+    """ (name, json-able value) for each of obj's attributes, sorted """
+    types = declaredTypes(type(obj))
+    for attName, value in sorted(vars(obj).items()):
+        encoded = None
+        if attName in types:
+            encoded = _encodeDeclared(value, types[attName], depth)
+        if encoded is None:
+            encoded = _encodeValue(value, depth)
+        yield (attName, encoded)
+
+
+def _encodeDeclared(value, attType, depth=0):
+    """ value as its declared type - None if it can't be converted """
+    if attType is list:
+        if not isinstance(value, (list, tuple)):
+            return None
+        return [_encodeValue(oneVal, depth) for oneVal in value]
+    if not isinstance(value, _PLAIN_SCALARS) or value is None:
+        return None
+    try:
+        return attType(value)
+    except ValueError:
+        return None
+
+
+def encode(obj):
+    """ return obj's attributes as compact json """
+    lines = [
+        _dumps(FORMAT_KEY) + ": " + _dumps(FORMAT_VERSION),
+        _dumps(CLASS_KEY) + ": " + _dumps(_className(type(obj))),
+    ]
+    for attName, encoded in _encodeAttributes(obj):
+        lines.append(_dumps(attName) + ": " + _dumps(encoded))
+    return "{\n" + ",\n".join(lines) + "\n}\n"
+
+
+def isCompact(loaded):
+    """ True if loaded (the json.loads of a file) is in the compact format """
+    return isinstance(loaded, dict) and FORMAT_KEY in loaded
+
+
+def _decodeValue(value):
+    if type(value) is list:  # i.e. a listAttribute's items
+        return [_decodeValue(oneVal) for oneVal in value]
+    if isinstance(value, dict):
+        if PICKLED_KEY in value:
+            return jsonpickle.unpickler.Unpickler().restore(value[PICKLED_KEY])
+        if DATETIME_KEY in value:
+            return datetime.fromisoformat(value[DATETIME_KEY])
+        if CLASS_KEY in value:
+            return _decodeObject(value)
+    return value
+
+
+def _decodeObject(value):
+    """ a nested object - like jsonpickle, its __init__ isn't called """
+    cls = jsonpickle.unpickler.loadclass(value[CLASS_KEY])
+    if cls is None:
+        raise ValueError("Unknown class " + str(value[CLASS_KEY]))
+    obj = cls.__new__(cls)
+    obj.__dict__.update(_decodeAttributes(value, cls))
+    return obj
+
+
+def _decodeAttributes(loaded, cls=None):
+    """ the attributes in a loaded json object.  With cls, the attributes
+        that it declares are cast to their declared types """
+    types = declaredTypes(cls) if cls else {}
+    attDict = {}
+    for attName, value in loaded.items():
+        if attName in [FORMAT_KEY, CLASS_KEY]:
+            continue
+        if attName in types:
+            attDict[attName] = _decodeDeclared(value, types[attName])
+        else:
+            attDict[attName] = _decodeValue(value)
+    return attDict
+
+
+def _decodeDeclared(value, attType):
+    """ cast a loaded value to its declared type - values that can't be
+        cast are returned as is (see AttributeHelper.fixAttributes) """
+    value = _decodeValue(value)
+    if attType is list:
+        return value
+    if isinstance(value, attType):
+        return value
+    try:
+        return attType(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def decode(text, cls=None):
+    """ returns (attribute dict, True) for the compact format, or
+        (the object, False) for the old jsonpickle format
+        * with cls, the attributes that it declares are cast to their
+          declared types """
+    loaded = json.loads(text)
+    if not isCompact(loaded):
+        return (jsonpickle.unpickler.Unpickler().restore(loaded), False)
+    return (_decodeAttributes(loaded, cls), True)
+
+
+def convert(text):
+    """ return the compact version of a file in the old jsonpickle format,
+        or None if it isn't one.  Files that are already compact are
+        returned as is """
+    thawed, compact = decode(text)
+    if compact:
+        return text
+    if not hasattr(thawed, "__dict__"):
+        return None
+    return encode(thawed)
+
+
+def _encodeOld(obj):
+    """ the old format - see common.storage.Storage.encodeJson """
+    jsonpickle.set_encoder_options("json", sort_keys=True, indent=4, ensure_ascii=False)
+    return jsonpickle.encode(obj, max_depth=MAX_DEPTH)
+
+
+def _loadOld(text):
+    """ what Storage.readJsonFile did for the old format """
+    thawed = jsonpickle.decode(text)
+    return {attName: getattr(thawed, attName) for attName in vars(thawed)}
+
+
+def _loadCompact(text):
+    return decode(text)[0]
+
+
+def benchmark(texts, iterations=3):
+    """ load and save latency (in ms), and size, of both formats
+        * texts are the contents of data files in the old format (i.e. the
+          rooms under DATADIR).  Nothing is read from or written to disk,
+          so this is just the cost of the serializer
+        * returns {format name: {"load": summary, "save": summary,
+                                 "bytes": total size}} """
+    oldTexts = [text for text in texts if not isCompact(json.loads(text))]
+    objs = [jsonpickle.decode(text) for text in oldTexts]  # imports classes
+    formats = [
+        ("jsonpickle", oldTexts, _loadOld, _encodeOld),
+        ("compact", [encode(obj) for obj in objs], _loadCompact, encode),
+    ]
+    results = {}
+    for name, fmtTexts, loadFunc, encodeFunc in formats:
+        loads, saves = [], []
+        for num in range(iterations):
+            for text, obj in zip(fmtTexts, objs):
+                startTime = time.perf_counter()
+                loadFunc(text)
+                loads.append(time.perf_counter() - startTime)
+                startTime = time.perf_counter()
+                encodeFunc(obj)
+                saves.append(time.perf_counter() - startTime)
+        results[name] = {
+            "load": latencySummary(loads),
+            "save": latencySummary(saves),
+            "bytes": sum(len(text.encode("utf-8")) for text in fmtTexts),
+        }
+    return results
@@ -0,0 +1,167 @@
+""" doorState - the closed and locked state of every door
+
+   Doors come in pairs, one on each side of an exit (see object.Door).  The
+   state of both sides is kept here, keyed by door id, so that opening a
+   door doesn't have to load, and save, the room on the other side:
+     * set() is a dict update.  The table is written behind, by its own
+       persister (see common.persister), so a door toggle never waits on
+       the disk, and many toggles are coalesced into one write
+     * rooms apply the table to their doors when they are loaded or
+       reactivated (see room.Room.postLoad)
+     * an entry is only needed until the door's state is saved with its
+       room (or door) file.  Entries are dropped when the room is saved
+       with the same state, and when the door or room is edited or
+       deleted, so the data files stay in charge of the door states
+   Each door's state is saved in its own data file, as compact json
+   ([closed, locked]), so a save only writes the doors that have changed
+"""
+
+import json
+import os
+import threading
+
+from common.general import logger
+import common.globals
+from common.persister import WriteBehind
+from common.storage import getBackend
+
+
+class DoorStateTable:
+    """ Door id -> (closed, locked)
+        * read from the data dir on first use
+        * thread-safe.  freeze() takes a copy of the changed entries, under
+          the lock, for the persister, which writes them on its I/O thread.
+          Entries stay changed until a copy with their current state has
+          been written, so a copy that is skipped or fails isn't lost
+        * flush() writes any pending change now (i.e. at shutdown) """
+
+    def __init__(self, dirname=None, persister=None):
+        self.dirname = dirname or common.globals.DOOR_STATE_DIR
+        self._persister = persister or WriteBehind()
+        self._lock = threading.Lock()
+        self._states = None
+        self._changed = set()  # door ids that haven't been written yet
+        self.writes = 0
+
+    def __str__(self):
+        return "DoorStateTable(" + self.dirname + ")"
+
+    def setDirectory(self, dirname):
+        """ use another data dir (i.e. for tests) - pending changes to the
+            old one are dropped """
+        self._persister.discard(self)
+        with self._lock:
+            self.dirname = dirname
+            self._states = None
+            self._changed = set()
+
+    def _filename(self, doorId):
+        return os.path.join(self.dirname, str(doorId) + ".json")
+
+    def _load(self):
+        """ the table - called while holding the lock """
+        if self._states is None:
+            self._states = {}
+            for name in getBackend().listDir(self.dirname):
+                doorId, ext = os.path.splitext(name)
+                if ext != ".json":
+                    continue
+                data = getBackend().read(self._filename(doorId), binary=False)
+                try:
+                    self._states[doorId] = tuple(json.loads(data))
+                except (TypeError, ValueError):
+                    logger.error("DoorStateTable: ignoring unreadable " +
+                                 self._filename(doorId))
+        return self._states
+
+    def freeze(self):
+        """ (data dir, {door id: state, or None if it was dropped}) for the
+            changed doors - the states are tuples, so they can't be changed
+            by later toggles """
+        with self._lock:
+            states = self._load()
+            return (self.dirname,
+                    {doorId: states.get(doorId) for doorId in self._changed})
+
+    def writeFrozen(self, frozen):
+        dirname, changes = frozen
+        written = {}
+        try:
+            for doorId, state in changes.items():
+                filename = os.path.join(dirname, doorId + ".json")
+                if state is None:
+                    getBackend().delete(filename)
+                else:
+                    getBackend().write(
+                        filename, json.dumps(state, separators=(",", ":")))
+                written[doorId] = state
+        finally:
+            with self._lock:
+                if dirname == self.dirname:
+                    states = self._load()
+                    for doorId, state in written.items():
+                        if states.get(doorId) == state:
+                            self._changed.discard(doorId)
+        self.writes += 1
+        return True
+
+    def flush(self):
+        """ write the changes now - returns False if the write failed """
+        return self._persister.flush(self)
+
+    def get(self, doorId):
+        """ return (closed, locked) for the door, or None """
+        with self._lock:
+            return self._load().get(str(doorId))
+
+    def set(self, doorStates):
+        """ record {door id: (closed, locked)} - returns True if anything
+            changed, and will be written """
+        with self._lock:
+            states = self._load()
+            changed = False
+            for doorId, (closed, locked) in doorStates.items():
+                state = (bool(closed), bool(locked))
+                if states.get(str(doorId)) != state:
+                    states[str(doorId)] = state
+                    self._changed.add(str(doorId))
+                    changed = True
+        if changed:
+            self._persister.markDirty(self)
+        return changed
+
+    def discard(self, doorIds):
+        """ forget the given doors - i.e. doors that were edited or deleted,
+            whose data files now have the last word """
+        return self._discard({str(doorId): None for doorId in doorIds})
+
+    def discardSaved(self, doorStates):
+        """ forget the doors in {door id: (closed, locked)} that still have
+            that state - i.e. the room that they're in was saved with it """
+        return self._discard({str(doorId): tuple(state)
+                              for doorId, state in doorStates.items()})
+
+    def _discard(self, doorStates):
+        """ forget the doors whose state matches (None matches any) """
+        with self._lock:
+            states = self._load()
+            removed = 0
+            for doorId, state in doorStates.items():
+                if doorId in states and state in [None, states[doorId]]:
+                    del states[doorId]
+                    self._changed.add(doorId)
+                    removed += 1
+        if removed:
+            self._persister.markDirty(self)
+        return removed
+
+    def apply(self, doorObj):
+        """ set the door's state from the table - True if it has one """
+        state = self.get(doorObj.getId())
+        if state is None:
+            return False
+        doorObj.setDoorState(state)
+        return True
+
+
+doorStates = DoorStateTable()  # shared by all rooms
@@ -0,0 +1,129 @@
+""" framing - length-prefixed wire protocol shared by client and server
+
+   Every message on the wire is a frame:
+     * 1 byte frame type (DATA, NOOP, TERM, STOP, PUSH)
+     * 4 byte payload length (network byte order)
+     * payload - utf-8 text
+
+   A framed client opens the connection by sending PREAMBLE.  The server
+   echoes it back and both sides switch to frames.  Legacy clients never
+   send first, so a server that doesn't receive the preamble shortly after
+   the connection is established falls back to the raw protocol, where
+   each recv is a single message and the control strings are sent as-is.
+     * a client that sends something else first (i.e. telnet) gets the
+       raw protocol right away.  One that sends nothing waits out
+       FRAME_HANDSHAKE_TIMEOUT before it gets the welcome
+     * older servers send their welcome without waiting, so a framed
+       client listens briefly before it sends the preamble, and uses the
+       raw protocol if output shows up (see clientLib.startFraming)
+
+   PUSH frames carry output that the server sends on its own, while the
+   client is sitting at a prompt.  They are only used with framed clients,
+   which display them right away, without waiting for the next DATA frame.
+"""
+
+import struct
+
+import common.globals
+
+PREAMBLE = b"=-o-= SOGF1 =-o-="
+
+DATA = 1
+NOOP = 2
+TERM = 3
+STOP = 4
+PUSH = 5
+
+FRAME_TYPES = (DATA, NOOP, TERM, STOP, PUSH)
+HEADER = struct.Struct("!BI")
+MAX_FRAME_SIZE = 1024 * 1024
+
+# map between frame types and the control strings used in raw mode
+_LEGACY_STRS = {
+    NOOP: common.globals.NOOP_STR,
+    TERM: common.globals.TERM_STR,
+    STOP: common.globals.STOP_STR,
+}
+
+
+class FrameError(ValueError):
+    """ Raised when the peer sends something that isn't a valid frame """
+
+
+def encodeFrame(ftype, text=""):
+    """ Return the bytes for a single frame """
+    if ftype not in FRAME_TYPES:
+        raise FrameError("Unknown frame type {}".format(ftype))
+    payload = str(text).encode("utf-8")
+    return HEADER.pack(ftype, len(payload)) + payload
+
+
+def frameChunks(ftype, chunks):
+    """ Return a list of byte chunks, with a frame header in front of them
+        * lets the caller send the payload without joining it first """
+    if ftype not in FRAME_TYPES:
+        raise FrameError("Unknown frame type {}".format(ftype))
+    return [HEADER.pack(ftype, sum(len(chunk) for chunk in chunks))] + chunks
+
+
+def fromLegacy(text):
+    """ Convert a raw mode message into a (frameType, text) tuple """
+    for ftype, legacyStr in _LEGACY_STRS.items():
+        if text == legacyStr:
+            return (ftype, "")
+    return (DATA, text)
+
+
+def toLegacy(ftype, text=""):
+    """ Convert a frame into the equivalent raw mode message """
+    if ftype in _LEGACY_STRS:
+        return _LEGACY_STRS[ftype]
+    return text
+
+
+def encodeLegacy(text):
+    """ Return the frame for a raw mode message (i.e. NOOP_STR -> NOOP) """
+    return encodeFrame(*fromLegacy(text))
+
+
+def preambleStatus(data):
+    """ Check the first bytes received on a new connection
+        * returns True if data starts with the preamble, None if it's an
+          incomplete preamble and more data is needed, and False otherwise """
+    if data.startswith(PREAMBLE):
+        return True
+    if PREAMBLE.startswith(data):
+        return None
+    return False
+
+
+class FrameDecoder:
+    """ Streaming frame reassembly
+        * feed it whatever recv returns and it returns the complete frames,
+          holding on to any partial frame until the rest of it arrives """
+
+    def __init__(self, maxFrameSize=MAX_FRAME_SIZE):
+        self._buffer = bytearray()
+        self._maxFrameSize = maxFrameSize
+
+    def feed(self, data):
+        """ Add data and return a list of complete (frameType, text) tuples """
+        self._buffer += data
+        frames = []
+        while len(self._buffer) >= HEADER.size:
+            ftype, length = HEADER.unpack_from(self._buffer)
+            if ftype not in FRAME_TYPES:
+                raise FrameError("Unknown frame type {}".format(ftype))
+            if length > self._maxFrameSize:
+                raise FrameError("Frame size {} exceeds limit".format(length))
+            end = HEADER.size + length
+            if len(self._buffer) < end:
+                break
+            payload = bytes(self._buffer[HEADER.size:end])
+            del self._buffer[:end]
+            frames.append((ftype, payload.decode("utf-8", errors="replace")))
+        return frames
+
+    def pending(self):
+        """ Number of bytes held for an incomplete frame """
+        return len(self._buffer)
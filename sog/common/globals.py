@@ -5,6 +5,8 @@
 #########
 import os
 
+from common.registry import ConnectionRegistry
+
 FILEDIR = os.path.dirname(os.path.abspath(__file__))
 ROOTDIR = os.path.abspath(os.path.join(FILEDIR, ".."))
 
@@ -19,19 +21,86 @@ LOGDIR = os.getenv('SOG_SERVER_LOGDIR', os.path.join(ROOTDIR, ".logs"))
 HOST = os.getenv('SOG_SERVER_HOST', "127.0.0.1")  # hostname or IP address
 PORT = int(os.getenv('SOG_SERVER_PORT', '8888'))  # The port used by the server
 BYTES_TO_TRANSFER = 2048
+# max number of connections waiting to be accepted
+LISTEN_BACKLOG = int(os.getenv('SOG_SERVER_LISTEN_BACKLOG', '128'))
+# seconds between checks that the async thread is still running
+THREAD_CHECK_INTERVAL = 1
+# Max bytes of output held for a client.  Oldest messages are dropped when
+# a client falls this far behind
+SPOOL_HIGH_WATER = int(os.getenv('SOG_SERVER_SPOOL_HIGH_WATER', '262144'))
+# Secs that a send to a client can take.  A client that doesn't read its
+# output for this long is disconnected
+SEND_TIMEOUT = float(os.getenv('SOG_SERVER_SEND_TIMEOUT', '5'))
+
+# Server engine - "thread" (one thread per connection) or "asyncio" (all
+# connections driven from a single event loop)
+SERVER_ENGINE = os.getenv('SOG_SERVER_ENGINE', "thread")
+# asyncio engine - max number of worker threads running commands concurrently
+ASYNC_WORKERS = int(os.getenv('SOG_SERVER_ASYNC_WORKERS', '32'))
+
+# Async game tick - runs every TICK_INTERVAL secs.  TICK_OVERRUN_POLICY is
+# what to do when a tick runs past the start of the next one (see
+# threads.AsyncThread): skip or stretch
+TICK_INTERVAL = float(os.getenv('SOG_SERVER_TICK_INTERVAL', '1'))
+TICK_OVERRUN_POLICIES = ["skip", "stretch"]
+TICK_OVERRUN_POLICY = os.getenv('SOG_SERVER_TICK_POLICY', "skip")
+# Ticks that take longer than TICK_BUDGET secs are counted as overruns, and
+# ticks longer than TICK_SLOW_THRESHOLD secs are logged.  Timing histograms
+# cover the last TICK_METRICS_WINDOW ticks
+TICK_BUDGET = TICK_INTERVAL
+TICK_SLOW_THRESHOLD = float(os.getenv('SOG_SERVER_TICK_SLOW', '0.25'))
+TICK_METRICS_WINDOW = 600
+
+# Room actors (opt-in) - when on, each active room gets a serial queue.
+# Player commands, encounters and creature attacks for a room run one at a
+# time on its queue, and ROOM_ACTOR_WORKERS threads run the queued tick work
+ROOM_ACTORS = os.getenv('SOG_SERVER_ROOM_ACTORS', "off").lower() in ["on", "true"]
+ROOM_ACTOR_WORKERS = int(os.getenv('SOG_SERVER_ROOM_ACTOR_WORKERS', '4'))
+
+# Character saves are written behind, by an I/O thread.  A changed
+# character is saved within SAVE_MAX_STALENESS secs (0 saves right away)
+SAVE_MAX_STALENESS = float(os.getenv('SOG_SERVER_SAVE_MAX_STALENESS', '5'))
+# Data files are written to a temp file and renamed into place.
+# SAVE_DURABILITY is when they are fsync'd (see common.storage.atomicWrite):
+# none, periodic (every SAVE_FSYNC_INTERVAL secs), or transaction (before
+# the save returns)
+SAVE_DURABILITY_LEVELS = ["none", "periodic", "transaction"]
+SAVE_DURABILITY = os.getenv('SOG_SERVER_SAVE_DURABILITY', "periodic")
+SAVE_FSYNC_INTERVAL = float(os.getenv('SOG_SERVER_SAVE_FSYNC_INTERVAL', '1'))
+# Where Storage objects are kept - "file" (one file each, under DATADIR) or
+# "sqlite" (rows in the STORAGE_DB database - see storagetool.py migrate)
+STORAGE_BACKEND = os.getenv('SOG_SERVER_STORAGE', "file")
+STORAGE_DB = os.getenv('SOG_SERVER_STORAGE_DB', os.path.join(DATADIR, "sog.db"))
+# Decoded creature and object files are kept in a template cache (see
+# common/templates.py), up to TEMPLATE_CACHE_ENTRIES files (0 turns it off)
+# and TEMPLATE_CACHE_BYTES of data file content
+TEMPLATE_CACHE_ENTRIES = int(os.getenv('SOG_SERVER_TEMPLATE_CACHE_ENTRIES', '1000'))
+TEMPLATE_CACHE_BYTES = int(os.getenv('SOG_SERVER_TEMPLATE_CACHE_BYTES', '8000000'))
+# Rooms that were emptied are kept warm, so that the next player to enter
+# doesn't load them again - up to WARM_ROOMS rooms (0 turns it off) and
+# WARM_ROOM_BYTES of saved room data, each for WARM_ROOM_SECS
+WARM_ROOMS = int(os.getenv('SOG_SERVER_WARM_ROOMS', '64'))
+WARM_ROOM_SECS = float(os.getenv('SOG_SERVER_WARM_ROOM_SECS', '300'))
+WARM_ROOM_BYTES = int(os.getenv('SOG_SERVER_WARM_ROOM_BYTES', '4000000'))
+# The closed/locked state of every door, one file per door (see
+# common/doorState.py)
+DOOR_STATE_DIR = os.path.join(DATADIR, "DoorState")
 
 NOOP_STR = "=-o-= NOOP =-o-="
 TERM_STR = "=-o-= TERM =-o-="
 STOP_STR = "=-o-= STOP =-o-="
 
+# Framed protocol (see common/framing.py) - seconds the server waits for a
+# new connection to send the framing preamble before assuming a raw client
+FRAME_HANDSHAKE_TIMEOUT = float(os.getenv('SOG_SERVER_FRAME_HANDSHAKE', '0.5'))
+
 
 ###################
 # Runtime globals #
 ###################
 
 # These are shared vars that are populated at runtime
-connections = []
-totalConnections = 0
+connections = ConnectionRegistry()  # clients, keyed by connection id
 
 
 #################
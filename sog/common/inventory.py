@@ -3,11 +3,18 @@
 import inflect
 import re
 import textwrap
+import threading
 
 from common.general import getRandomItemFromList, dLog, itemSort
 
 # from common.general import logger
 
+# Inventories (and room character lists) are copy-on-write.  Writers build a
+# new list and swap it in while holding this lock.  Readers use the current
+# list without locking - it's never changed in place, so it's safe to iterate
+# over while other threads add and remove items.
+inventoryWriteLock = threading.RLock()
+
 
 class Inventory:
     """ A generic inventory SuperClass
@@ -68,18 +75,23 @@ class Inventory:
         return self._inventoryTruncSize
 
     def addToInventory(self, item, maxSize=99999):
-        if len(self.getInventory()) >= maxSize:
-            return False
-        self._inventory.append(item)
+        with inventoryWriteLock:
+            if len(self._inventory) >= maxSize:
+                return False
+            self._inventory = self._inventory + [item]
         self._setInventoryWeight()
         self._setInventoryValue()
         return True
 
     def removeFromInventory(self, item):
-        if item in self._inventory:
-            self._inventory.remove(item)
-            self._setInventoryWeight()
-            self._setInventoryValue()
+        with inventoryWriteLock:
+            if item not in self._inventory:
+                return True
+            newInventory = list(self._inventory)
+            newInventory.remove(item)
+            self._inventory = newInventory
+        self._setInventoryWeight()
+        self._setInventoryValue()
         return True
 
     def describeInventory(
@@ -222,7 +234,8 @@ class Inventory:
         """ remove everything from inventory that exceeds <num> items """
         if not num:
             num = self._inventoryTruncSize
-        del self._inventory[num:]
+        with inventoryWriteLock:
+            self._inventory = self._inventory[:num]
 
     def _setInventoryWeight(self):
         """ Calculate the weight of inventory """
@@ -1,11 +1,178 @@
 """ i/o spool class """
 
 # import importlib
+import collections
 from common.general import Terminator, logger
+import common.framing
 import common.globals
-import queue
 import re
+import select
+import socket
 import sys
+import threading
+import time
+
+IOV_MAX = 1024  # max chunks per sendmsg call (posix minimum is 16)
+
+
+TRUNCATED_MSG = b"[output truncated]\n"
+
+
+class OutputBuffer:
+    """ Output spool that holds utf-8 encoded chunks, one per spoolOut
+        * chunks are encoded once, when queued, and are sent as-is (see
+          sendChunks), so popping the spool doesn't copy strings around
+        * if the client isn't reading, the buffer is capped at highWater
+          bytes by dropping the oldest chunks.  The output then starts with
+          a single TRUNCATED_MSG, so the player knows that some was lost
+        * a count of each pending message is kept, so that checking for a
+          duplicate message doesn't require a scan of the buffer """
+
+    def __init__(self, highWater=None):
+        self._chunks = collections.deque()
+        self._pending = collections.Counter()  # chunk -> number queued
+        self._size = 0
+        self._highWater = highWater or common.globals.SPOOL_HIGH_WATER
+        self._lock = threading.Lock()
+        self._dropped = 0
+
+    def put(self, txt):
+        chunk = str(txt).encode("utf-8")
+        with self._lock:
+            wasDropping = self._dropped
+            self._chunks.append(chunk)
+            self._pending[chunk] += 1
+            self._size += len(chunk)
+            while self._size > self._highWater and len(self._chunks) > 1:
+                oldChunk = self._chunks.popleft()
+                self._size -= len(oldChunk)
+                self._pending[oldChunk] -= 1
+                if not self._pending[oldChunk]:
+                    del self._pending[oldChunk]
+                self._dropped += 1
+            startedDropping = self._dropped and not wasDropping
+        if startedDropping:
+            logger.warning("Output spool over {} bytes.  Dropping oldest msgs".format(
+                self._highWater))
+
+    def empty(self):
+        return not self._chunks
+
+    def size(self):
+        """ number of bytes in the buffer """
+        return self._size
+
+    def popChunks(self):
+        """ Return the list of encoded chunks and empty the buffer """
+        with self._lock:
+            chunks = list(self._chunks)
+            self._chunks.clear()
+            self._pending.clear()
+            self._size = 0
+            dropped = self._dropped
+            self._dropped = 0
+        if dropped:
+            chunks.insert(0, TRUNCATED_MSG)
+            logger.warning("Output spool over {} bytes.  Dropped {} msgs".format(
+                self._highWater, dropped))
+        return chunks
+
+    def pop(self):
+        """ Return the buffer as a string and empty the buffer """
+        return b"".join(self.popChunks()).decode("utf-8")
+
+    def hasMsg(self, txt):
+        """ returns True if the exact message is queued - constant time """
+        chunk = str(txt).encode("utf-8")
+        with self._lock:
+            return chunk in self._pending
+
+    def contains(self, regex):
+        """ returns True if any of the queued messages match regex """
+        with self._lock:
+            chunks = list(self._chunks)
+        for chunk in chunks:
+            if re.search(regex, chunk.decode("utf-8")):
+                return True
+        return False
+
+
+def lastLine(chunks):
+    """ Return the bytes after the last newline in a list of chunks """
+    tail = []
+    for chunk in reversed(chunks):
+        pos = chunk.rfind(b"\n")
+        if pos != -1:
+            tail.append(chunk[pos + 1:])
+            break
+        tail.append(chunk)
+    return b"".join(reversed(tail))
+
+
+def _waitWritable(sock, deadline):
+    """ wait until sock can be written to - raise socket.timeout if that
+        doesn't happen before deadline (time.monotonic) """
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0 or not select.select([], [sock], [], remaining)[1]:
+        raise socket.timeout("client isn't reading")
+    return None
+
+
+def _sendViews(sock, views, flags):
+    """ sendmsg as much of a list of memoryviews as the socket will take -
+        returns the views that are left (empty once everything is sent)
+        * with MSG_DONTWAIT, this stops when the socket buffer is full """
+    num = 0
+    while num < len(views):
+        try:
+            sent = sock.sendmsg(views[num:num + IOV_MAX], [], flags)
+        except BlockingIOError:
+            break
+        while num < len(views) and sent >= len(views[num]):
+            sent -= len(views[num])
+            num += 1
+        if sent:  # partial send of a chunk
+            views[num] = views[num][sent:]
+    return views[num:]
+
+
+def sendChunks(sock, chunks, timeout=None):
+    """ Send a list of byte chunks in as few system calls as possible
+        * uses sendmsg (scatter/gather i/o) where the platform has it, so
+          the chunks don't have to be joined into a new string first
+        * with a timeout, the sends don't block (MSG_DONTWAIT), and
+          socket.timeout is raised if the client hasn't taken all of the
+          data within timeout secs.  The socket itself is left in blocking
+          mode, for the thread that reads from it """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    flags = getattr(socket, "MSG_DONTWAIT", 0) if deadline else 0
+    if not hasattr(sock, "sendmsg") or (deadline and not flags):
+        # best effort - sendall can still block once the socket is writable
+        _waitWritable(sock, deadline)
+        sock.sendall(b"".join(chunks))
+        return None
+    views = [memoryview(chunk) for chunk in chunks if chunk]
+    while views:
+        views = _sendViews(sock, views, flags)
+        if views:
+            _waitWritable(sock, deadline)
+    return None
+
+
+def sendNoWait(sock, chunks):
+    """ Send as much of a list of byte chunks as the socket will take
+        right now - returns the chunks that are left over, for the caller
+        to send once the socket is writable again (see select)
+        * where there is no non-blocking sendmsg, everything is sent, and
+          the send can wait for up to SEND_TIMEOUT secs """
+    flags = getattr(socket, "MSG_DONTWAIT", 0)
+    if not hasattr(sock, "sendmsg") or not flags:
+        sendChunks(sock, chunks, timeout=common.globals.SEND_TIMEOUT)
+        return []
+    return _sendViews(sock, [memoryview(chunk) for chunk in chunks if chunk],
+                      flags)
 
 
 class Spooler:
@@ -13,13 +180,14 @@ class Spooler:
 
     def __init__(self):
         self._inputStr = ""  # user input buffer
-        self._outputSpool = queue.Queue()  # output buffer
+        self._outputSpool = OutputBuffer()  # output buffer
         self._debugIO = False  # Turn on/off debug logging
         self._maxPromptRetries = 10  # of times an input is retried
+        self._promptHook = None  # see setPromptHook
 
     def spoolOut(self, txt):
         """ Append to output buffer """
-        self._outputSpool.put(str(txt))
+        self._outputSpool.put(txt)
 
     def getInputStr(self):
         """ Get command from input buffer """
@@ -32,34 +200,34 @@ class Spooler:
     def popOutSpool(self):
         """ Return string with entirety of outpool spool.
             Output spool is emptied """
-        data = ""
-        while not self._outputSpool.empty():
-            data += self._outputSpool.get()
-        return data
+        return self._outputSpool.pop()
 
-    def outputSpoolContains(self, str1):
-        """ returns True if given string is in the output spool
-            * since the queue doesn't have a way to peek at it, we end up
-              emptying and replacing the queue.
-              * This is inefficient, but since the use case is rare and the
-                queue is always small, we don't care.  Maybe someday we'll
-                switch to a better queuing mechanism """
-        found = False
-
-        if self._outputSpool.empty():
-            return False
-
-        newQueue = queue.Queue()
-        while not self._outputSpool.empty():
-            data = self._outputSpool.get()
-            if re.search(str1, data):
-                found = True
-            newQueue.put(data)
-        self._outputSpool = newQueue
+    def popOutSpoolChunks(self):
+        """ Return the encoded chunks in the output spool.
+            Output spool is emptied """
+        return self._outputSpool.popChunks()
 
-        if found:
-            return True
-        return False
+    def outputSpoolContains(self, str1):
+        """ returns True if given regex matches a message in the output spool
+            * scans the spool - use outputSpoolHasMsg for exact matches """
+        return self._outputSpool.contains(str1)
+
+    def outputSpoolHasMsg(self, msg):
+        """ returns True if the given message is already in the output spool """
+        return self._outputSpool.hasMsg(msg)
+
+    def setPromptHook(self, hook=None):
+        """ hook() returns a context manager that the prompts wait for their
+            input in - set by the game, so that a player who is answering a
+            prompt doesn't hold up their room (see game.Game.waitForInput) """
+        self._promptHook = hook
+
+    def _receiveInput(self):
+        """ send the spooled output, and wait for the player's input """
+        if not self._promptHook:
+            return self._sendAndReceive()
+        with self._promptHook():
+            return self._sendAndReceive()
 
     def getMaxPromptRetries(self):
         return self._maxPromptRetries
@@ -70,7 +238,7 @@ class Spooler:
             # logger.debug("PromptForInput try " + str(x))
             self.spoolOut(promptStr)
             oneStr = ""
-            if self._sendAndReceive():
+            if self._receiveInput():
                 oneStr = self.getInputStr()
             else:
                 logger.debug("S&R returned False")
@@ -99,7 +267,7 @@ class Spooler:
             )
         while True:
             self.spoolOut(promptStr)
-            self._sendAndReceive()
+            self._receiveInput()
             numStr = self.getInputStr()
 
             if re.match("^[0-9]+$", str(numStr)):
@@ -114,7 +282,7 @@ class Spooler:
         """ prompt for yes/no input - return True or False """
         while True:
             self.spoolOut(promptStr + " [y/N]: ")
-            self._sendAndReceive()
+            self._receiveInput()
             oneStr = self.getInputStr()
             if oneStr == "y" or oneStr == "Y":
                 return True
@@ -128,7 +296,7 @@ class Spooler:
             promptStr = self.getCmdPrompt()
 
         self.spoolOut(promptStr)
-        if self._sendAndReceive():
+        if self._receiveInput():
             return True
         return False
 
@@ -258,63 +426,285 @@ class TestIo(Spooler):
 
 
 class ServerIo(Spooler):
+    """ Spooler for clients connected over the network
+        * speaks either the framed protocol or the legacy raw protocol, as
+          decided when the connection is established (see common/framing)
+        * framed clients that are sitting at a prompt get output pushed to
+          them as soon as it is spooled, followed by the prompt again
+        * pushes never block.  Whatever the client's socket won't take is
+          held as unsent output, and sent when the socket is writable (see
+          threads.PushThread), or ahead of the session's next send """
+
+    def __init__(self):
+        super().__init__()
+        self._framed = False
+        self._frameDecoder = None
+        self._clientMsgs = collections.deque()  # received (frameType, text)
+        self._sendLock = threading.Lock()  # session vs push sends
+        self._awaitingInput = False  # output was sent, waiting for a reply
+        self._lastPrompt = b""
+        self._unsent = []  # pushed output that the socket didn't take yet
+        self._unsentSince = None  # time.monotonic() when it started backing up
+
+    def isFramed(self):
+        return self._framed
+
+    def spoolOut(self, txt):
+        """ Append to output buffer - push it if the client is idle """
+        super().spoolOut(txt)
+        if self._awaitingInput and self._framed:
+            self.requestPush()
+
+    def requestPush(self):
+        """ Arrange for pushOutput to be called soon
+            * intended to be overwritten in subClass """
+        return None
+
+    def pushOutput(self):
+        """ Send spooled output to a client that is waiting at a prompt
+            * redraws the prompt that the client is sitting at
+            * never waits on the session thread - if it is sending, it
+              pushes whatever is left when it is done (see _sendOutput)
+            * never waits on the client - see _sendUnsent
+            * returns True if all of the output has been sent """
+        if not self._sendLock.acquire(blocking=False):
+            return False
+        try:
+            if self._awaitingInput and not self._outputSpool.empty():
+                chunks = [b"\n"] + self.popOutSpoolChunks() + [self._lastPrompt]
+                if self._debugServer:
+                    logger.debug(str(self) + " PUSHING:\n" +
+                                 b"".join(chunks).decode("utf-8"))
+                self._unsent.extend(
+                    self._chunksForClient(common.framing.PUSH, chunks))
+            elif not self._unsent:
+                return False  # nothing to push
+            return self._sendUnsent()
+        finally:
+            self._sendLock.release()
+
+    def hasUnsentOutput(self):
+        return bool(self._unsent)
+
+    def _sendUnsent(self):
+        """ Send as much of the unsent output as the client will take,
+            without blocking - called while holding the send lock
+            * a client that lets more than SPOOL_HIGH_WATER bytes back up,
+              or doesn't take any of it for SEND_TIMEOUT secs, has stopped
+              reading, and is disconnected
+            * returns True if all of it has been sent """
+        size = sum(len(chunk) for chunk in self._unsent)
+        try:
+            unsent = self._writeNoWait(self._unsent)
+        except socket.timeout:
+            unsent = None
+        except OSError:  # the session thread will see that it's gone
+            self._unsent = []
+            self._unsentSince = None
+            return False
+        if unsent:
+            left = sum(len(chunk) for chunk in unsent)
+            if left < size or self._unsentSince is None:
+                self._unsentSince = time.monotonic()  # the client is reading
+            elif time.monotonic() - self._unsentSince > common.globals.SEND_TIMEOUT:
+                unsent = None
+            if left > common.globals.SPOOL_HIGH_WATER:
+                unsent = None
+        if unsent is None:
+            self._unsent = []
+            self._unsentSince = None
+            self._dropClient()
+            return False
+        self._unsent = unsent
+        if not unsent:
+            self._unsentSince = None
+        return not unsent
+
+    def _writeNoWait(self, chunks):
+        """ Send what the client will take of a list of byte chunks right
+            now - returns the chunks that are left over """
+        return sendNoWait(self.socket, chunks)
+
+    def _writeToClient(self, chunks):
+        """ Send a list of byte chunks to the client
+            * raises socket.timeout if the client doesn't take them within
+              SEND_TIMEOUT secs, so a client that has stopped reading can't
+              hold up the thread that is sending """
+        sendChunks(self.socket, chunks, timeout=common.globals.SEND_TIMEOUT)
+
+    def _dropClient(self):
+        """ Disconnect a client that has stopped reading its output
+            * a send to it may have been cut off part way through, so the
+              connection can't be used again.  Shutting the socket down
+              wakes up the session thread, which cleans up as if the client
+              had disconnected """
+        logger.warning("{} Client isn't reading its output - disconnecting".format(
+            self))
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _sendOutput(self):
+        """ Send the output spool and mark the client as waiting for input
+            * the flag is set before the spool is emptied, so anything
+              spooled from here on is either sent now or pushed later
+            * the last line of the output is the prompt """
+        with self._sendLock:
+            self._awaitingInput = True
+            chunks = self.popOutSpoolChunks()
+            if self._debugServer:
+                logger.debug(str(self) + " SENDING:\n" +
+                             b"".join(chunks).decode("utf-8"))
+            self._lastPrompt = lastLine(chunks)
+            unsent, self._unsent = self._unsent, []  # earlier pushes go first
+            self._unsentSince = None
+            self._writeToClient(
+                unsent + self._chunksForClient(common.framing.DATA, chunks))
+        if self._framed and not self._outputSpool.empty():
+            self.requestPush()  # spooled while we were sending
+
+    def _inputReceived(self):
+        with self._sendLock:
+            self._awaitingInput = False
+
+    def negotiateFraming(self):
+        """ Wait briefly for the client to send the framing preamble
+              * legacy clients never send first, so if nothing shows up
+                before the timeout, we stick with the raw protocol
+              * as soon as the first bytes aren't the preamble, we stop
+                waiting - they're kept as the client's first input """
+        if not self.socket:
+            return False
+        data = b""
+        status = None
+        oldTimeout = self.socket.gettimeout()
+        self.socket.settimeout(common.globals.FRAME_HANDSHAKE_TIMEOUT)
+        try:
+            while status is None:
+                chunk = self.socket.recv(common.globals.BYTES_TO_TRANSFER)
+                if not chunk:
+                    break
+                data += chunk
+                status = common.framing.preambleStatus(data)
+            if status:
+                self.socket.sendall(common.framing.PREAMBLE)  # acknowledge
+        except OSError:  # includes the timeout
+            pass
+        finally:
+            self.socket.settimeout(oldTimeout)
+        return self._startProtocol(bool(status), data)
+
+    def _startProtocol(self, framed, data):
+        """ Set the protocol and hold on to anything that arrived with (or
+            instead of) the preamble """
+        self._framed = framed
+        if framed:
+            self._frameDecoder = common.framing.FrameDecoder()
+            data = data[len(common.framing.PREAMBLE):]
+        if self._debugServer:
+            logger.debug("{} Using {} protocol".format(
+                self, "framed" if framed else "raw"))
+        if data:
+            self._bufferClientData(data)
+        return framed
+
+    def _encodeForClient(self, ftype, text=""):
+        """ Return the bytes to send to the client for the given message """
+        if self._framed:
+            return common.framing.encodeFrame(ftype, text)
+        return str.encode(common.framing.toLegacy(ftype, text))
+
+    def _chunksForClient(self, ftype, chunks):
+        """ Return the list of chunks to send for an output message """
+        if self._framed:
+            return common.framing.frameChunks(ftype, chunks)
+        return chunks
+
+    def _bufferClientData(self, clientdata):
+        """ Queue up the messages contained in the data received
+              * framed - zero or more complete frames (partials are held)
+              * raw - each recv is treated as a single message """
+        if self._framed:
+            self._clientMsgs.extend(self._frameDecoder.feed(clientdata))
+        else:
+            clientdata = str(clientdata.decode("utf-8"))
+            self._clientMsgs.append(common.framing.fromLegacy(clientdata))
+
     def _sendAndReceive(self):  # noqa: C901
         """ All client Input and output function go through here
               * Override IOspool for client/server communication
               * send and recieve is connected in a single transaction
               * Data to be sent comes from the outputSpool queue
               * Data Recieveed goed into the inputStr var """
-        clientdata = ""
-        dataToSend = self.popOutSpool()
-
         if self.socket:
             try:
-                # send the data
-                if self._debugServer:
-                    logger.debug(str(self) + " SENDING:\n" + dataToSend)
-                self.socket.sendall(str.encode(dataToSend))
+                self._sendOutput()  # send the data
                 if self._debugServer:
                     logger.debug(str(self) + " SEND: Data Sent")
             except (ConnectionResetError, ConnectionAbortedError):
                 self.terminateClientConnection()
                 return False
+            except socket.timeout:
+                self._dropClient()
+                self.terminateClientConnection()
+                return False
             except IOError:
                 pass
 
             try:
                 if self._debugServer:
                     logger.debug(str(self) + " REC: Waiting for input")
-                clientdata = self.socket.recv(common.globals.BYTES_TO_TRANSFER)
-                if self._debugServer:
-                    logger.debug(str(self) + " REC: " + str(clientdata.decode("utf-8")))
+                while not self._clientMsgs:
+                    clientdata = self.socket.recv(common.globals.BYTES_TO_TRANSFER)
+                    if self._debugServer:
+                        logger.debug(str(self) + " REC: " + str(clientdata))
+                    if not clientdata:  # closed, or dropped by _dropClient
+                        self.terminateClientConnection()
+                        return False
+                    self._bufferClientData(clientdata)
             except (ConnectionResetError, ConnectionAbortedError):
                 self.terminateClientConnection()
                 return False
+            except common.framing.FrameError as e:
+                logger.warning("{} Invalid frame - {}".format(self, e))
+                self.terminateClientConnection()
+                return False
             except IOError:
                 pass
+            finally:
+                self._inputReceived()
         else:
+            self.popOutSpool()
             logger.debug(str(self) + " No socket to receive input from")
             return False
 
-        if clientdata:
-            clientdata = str(clientdata.decode("utf-8"))
-            if clientdata == common.globals.NOOP_STR:  # empty sends
-                clientdata = ""
-                if self._debugServer:
-                    logger.debug("Server received NO_OP from client")
-            elif clientdata == common.globals.TERM_STR:  # client shut down
-                if self._debugServer:
-                    logger.debug("Server received TERM_STR from client")
-                self.terminateClientConnection()
-                return False
-            elif clientdata == common.globals.STOP_STR:  # server shut down
-                if self._debugServer:
-                    logger.debug("Server received STOP_STR from client")
-                self.terminateClientConnection()
-                raise Terminator
-                return False
-            self.setInputStr(clientdata)
-        else:
+        return self._processClientMsg()
+
+    def _processClientMsg(self):
+        """ Handle the next message received from the client
+              * control messages (noop/term/stop) are handled here
+              * anything else is stored as the input string
+              * returns False if there is no usable input """
+        if not self._clientMsgs:
             logger.debug(str(self) + " No clientdata returned")
             return False
+
+        ftype, clientdata = self._clientMsgs.popleft()
+        if ftype == common.framing.NOOP:  # empty sends
+            clientdata = ""
+            if self._debugServer:
+                logger.debug("Server received NO_OP from client")
+        elif ftype == common.framing.TERM:  # client shut down
+            if self._debugServer:
+                logger.debug("Server received TERM_STR from client")
+            self.terminateClientConnection()
+            return False
+        elif ftype == common.framing.STOP:  # server shut down
+            if self._debugServer:
+                logger.debug("Server received STOP_STR from client")
+            self.terminateClientConnection()
+            raise Terminator
+            return False
+        self.setInputStr(clientdata)
         return True
@@ -16,10 +16,10 @@ class Ipc:
             return False
 
         if isinstance(character, str):
-            for oneChar in self.getCharacterList():  # get chars in game
-                if re.match(character.lower(), oneChar.getName().lower()):
-                    recipientObj = oneChar
-                    break
+            # first character in the game whose name starts with the string
+            recipientObj = self.getPlayerRegistry().findByName(character)
+            if not recipientObj:
+                return False
         else:
             recipientObj = character
 
@@ -56,7 +56,7 @@ class Ipc:
             )
             return False
 
-        if not allowDupMsgs and charObj.client.outputSpoolContains(msg):
+        if not allowDupMsgs and charObj.client.outputSpoolHasMsg(msg):
             # skip duplicate messages
             return True
 
@@ -118,8 +118,8 @@ class Ipc:
             logger.debug("yellMsg: ajoining rooms" + str(roomNumbList))
 
         # If any of the rooms are active, display message there.
-        for oneRoom in self.getActiveRoomList():  # foreach active room
-            if oneRoom.getId() in roomNumbList:  # if room id is an exit
-                if self.roomMsg(oneRoom, msg):
-                    received = True  # sent to at least one recipient
+        for roomNum in dict.fromkeys(roomNumbList):  # no duplicates
+            oneRoom = self.getActiveRoom(roomNum)
+            if oneRoom and self.roomMsg(oneRoom, msg):
+                received = True  # sent to at least one recipient
         return received
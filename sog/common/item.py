@@ -2,7 +2,6 @@
     derived.
 """
 
-import glob
 import os
 import re
 
@@ -10,7 +9,7 @@ from common.attributes import AttributeHelper
 from common.editwizard import EditWizard
 from common.globals import DATADIR
 from common.inventory import Inventory
-from common.storage import Storage
+from common.storage import Storage, getBackend
 
 
 class Item(Storage, AttributeHelper, Inventory, EditWizard):
@@ -134,10 +133,9 @@ class Item(Storage, AttributeHelper, Inventory, EditWizard):
             extension = ".pickle"
 
         numberlist = []
-        if os.path.exists(dir):
-            filelist = glob.glob(dir + "/*" + extension)
-            for fqfn in filelist:
-                filenumber = re.sub("[^0-9]", "", os.path.basename(fqfn))
+        for filename in getBackend().listDir(os.path.abspath(dir)):
+            if filename.endswith(extension):
+                filenumber = re.sub("[^0-9]", "", filename)
                 if filenumber != "":
                     numberlist.append(int(filenumber))
         if len(numberlist) > 0:
@@ -0,0 +1,417 @@
+""" loadLib - load generation harness
+   * BotBrain - decides what a simulated player types, based on the output
+     it was given (login, account/character creation, lobby, and game)
+   * LoadStats - collects round-trip latency, throughput, and error counts
+   * SocketBot - a bot that connects to a running server (framed protocol)
+   * InProcessBot - a bot that runs inside this process against the game,
+     with no sockets, so that load runs can be part of CI
+   * runLoad - start a number of bots and wait for them to finish
+   * scratchData - keep what in-process bots save out of the real data dir
+"""
+
+import collections
+import contextlib
+import os
+import random
+import re
+import socket
+import tempfile
+import threading
+import time
+
+import account
+from common.doorState import doorStates
+import common.framing
+from common.general import logger
+import common.globals
+from common.storage import ScratchBackend, getBackend, setBackend
+import game
+from threads import NetworkClient
+
+# Game commands that bots choose from.  {target} is replaced with the first
+# thing the bot saw in the room, which may or may not be a creature.
+BOT_ACTIONS = [
+    "look", "n", "s", "e", "w", "u", "d", "look", "health", "inventory",
+    "attack {target}", "attack {target}", "catalog", "buy 0", "who"]
+
+BOT_PASSWORD = "loadBotPass1"
+
+_errorResponses = ["Invalid Command", "Unknown Command", "Error: "]
+_passwordPrompts = ["Enter Password: ", "Verify Password: ",
+                    "Enter Account Password: "]
+
+
+class LoadStats:
+    """ Thread-safe collection of the results of a load run """
+
+    def __init__(self, runId=""):
+        self.runId = runId
+        self._lock = threading.Lock()
+        self._latencies = []
+        self._errors = collections.Counter()
+        self._startTime = time.monotonic()
+        self._endTime = None
+        self.botsStarted = 0
+        self.botsFinished = 0
+
+    def record(self, seconds):
+        """ record the round trip time of one command """
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def error(self, kind):
+        with self._lock:
+            self._errors[kind] += 1
+
+    def botStarted(self):
+        with self._lock:
+            self.botsStarted += 1
+
+    def botFinished(self):
+        with self._lock:
+            self.botsFinished += 1
+
+    def stop(self):
+        self._endTime = time.monotonic()
+
+    def getCommandCount(self):
+        return len(self._latencies)
+
+    def getErrors(self):
+        with self._lock:
+            return dict(self._errors)
+
+    def getElapsed(self):
+        return (self._endTime or time.monotonic()) - self._startTime
+
+    def percentile(self, pct):
+        """ return the given percentile of the latencies, in seconds """
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return 0.0
+        index = min(len(latencies) - 1, int(round(pct / 100 * (len(latencies) - 1))))
+        return latencies[index]
+
+    def report(self):
+        """ return a human readable summary """
+        elapsed = self.getElapsed()
+        count = self.getCommandCount()
+        ROW_FORMAT = "  {0:16}: {1:<30}\n"
+        buf = "Load run results:\n"
+        buf += ROW_FORMAT.format(
+            "Bots", "{} started, {} finished".format(self.botsStarted,
+                                                     self.botsFinished))
+        buf += ROW_FORMAT.format("Commands", count)
+        buf += ROW_FORMAT.format("Elapsed", "{:.2f} s".format(elapsed))
+        buf += ROW_FORMAT.format(
+            "Throughput", "{:.1f} cmds/s".format(count / elapsed if elapsed else 0))
+        for pct in [50, 90, 95, 99, 100]:
+            label = "max" if pct == 100 else "p" + str(pct)
+            buf += ROW_FORMAT.format(
+                "Latency " + label, "{:.1f} ms".format(self.percentile(pct) * 1000))
+        errors = self.getErrors()
+        buf += ROW_FORMAT.format("Errors", sum(errors.values()))
+        for kind in sorted(errors):
+            buf += ROW_FORMAT.format("  " + kind, errors[kind])
+        return buf
+
+
+class BotBrain:
+    """ Decides what to type for a given prompt
+        * respond() returns the next input, or None when the bot is done
+        * a session is: log in (creating the account and character as
+          needed), enter the game, run <commands> game commands, exit the
+          game, and quit the lobby """
+
+    def __init__(self, botNum, runId, commands=20, actions=None, seed=None):
+        self.email = "loadbot{}-{}@example.com".format(runId, botNum)
+        self.displayName = "LoadBot{}x{}".format(runId, botNum)
+        self.charName = "Lb{}x{}".format(runId, botNum)
+        self._commands = commands
+        self._actions = actions or BOT_ACTIONS
+        self._rng = random.Random(seed)
+        self._commandsSent = 0
+        self._inGame = False
+        self._played = False
+        self._loggedIn = False
+        self._done = False
+        self._lastTarget = "rat"
+
+    def isDone(self):
+        return self._done
+
+    def respond(self, output):  # noqa: C901
+        prompt = output.rsplit("\n", 1)[-1]
+        self._noteTarget(output)
+
+        if self._done:
+            return None
+        if prompt.startswith("Enter email address"):
+            if self._loggedIn:  # back at the login after quitting
+                self._done = True
+                return None
+            return self.email
+        if prompt in _passwordPrompts:
+            return BOT_PASSWORD
+        if prompt.startswith("Create new account?"):
+            return "y"
+        if prompt == "Display Name: ":
+            return self.displayName
+        if prompt.startswith("Please enter your character's name"):
+            return self.charName
+        if prompt.startswith("Enter number or press [enter] to exit"):
+            # character selection - use our character if it exists
+            return "1" if "(1)" in output else "0"
+        if prompt.startswith("Select your character's"):
+            return "0"
+        if "Skills:\n" in output and prompt == "":
+            return "0"
+        if prompt.endswith("[y/N]: "):
+            return "y" if "Proceed?" in prompt else "n"
+        if prompt in ["[lobby] ", "] "]:
+            self._loggedIn = True
+            self._inGame = False
+            if self._played:
+                return "quit"
+            self._played = True
+            return "play"
+        if prompt in ["<game> ", "> "]:
+            self._inGame = True
+            if self._commandsSent >= self._commands:
+                return "exit"
+            self._commandsSent += 1
+            action = self._rng.choice(self._actions)
+            return action.format(target=self._lastTarget)
+        return ""  # unknown prompt - send an empty response
+
+    def _noteTarget(self, output):
+        match = re.search(r"You see (?:an? |the |some )?([A-Za-z]+)", output)
+        if match:
+            self._lastTarget = match.group(1).lower()
+
+    def isCommandError(self, output):
+        for errStr in _errorResponses:
+            if errStr in output:
+                return True
+        return False
+
+
+class InProcessBot(NetworkClient):
+    """ A simulated player that runs in this process, without a socket
+        * the game/lobby call _sendAndReceive, which asks the brain for the
+          next input instead of reading from the network
+        * latency is the time spent processing each input """
+
+    def __init__(self, brain, stats, id):
+        NetworkClient.__init__(self, ("inprocess", id), id)
+        self.socket = None
+        self.brain = brain
+        self.stats = stats
+        self._sentAt = None
+        self.identifier = "IB" + str(id) + str(self.address)
+
+    def __str__(self):
+        return self.identifier
+
+    def run(self):
+        """ a single session - login, lobby/game, logout """
+        self.stats.botStarted()
+        try:
+            self.welcome("Sog Server\n")
+            self.acctObj = account.Account(self)
+            if self.acctLogin():
+                self.lobbyObj.joinLobby(self)
+                if self.acctObj:
+                    self.acctObj.logout()
+                self.acctObj = None
+            elif not self.brain.isDone():
+                self.stats.error("login")
+        except Exception:
+            # a bug in the game - record it and keep the rest of the run going
+            logger.exception("{} loadLib bot died".format(self))
+            self.stats.error("exception")
+        finally:
+            try:
+                self.terminateClientConnection()
+            except Exception:
+                logger.exception("{} loadLib bot cleanup failed".format(self))
+                self.stats.error("exception")
+            self.stats.botFinished()
+
+    def _sendAndReceive(self):
+        """ Override ServerIo - the brain plays the part of the client """
+        output = self.popOutSpool()
+        if self._sentAt is not None:
+            self.stats.record(time.monotonic() - self._sentAt)
+            self._sentAt = None
+            if self.brain.isCommandError(output):
+                self.stats.error("command")
+        reply = self.brain.respond(output)
+        if reply is None or not self.isRunning():
+            self.terminateClientConnection()
+            return False
+        self.setInputStr(reply)
+        self._sentAt = time.monotonic()
+        return True
+
+    def terminateClientConnection(self):
+        if self._running:
+            self.removeConnectionFromList()
+            self._running = False
+            self.releaseGameObjs()
+        return None
+
+
+class SocketBot:
+    """ A simulated player that connects to a running server """
+
+    def __init__(self, brain, stats, host, port, timeout=30):
+        self.brain = brain
+        self.stats = stats
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._sock = None
+        self._decoder = common.framing.FrameDecoder()
+        self._msgs = collections.deque()
+
+    def run(self):
+        self.stats.botStarted()
+        try:
+            self._connect()
+            self._session()
+        except socket.timeout:
+            self.stats.error("timeout")
+        except (OSError, common.framing.FrameError) as e:
+            logger.warning("loadLib: {} {}".format(self.brain.email, e))
+            self.stats.error("connection")
+        except Exception:
+            logger.exception("loadLib: {} bot died".format(self.brain.email))
+            self.stats.error("exception")
+        finally:
+            self._close()
+            self.stats.botFinished()
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), self.timeout)
+        self._sock.sendall(common.framing.PREAMBLE)
+        data = b""
+        while len(data) < len(common.framing.PREAMBLE):
+            chunk = self._sock.recv(common.globals.BYTES_TO_TRANSFER)
+            if not chunk:
+                raise ConnectionError("closed during handshake")
+            data += chunk
+        if not common.framing.preambleStatus(data):
+            raise ConnectionError("server doesn't support framing")
+        self._msgs.extend(
+            self._decoder.feed(data[len(common.framing.PREAMBLE):]))
+
+    def _session(self):
+        sentAt = None
+        while True:
+            ftype, output = self._receive()
+            if ftype == common.framing.TERM:
+                if not self.brain.isDone():
+                    self.stats.error("disconnect")
+                return None
+            if sentAt is not None:
+                self.stats.record(time.monotonic() - sentAt)
+                if self.brain.isCommandError(output):
+                    self.stats.error("command")
+            reply = self.brain.respond(output)
+            if reply is None:
+                return None
+            self._sock.sendall(common.framing.encodeLegacy(
+                reply or common.globals.NOOP_STR))
+            sentAt = time.monotonic()
+
+    def _receive(self):
+        """ return the next non-push message from the server """
+        while True:
+            while not self._msgs:
+                data = self._sock.recv(common.globals.BYTES_TO_TRANSFER)
+                if not data:
+                    return (common.framing.TERM, "")
+                self._msgs.extend(self._decoder.feed(data))
+            msg = self._msgs.popleft()
+            if msg[0] != common.framing.PUSH:
+                return msg
+
+    def _close(self):
+        if not self._sock:
+            return None
+        try:
+            self._sock.sendall(common.framing.encodeFrame(common.framing.TERM))
+            self._sock.close()
+        except OSError:
+            pass
+        self._sock = None
+
+
+@contextlib.contextmanager
+def scratchData(scratchdir=None):
+    """ while in the block, everything that is saved under the data dir
+        goes to scratchdir instead (see common.storage.ScratchBackend)
+        * by default, scratchdir is a temp dir that is removed afterwards
+        * pending saves are written before the real backend is put back,
+          so none of them end up in the real data dir """
+    tmpDir = None
+    if not scratchdir:
+        tmpDir = tempfile.TemporaryDirectory(prefix="sogLoad")
+        scratchdir = tmpDir.name
+    previous = setBackend(ScratchBackend(scratchdir, getBackend()))
+    try:
+        yield scratchdir
+    finally:
+        game.Game().getPersister().stop()
+        doorStates.flush()
+        setBackend(previous)
+        doorStates.setDirectory(doorStates.dirname)  # reread the real table
+        if tmpDir:
+            tmpDir.cleanup()
+
+
+def runLoad(numBots, commands=20, host=None, port=None, inProcess=False,
+            rampSecs=0.0, runId=None, seed=None, timeout=30, datadir=None):
+    """ run the bots, each in its own thread, and return the LoadStats
+        * in-process bots save their accounts and characters (and anything
+          else) under datadir, or under a temp dir that is removed when
+          the run is done, instead of in the real data dir """
+    runId = runId or str(int(time.time()))
+    stats = LoadStats(runId)
+    botThreads = []
+    with scratchData(datadir) if inProcess else contextlib.nullcontext():
+        for num in range(numBots):
+            brain = BotBrain(num, runId, commands=commands,
+                             seed=None if seed is None else seed + num)
+            if inProcess:
+                bot = InProcessBot(brain, stats, common.globals.connections.nextId())
+                common.globals.connections.add(bot)
+            else:
+                bot = SocketBot(brain, stats, host or common.globals.HOST,
+                                int(port or common.globals.PORT), timeout)
+            botThread = threading.Thread(target=bot.run, daemon=True)
+            botThread.start()
+            botThreads.append(botThread)
+            if rampSecs:
+                time.sleep(rampSecs)
+        for botThread in botThreads:
+            botThread.join()
+    stats.stop()
+    return stats
+
+
+def cleanupAccounts(runId, datadir=None):
+    """ remove the accounts (and characters) created by a load run
+        * only useful when the server shares this machine's data dir.
+          In-process runs don't save to the real data dir (see runLoad) """
+    accountDir = os.path.abspath(
+        os.path.join(datadir or common.globals.DATADIR, "Account"))
+    prefix = "loadbot{}-".format(runId)
+    removed = 0
+    for name in getBackend().listDir(accountDir):
+        if name.startswith(prefix):
+            getBackend().removeTree(os.path.join(accountDir, name))
+            removed += 1
+    return removed
@@ -0,0 +1,290 @@
+""" metrics - timing instrumentation for the game's async tick
+
+   * RollingHistogram - bucketed durations over the last N samples
+   * TickMetrics - per tick and per phase timing, slow tick logging,
+     overrun counts, and async thread lag
+   * SaveCounts - storage saves that were written, or skipped because
+     nothing had changed, by class
+   * latencySummary - count, mean and percentiles of a list of timings
+"""
+
+import collections
+import contextlib
+import json
+import threading
+import time
+
+from common.general import logger
+import common.globals
+
+TICK_PHASES = ["deactivate", "encounter", "creaturesAttack", "timeouts", "regen"]
+
+
+class RollingHistogram:
+    """ Durations (in seconds) of the last <window> samples
+        * buckets are computed when a snapshot is taken, so add() is cheap
+        * count is the number of samples ever added """
+
+    BUCKETS_MS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000]
+
+    def __init__(self, window=600):
+        self._samples = collections.deque(maxlen=window)
+        self.count = 0
+
+    def add(self, secs):
+        self._samples.append(secs)
+        self.count += 1
+
+    def snapshot(self):
+        """ return a dict of the histogram - all times are in ms """
+        samples = sorted(self._samples)
+        buckets = collections.OrderedDict()
+        for limit in self.BUCKETS_MS:
+            buckets["<=" + str(limit)] = 0
+        buckets[">" + str(self.BUCKETS_MS[-1])] = 0
+        for secs in samples:
+            ms = secs * 1000
+            for limit in self.BUCKETS_MS:
+                if ms <= limit:
+                    buckets["<=" + str(limit)] += 1
+                    break
+            else:
+                buckets[">" + str(self.BUCKETS_MS[-1])] += 1
+        return {
+            "count": self.count,
+            "window": len(samples),
+            "p50": _percentileMs(samples, 50),
+            "p95": _percentileMs(samples, 95),
+            "p99": _percentileMs(samples, 99),
+            "max": _percentileMs(samples, 100),
+            "buckets": buckets,
+        }
+
+
+def _percentileMs(sortedSamples, pct):
+    if not sortedSamples:
+        return 0.0
+    index = min(len(sortedSamples) - 1,
+                int(round(pct / 100 * (len(sortedSamples) - 1))))
+    return round(sortedSamples[index] * 1000, 3)
+
+
+def latencySummary(secsList):
+    """ count, mean and percentiles, in ms, of a list of secs - used by the
+        storage benchmarks """
+    secsList = sorted(secsList)
+    if not secsList:
+        return {"count": 0, "mean": 0.0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+    return {"count": len(secsList),
+            "mean": round(sum(secsList) / len(secsList) * 1000, 3),
+            "p50": _percentileMs(secsList, 50),
+            "p95": _percentileMs(secsList, 95),
+            "max": _percentileMs(secsList, 100)}
+
+
+class _TickTimes:
+    """ the phase times of one tick - updated under TickMetrics._lock """
+
+    def __init__(self):
+        self.phases = collections.Counter()  # phase name -> secs
+        self.closed = False  # the tick has been recorded
+
+
+class TickMetrics:
+    """ Timing for the game's async tick
+        * wrap each tick in tick(), and the work inside of it in phase().
+          A phase can run many times in a tick (once per room, etc) - the
+          phase histograms hold the total time per tick
+        * ticks longer than slowSecs are logged with their phase breakdown
+        * ticks longer than budgetSecs are counted as overruns
+        * the async thread reports how late each tick started with
+          recordLag(), and ticks that it dropped with recordSkipped()
+        * phases are credited to the tick of the thread that runs them.
+          Work that is handed to another thread (i.e. a room actor) takes
+          currentTick() with it, and runs in forTick().  A phase that ends
+          after its tick has been recorded is recorded on its own """
+
+    def __init__(self, budgetSecs=None, slowSecs=None, window=None):
+        self.budgetSecs = budgetSecs or common.globals.TICK_BUDGET
+        self.slowSecs = slowSecs or common.globals.TICK_SLOW_THRESHOLD
+        self._window = window or common.globals.TICK_METRICS_WINDOW
+        self._lock = threading.Lock()
+        self._local = threading.local()  # .tick - this thread's _TickTimes
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._tickHist = RollingHistogram(self._window)
+            self._lagHist = RollingHistogram(self._window)
+            self._phaseHists = collections.OrderedDict()
+            for phaseName in TICK_PHASES:
+                self._phaseHists[phaseName] = RollingHistogram(self._window)
+            self.overruns = 0
+            self.slowTicks = 0
+            self.skippedTicks = 0
+            self.lastLag = 0.0
+            self._resetTime = time.time()
+
+    @contextlib.contextmanager
+    def tick(self):
+        with self.forTick(_TickTimes()) as tickTimes:
+            startTime = time.perf_counter()
+            try:
+                yield
+            finally:
+                duration = time.perf_counter() - startTime
+                with self._lock:
+                    tickTimes.closed = True
+                self._recordTick(duration, tickTimes.phases)
+
+    def currentTick(self):
+        """ the tick that the calling thread is in, or None """
+        return getattr(self._local, "tick", None)
+
+    @contextlib.contextmanager
+    def forTick(self, tickTimes):
+        """ credit the phases that run in the block to tickTimes, a tick
+            that was taken from currentTick() on another thread """
+        previous = self.currentTick()
+        self._local.tick = tickTimes
+        try:
+            yield tickTimes
+        finally:
+            self._local.tick = previous
+
+    @contextlib.contextmanager
+    def phase(self, phaseName):
+        startTime = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - startTime
+            tickTimes = self.currentTick()
+            with self._lock:
+                if tickTimes is not None and not tickTimes.closed:
+                    tickTimes.phases[phaseName] += duration
+                else:  # phase ran outside of its tick - record it on its own
+                    self._getPhaseHist(phaseName).add(duration)
+
+    def recordLag(self, lagSecs):
+        """ record how far behind schedule a tick started """
+        with self._lock:
+            self.lastLag = lagSecs
+            self._lagHist.add(lagSecs)
+
+    def recordSkipped(self, count):
+        """ record ticks that were dropped because we fell behind """
+        with self._lock:
+            self.skippedTicks += count
+
+    def _getPhaseHist(self, phaseName):
+        if phaseName not in self._phaseHists:
+            self._phaseHists[phaseName] = RollingHistogram(self._window)
+        return self._phaseHists[phaseName]
+
+    def _recordTick(self, duration, phaseTimes):
+        with self._lock:
+            self._tickHist.add(duration)
+            for phaseName in self._phaseHists:
+                self._phaseHists[phaseName].add(phaseTimes.get(phaseName, 0.0))
+            for phaseName in phaseTimes:
+                if phaseName not in self._phaseHists:
+                    self._getPhaseHist(phaseName).add(phaseTimes[phaseName])
+            if duration > self.budgetSecs:
+                self.overruns += 1
+            if duration > self.slowSecs:
+                self.slowTicks += 1
+        if duration > self.slowSecs:
+            logger.warning("Slow tick: {:.1f} ms ({})".format(
+                duration * 1000, ", ".join(
+                    ["{} {:.1f} ms".format(name, secs * 1000)
+                     for name, secs in phaseTimes.most_common()])))
+
+    def snapshot(self):
+        """ return all of the metrics as a dict - times are in ms """
+        with self._lock:
+            return {
+                "since": self._resetTime,
+                "budgetMs": self.budgetSecs * 1000,
+                "slowMs": self.slowSecs * 1000,
+                "ticks": self._tickHist.count,
+                "overruns": self.overruns,
+                "slowTicks": self.slowTicks,
+                "skippedTicks": self.skippedTicks,
+                "lastLagMs": round(self.lastLag * 1000, 3),
+                "tick": self._tickHist.snapshot(),
+                "lag": self._lagHist.snapshot(),
+                "phases": collections.OrderedDict(
+                    [(name, hist.snapshot())
+                     for name, hist in self._phaseHists.items()]),
+            }
+
+    def toJson(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def dump(self, filename):
+        """ write the metrics, as json, to a file """
+        with open(filename, "w") as filehandle:
+            filehandle.write(self.toJson() + "\n")
+        return filename
+
+    def report(self):
+        """ return a human readable summary """
+        data = self.snapshot()
+        ROW_FORMAT = "  {0:16}: {1:>8} {2:>8} {3:>8} {4:>8}\n"
+        buf = "Tick metrics - {} ticks, {} overruns (> {:.0f} ms), ".format(
+            data["ticks"], data["overruns"], data["budgetMs"])
+        buf += "{} slow (> {:.0f} ms), {} skipped, last lag {:.1f} ms\n".format(
+            data["slowTicks"], data["slowMs"], data["skippedTicks"],
+            data["lastLagMs"])
+        buf += ROW_FORMAT.format("ms", "p50", "p95", "p99", "max")
+        rows = [("tick", data["tick"]), ("lag", data["lag"])]
+        rows += list(data["phases"].items())
+        for name, hist in rows:
+            buf += ROW_FORMAT.format(
+                name, hist["p50"], hist["p95"], hist["p99"], hist["max"])
+        return buf
+
+
+class SaveCounts:
+    """ Counts of Storage.save calls, by class name
+        * written - the object was serialized and written to disk
+        * skipped - the object was unchanged since it was last loaded or
+          saved, so there was nothing to write """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counts = collections.defaultdict(collections.Counter)
+            self._resetTime = time.time()
+
+    def record(self, className, written):
+        with self._lock:
+            self._counts[className]["written" if written else "skipped"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "since": self._resetTime,
+                "classes": collections.OrderedDict(
+                    [(name, {"written": counts["written"],
+                             "skipped": counts["skipped"]})
+                     for name, counts in sorted(self._counts.items())]),
+            }
+
+    def report(self):
+        """ return a human readable summary """
+        data = self.snapshot()
+        ROW_FORMAT = "  {0:16}: {1:>8} {2:>8}\n"
+        buf = "Saves since {}\n".format(
+            time.strftime("%Y/%m/%d %H:%M:%S", time.localtime(data["since"])))
+        buf += ROW_FORMAT.format("class", "written", "skipped")
+        for name, counts in data["classes"].items():
+            buf += ROW_FORMAT.format(name, counts["written"], counts["skipped"])
+        return buf
+
+
+saveCounts = SaveCounts()  # shared by all Storage objects
@@ -0,0 +1,278 @@
+""" persister - write-behind saves
+
+   * WriteBehind - objects are marked dirty as they change, and a
+     background I/O thread saves them.  Saves are coalesced, so an object
+     that changes many times in a few seconds is written once, and an
+     object is never left unsaved for longer than maxStaleness seconds.
+"""
+
+import contextlib
+import itertools
+import threading
+import time
+import weakref
+
+from common.general import logger
+import common.globals
+from common.storage import groupCommit, onCommitFailure
+
+FREEZE_RETRIES = 3
+
+
+class WriteBehind:
+    """ Coalesces saves of Storage objects (characters, etc) onto an I/O thread
+        * markDirty(obj) - obj has changed and should be saved soon.  This
+          only notes that obj is dirty, so it's cheap enough to call after
+          every change.  obj is serialized (see Storage.freeze) once, when
+          its coalesced save is due, on the I/O thread
+        * changing() - a block (i.e. a command) that changes objects which
+          other threads change too.  The objects marked dirty in the block
+          are serialized once, when it exits, on the thread that changed
+          them, and that copy is what the I/O thread writes
+        * flush(obj) - save obj now, on this thread.  Used when we can't
+          risk losing the change (i.e. money transactions and leaving the
+          game)
+        * discard(obj) - forget a pending save (i.e. the obj was deleted)
+        * stop() - save everything that is dirty, and stop the I/O thread
+        * each copy is numbered when it's taken, and a copy is never written
+          after a newer copy of the same obj, whichever thread writes it
+        * with a maxStaleness of 0, markDirty saves right away """
+
+    def __init__(self, maxStaleness=None, clock=time.monotonic):
+        if maxStaleness is None:
+            maxStaleness = common.globals.SAVE_MAX_STALENESS
+        self.maxStaleness = maxStaleness
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._dirty = {}  # obj -> time first marked dirty
+        self._copies = {}  # obj -> (seq, copy) taken by a changing() block
+        self._local = threading.local()  # objs marked in this thread's block
+        self._seq = itertools.count()
+        self._written = weakref.WeakKeyDictionary()  # obj -> seq last written
+        self._saveLock = threading.RLock()  # one save, or batch, at a time
+        self._thread = None
+        self._stopping = False
+        self.marks = 0
+        self.saves = 0
+        self.failures = 0
+
+    def markDirty(self, obj):
+        if self.maxStaleness <= 0:
+            with self._cond:
+                self.marks += 1
+            self.flush(obj)
+            return None
+        changed = getattr(self._local, "changed", None)
+        if changed is not None:  # copied when the changing() block exits
+            with self._cond:
+                self.marks += 1
+            changed.setdefault(obj, None)
+            return None
+        with self._cond:
+            self.marks += 1
+            self._copies.pop(obj, None)  # stale - it's copied when it's due
+            if obj in self._dirty:
+                return None  # coalesced into the pending save
+            self._dirty[obj] = self._clock()
+            self._startThread()
+            self._cond.notify()
+        return None
+
+    @contextlib.contextmanager
+    def changing(self):
+        """ serialize the objects marked dirty in the block once, when it
+            exits, on this thread - other threads (i.e. the I/O thread) never
+            see them half changed.  Nested blocks are part of the outer one """
+        if getattr(self._local, "changed", None) is not None:
+            yield
+            return
+        self._local.changed = {}  # dict, to keep the order they were marked
+        try:
+            yield
+        finally:
+            changed, self._local.changed = self._local.changed, None
+            for obj in changed:
+                self._takeCopy(obj)
+
+    def _takeCopy(self, obj):
+        frozen = self._freeze(obj)
+        if frozen is None:
+            return None
+        with self._cond:
+            self._copies[obj] = frozen
+            if obj not in self._dirty:
+                self._dirty[obj] = self._clock()
+                self._startThread()
+                self._cond.notify()
+        return None
+
+    def isDirty(self, obj):
+        with self._cond:
+            return obj in self._dirty
+
+    def getDirtyCount(self):
+        with self._cond:
+            return len(self._dirty)
+
+    def flush(self, obj):
+        """ save obj now, whether or not it is dirty, and drop its pending
+            save - returns False if the save failed """
+        with self._cond:
+            self._dirty.pop(obj, None)
+            self._copies.pop(obj, None)  # older than the copy taken here
+        self._forgetChange(obj)
+        frozen = self._freeze(obj)
+        if frozen is None:
+            return False
+        return self._write(obj, frozen)
+
+    def discard(self, obj):
+        with self._cond:
+            self._dirty.pop(obj, None)
+            self._copies.pop(obj, None)
+        self._forgetChange(obj)
+
+    def _forgetChange(self, obj):
+        """ obj no longer needs a copy when this thread's block exits """
+        changed = getattr(self._local, "changed", None)
+        if changed:
+            changed.pop(obj, None)
+
+    def flushAll(self):
+        """ save every dirty object now - returns the number saved """
+        with self._cond:
+            objs = list(self._dirty)
+            self._dirty.clear()
+        return self._saveBatch(objs)
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        saved = self.flushAll()
+        with self._cond:
+            self._stopping = False
+        return saved
+
+    def _startThread(self):
+        """ start the I/O thread if it isn't running - caller holds _cond """
+        if self._thread is None and not self._stopping:
+            self._thread = threading.Thread(
+                target=self._ioLoop, name="writeBehind", daemon=True)
+            self._thread.start()
+
+    def _ioLoop(self):
+        while True:
+            with self._cond:
+                due = self._waitForDue()
+                if due is None:
+                    return None
+            self._saveBatch(due)
+
+    def _waitForDue(self):
+        """ wait until the oldest dirty object is due, then return a list of
+            the due objects.  Returns None when stopping - caller holds
+            _cond """
+        while not self._stopping:
+            if not self._dirty:
+                self._cond.wait()
+                continue
+            oldest = next(iter(self._dirty.values()))  # dicts keep insert order
+            secsLeft = oldest + self.maxStaleness - self._clock()
+            if secsLeft > 0:
+                self._cond.wait(secsLeft)
+                continue
+            now = self._clock()
+            due = [obj for obj, since in self._dirty.items()
+                   if since + self.maxStaleness <= now]
+            for obj in due:
+                del self._dirty[obj]
+            return due
+        return None
+
+    def _saveBatch(self, objs):
+        """ serialize and write objs with one fsync cycle (see
+            common.storage.groupCommit) - an obj that is marked dirty again
+            while it's being saved is queued for another save """
+        with self._saveLock:
+            saved = 0
+            try:
+                with groupCommit():
+                    for obj in objs:
+                        with self._cond:
+                            frozen = self._copies.pop(obj, None)
+                        if frozen is None:
+                            frozen = self._freeze(obj)
+                        if frozen is not None and self._write(obj, frozen):
+                            saved += 1
+            except Exception:  # the saves are marked dirty again by _write
+                logger.exception("WriteBehind: could not commit the saves")
+                return 0
+            return saved
+
+    def _freeze(self, obj):
+        """ returns (seq, serialized obj), or None if obj can't be saved
+            * other threads can change obj while it's being serialized
+              (i.e. the async thread applying poison damage), which can
+              make the serializer raise, so it's tried again """
+        for attempt in range(FREEZE_RETRIES):
+            seq = next(self._seq)
+            try:
+                frozen = obj.freeze()
+            except RuntimeError:  # i.e. dictionary changed size during iteration
+                continue
+            except Exception:
+                logger.exception("WriteBehind: could not serialize {}".format(obj))
+                break
+            if frozen is not None:
+                return (seq, frozen)
+            break  # i.e. obj isn't valid - it won't do any better next time
+        else:
+            logger.error("WriteBehind: {} kept changing while it was saved".format(obj))
+        with self._cond:
+            self.failures += 1
+        return None
+
+    def _write(self, obj, frozen):
+        """ write a copy of obj - if the write raises (i.e. an I/O error),
+            or its group commit fails, obj is marked dirty again, so that
+            it's retried later """
+        retry = False
+        with self._saveLock:
+            if self._written.get(obj, -1) > frozen[0]:
+                return True  # a newer copy has already been written
+            try:
+                saved = obj.writeFrozen(frozen[1]) is not False
+            except Exception:
+                logger.exception("WriteBehind: could not save {}".format(obj))
+                saved = False
+                retry = True
+            if saved:
+                self._written[obj] = frozen[0]
+                onCommitFailure(lambda: self._commitFailed(obj, frozen))
+        with self._cond:
+            if saved:
+                self.saves += 1
+            else:
+                self.failures += 1
+            if retry:
+                self._retry(obj, frozen)
+        return saved
+
+    def _commitFailed(self, obj, frozen):
+        """ obj's save was written, but its group commit failed """
+        with self._cond:
+            self.saves -= 1
+            self.failures += 1
+            self._retry(obj, frozen)
+
+    def _retry(self, obj, frozen):
+        """ save the copy again later, unless obj was marked dirty since it
+            was taken - caller holds _cond """
+        if obj not in self._dirty:
+            self._copies[obj] = frozen
+            self._dirty[obj] = self._clock()
+        self._startThread()
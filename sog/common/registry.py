@@ -0,0 +1,361 @@
+""" registry - thread-safe lookup tables for shared runtime objects
+
+   * ConnectionRegistry - network clients, keyed by connection id, with
+     secondary indexes by account email and character name
+   * RoomRegistry - the game's active rooms, keyed by room number
+   * WarmRoomCache - rooms that were recently emptied, so that they can be
+     reactivated without loading them again
+   * SessionRegistry - players in the game (characters) or in the lobby
+     (accounts), with indexes by id, name, name prefix, and account email
+"""
+
+import collections
+import itertools
+import threading
+import time
+
+
+class ConnectionRegistry:
+    """ All of the clients connected to the server
+        * ids come from nextId, which never hands out the same id twice
+        * lookup/removal by id, account, or character is a dict access
+        * iterating over the registry iterates over a snapshot, so clients
+          can connect/disconnect while we are looping (i.e. broadcast) """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._idCounter = itertools.count()
+        self._clients = {}  # id -> client
+        self._byAccount = {}  # email -> {id: client}
+        self._byCharacter = {}  # lowercase character name -> client
+        self._accountOf = {}  # id -> email
+        self._characterOf = {}  # id -> lowercase character name
+
+    def nextId(self):
+        """ Return a new, unique, connection id """
+        with self._lock:
+            return next(self._idCounter)
+
+    def add(self, client):
+        with self._lock:
+            self._clients[client.getId()] = client
+
+    def remove(self, client):
+        """ Remove the client and its index entries - True if it was there """
+        with self._lock:
+            id = client.getId()
+            if self._clients.get(id) is not client:
+                return False
+            self.setAccount(client, None)
+            self.setCharacter(client, None)
+            del self._clients[id]
+        return True
+
+    def get(self, id, default=None):
+        with self._lock:
+            return self._clients.get(id, default)
+
+    def setAccount(self, client, email):
+        """ Index the client by account email (None to clear) """
+        with self._lock:
+            id = client.getId()
+            if self._clients.get(id) is not client:
+                return False
+            oldEmail = self._accountOf.pop(id, None)
+            if oldEmail is not None:
+                clients = self._byAccount[oldEmail]
+                del clients[id]
+                if not clients:
+                    del self._byAccount[oldEmail]
+            if email:
+                self._accountOf[id] = email
+                self._byAccount.setdefault(email, {})[id] = client
+        return True
+
+    def setCharacter(self, client, name):
+        """ Index the client by character name (None to clear) """
+        with self._lock:
+            id = client.getId()
+            if self._clients.get(id) is not client:
+                return False
+            oldName = self._characterOf.pop(id, None)
+            if oldName is not None and self._byCharacter.get(oldName) is client:
+                del self._byCharacter[oldName]
+            if name:
+                self._characterOf[id] = name.lower()
+                self._byCharacter[name.lower()] = client
+        return True
+
+    def getByAccount(self, email):
+        """ Return the list of clients logged in to the given account """
+        with self._lock:
+            return list(self._byAccount.get(email, {}).values())
+
+    def getByCharacter(self, name):
+        """ Return the client playing the named character, or None """
+        with self._lock:
+            return self._byCharacter.get(str(name).lower())
+
+    def list(self):
+        """ Return a snapshot list of the clients """
+        with self._lock:
+            return list(self._clients.values())
+
+    def __iter__(self):
+        return iter(self.list())
+
+    def __len__(self):
+        return len(self._clients)
+
+    def __contains__(self, client):
+        with self._lock:
+            return self._clients.get(client.getId()) is client
+
+
+class RoomRegistry:
+    """ The rooms that are active in the game
+        * keyed by room number, so lookups are a dict access.  There is only
+          one active room per number - adding a different room object with
+          the same number replaces the old one
+        * rooms are kept in the order that they became active
+        * iterating over the registry iterates over a snapshot, so client
+          threads can activate/deactivate rooms while we are looping """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._rooms = {}  # room number -> roomObj
+
+    def add(self, roomObj):
+        """ Add the room - returns the room that was active with the same
+            number before (roomObj itself, if it was already active), or
+            None """
+        with self._lock:
+            previous = self._rooms.get(roomObj.getId())
+            if previous is not roomObj:
+                self._rooms.pop(roomObj.getId(), None)  # re-add at the end
+                self._rooms[roomObj.getId()] = roomObj
+            return previous
+
+    def remove(self, roomObj):
+        """ Remove the room - True if it was active """
+        with self._lock:
+            if self._rooms.get(roomObj.getId()) is not roomObj:
+                return False
+            del self._rooms[roomObj.getId()]
+        return True
+
+    def get(self, roomNum, default=None):
+        with self._lock:
+            return self._rooms.get(roomNum, default)
+
+    def list(self):
+        """ Return a snapshot list of the rooms, in the order they became
+            active """
+        with self._lock:
+            return list(self._rooms.values())
+
+    def __iter__(self):
+        return iter(self.list())
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def __contains__(self, roomObj):
+        with self._lock:
+            return self._rooms.get(roomObj.getId()) is roomObj
+
+
+class WarmRoomCache:
+    """ Rooms that were emptied (and saved) recently, keyed by room number
+        * take() hands a room back, and removes it from the cache, so a
+          room is only ever warm or active, never both
+        * rooms are dropped after gracePeriod secs, and least recently
+          emptied first when there are more than maxRooms, or when their
+          total size (the size of their saved data) is over maxBytes
+        * a maxRooms of 0 turns the cache off """
+
+    def __init__(self, maxRooms, gracePeriod, maxBytes, clock=time.monotonic):
+        self.maxRooms = maxRooms
+        self.gracePeriod = gracePeriod
+        self.maxBytes = maxBytes
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._rooms = collections.OrderedDict()  # num -> (roomObj, size, time)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def put(self, roomObj, size):
+        """ keep an emptied room - False if it's too big to keep """
+        with self._lock:
+            self._remove(roomObj.getId())
+            if self.maxRooms <= 0 or size > self.maxBytes:
+                return False
+            self._rooms[roomObj.getId()] = (roomObj, size, self._clock())
+            self._bytes += size
+            self._expire()
+            while len(self._rooms) > self.maxRooms or self._bytes > self.maxBytes:
+                self._remove(next(iter(self._rooms)))
+                self.evictions += 1
+        return True
+
+    def take(self, roomNum):
+        """ remove and return the warm room, or None """
+        with self._lock:
+            self._expire()
+            entry = self._rooms.get(roomNum)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._remove(roomNum)
+            self.hits += 1
+        return entry[0]
+
+    def discard(self, roomNum):
+        with self._lock:
+            return self._remove(roomNum)
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+            self._bytes = 0
+
+    def _remove(self, roomNum):
+        entry = self._rooms.pop(roomNum, None)
+        if entry is None:
+            return False
+        self._bytes -= entry[1]
+        return True
+
+    def _expire(self):
+        """ drop the rooms that were emptied more than gracePeriod ago """
+        cutoff = self._clock() - self.gracePeriod
+        while self._rooms:
+            roomNum, entry = next(iter(self._rooms.items()))
+            if entry[2] > cutoff:
+                break
+            self._remove(roomNum)
+            self.expired += 1
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "rooms": len(self._rooms),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "evictions": self.evictions,
+            }
+
+
+class SessionRegistry:
+    """ The players in the game or the lobby
+        * members are character or account objects.  Membership is by
+          identity, so two instances of the same character are different
+          members
+        * indexed by getId(), by lowercase getName() and every prefix of it,
+          and by account email (accountOf(member)).  Indexes are built when
+          a member is added - re-add a member after it's renamed
+        * lookups that can match more than one member return the one that
+          joined first
+        * iterating over the registry iterates over a snapshot """
+
+    def __init__(self, accountOf):
+        self._lock = threading.RLock()
+        self._accountOf = accountOf  # function that returns a member's email
+        self._members = {}  # id(member) -> member, in the order they joined
+        self._keysOf = {}  # id(member) -> (id, name, email) that we indexed
+        self._byId = {}  # member id -> {id(member): member}
+        self._byName = {}  # lowercase name -> {id(member): member}
+        self._byPrefix = {}  # lowercase name prefix -> {id(member): member}
+        self._byAccount = {}  # email -> {id(member): member}
+
+    def add(self, member):
+        """ Add the member - False if it was already there """
+        with self._lock:
+            if id(member) in self._members:
+                return False
+            keys = (member.getId(), str(member.getName()).lower(),
+                    self._accountOf(member))
+            self._members[id(member)] = member
+            self._keysOf[id(member)] = keys
+            _addToIndex(self._byId, keys[0], member)
+            _addToIndex(self._byName, keys[1], member)
+            for num in range(1, len(keys[1]) + 1):
+                _addToIndex(self._byPrefix, keys[1][:num], member)
+            _addToIndex(self._byAccount, keys[2], member)
+        return True
+
+    def remove(self, member):
+        """ Remove the member - True if it was there """
+        with self._lock:
+            if id(member) not in self._members:
+                return False
+            del self._members[id(member)]
+            keys = self._keysOf.pop(id(member))
+            _removeFromIndex(self._byId, keys[0], member)
+            _removeFromIndex(self._byName, keys[1], member)
+            for num in range(1, len(keys[1]) + 1):
+                _removeFromIndex(self._byPrefix, keys[1][:num], member)
+            _removeFromIndex(self._byAccount, keys[2], member)
+        return True
+
+    def get(self, memberId):
+        """ Return the member with the given id (i.e. email/charName) """
+        with self._lock:
+            return _firstInIndex(self._byId, memberId)
+
+    def getByName(self, name):
+        """ Return the member with the given name, ignoring case """
+        with self._lock:
+            return _firstInIndex(self._byName, str(name).lower())
+
+    def findByName(self, prefix):
+        """ Return the first member whose name starts with prefix """
+        with self._lock:
+            return _firstInIndex(self._byPrefix, str(prefix).lower())
+
+    def getByAccount(self, email):
+        """ Return the list of members that belong to the account """
+        with self._lock:
+            return list(self._byAccount.get(email, {}).values())
+
+    def list(self):
+        """ Return a snapshot list of the members, in the order they joined """
+        with self._lock:
+            return list(self._members.values())
+
+    def __iter__(self):
+        return iter(self.list())
+
+    def __len__(self):
+        return len(self._members)
+
+    def __contains__(self, member):
+        return id(member) in self._members
+
+
+def _addToIndex(index, key, member):
+    index.setdefault(key, {})[id(member)] = member
+
+
+def _removeFromIndex(index, key, member):
+    members = index.get(key)
+    if members is None:
+        return None
+    members.pop(id(member), None)
+    if not members:
+        del index[key]
+
+
+def _firstInIndex(index, key):
+    members = index.get(key)
+    if not members:
+        return None
+    return next(iter(members.values()))
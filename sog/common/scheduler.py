@@ -0,0 +1,142 @@
+""" scheduler - deadline driven task scheduling
+
+   * Scheduler - a heap of keyed tasks, each with a due time.  The game's
+     async thread calls runDue() once per tick, which only touches the
+     tasks that are due, no matter how many tasks are waiting.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+from common.general import logger
+
+RETRY_SECS = 1  # when a task raises, try it again after this many seconds
+HOLD = object()  # returned by a callback to keep its key (see Scheduler)
+
+
+class Scheduler:
+    """ Runs callbacks when they are due
+        * each task has a key (i.e. ("vitals", charObj)).  Scheduling a key
+          that is already scheduled replaces the existing task, unless
+          replace=False, in which case the existing task is left alone
+        * a callback returns the number of seconds until it should run
+          again, or None to drop the task
+        * a callback that returns HOLD isn't run again, but its key stays
+          scheduled (i.e. while the work was handed off to another thread),
+          so replace=False doesn't add a second task for it.  The key is
+          freed by scheduling it again, cancel, or release
+        * cancelled/replaced tasks are left in the heap and skipped when
+          they come up, so cancel is a dict access
+        * thread-safe - tasks can be scheduled and cancelled from client
+          threads while runDue is running in the async thread """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._lock = threading.RLock()
+        self._heap = []  # [due, seq, key, callback]
+        self._tasks = {}  # key -> current entry for the key
+        self._held = set()  # keys whose callback returned HOLD
+        self._seq = itertools.count()  # tie breaker - keeps the heap stable
+
+    def __len__(self):
+        with self._lock:
+            return len(self._tasks)
+
+    def __contains__(self, key):
+        return self.isScheduled(key)
+
+    def schedule(self, key, delay, callback, replace=True):
+        """ Run callback() <delay> seconds from now
+            * returns False if replace is False and the key is scheduled """
+        with self._lock:
+            if not replace and key in self._tasks:
+                return False
+            entry = [self._clock() + max(0, delay), next(self._seq), key, callback]
+            self._tasks[key] = entry
+            self._held.discard(key)
+            heapq.heappush(self._heap, entry)
+            self._compact()
+        return True
+
+    def cancel(self, key):
+        """ Drop the task for the given key - True if there was one """
+        with self._lock:
+            self._held.discard(key)
+            return self._tasks.pop(key, None) is not None
+
+    def release(self, key):
+        """ Drop a key that is held (see HOLD) - a key that was scheduled
+            again since is left alone.  True if the key was held """
+        with self._lock:
+            if key not in self._held:
+                return False
+            self._held.discard(key)
+            del self._tasks[key]
+        return True
+
+    def isScheduled(self, key):
+        with self._lock:
+            return key in self._tasks
+
+    def secsUntilDue(self, key):
+        """ Return the seconds until the key is due, or None """
+        with self._lock:
+            entry = self._tasks.get(key)
+            if not entry:
+                return None
+            return max(0, entry[0] - self._clock())
+
+    def nextDue(self):
+        """ Return the seconds until the next task is due, or None """
+        with self._lock:
+            self._discardStale()
+            if not self._heap:
+                return None
+            return max(0, self._heap[0][0] - self._clock())
+
+    def runDue(self):
+        """ Run every task that is due - returns the number of tasks run
+            * callbacks run without the lock held, so they can schedule or
+              cancel tasks (including their own) """
+        ran = 0
+        now = self._clock()
+        while True:
+            with self._lock:
+                self._discardStale()
+                if not self._heap or self._heap[0][0] > now:
+                    return ran
+                entry = heapq.heappop(self._heap)
+            delay = self._runTask(entry)
+            ran += 1
+            with self._lock:
+                if self._tasks.get(entry[2]) is not entry:
+                    continue  # cancelled or replaced while it was running
+                if delay is None:
+                    del self._tasks[entry[2]]
+                    continue
+                if delay is HOLD:
+                    self._held.add(entry[2])
+                    continue
+                entry[0] = self._clock() + max(0, delay)
+                entry[1] = next(self._seq)
+                heapq.heappush(self._heap, entry)
+
+    def _runTask(self, entry):
+        try:
+            return entry[3]()
+        except Exception:
+            logger.exception("Scheduler: task {} failed".format(entry[2]))
+            return RETRY_SECS
+
+    def _discardStale(self):
+        """ pop cancelled/replaced entries off of the top of the heap """
+        while self._heap and self._tasks.get(self._heap[0][2]) is not self._heap[0]:
+            heapq.heappop(self._heap)
+
+    def _compact(self):
+        """ rebuild the heap when it is mostly cancelled/replaced entries """
+        if len(self._heap) > 2 * len(self._tasks) + 64:
+            self._heap = [e for e in self._heap if self._tasks.get(e[2]) is e]
+            heapq.heapify(self._heap)
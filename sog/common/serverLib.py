@@ -5,21 +5,87 @@
    * Threads are instanciated from threads.ClientThread
 """
 
-# import selectors
 import os
+import selectors
 import socket
 import sys
+import threading
 import time
 
 import common.globals
 import common.serverLib
+from common.doorState import doorStates
 from common.general import Terminator, logger
+from common.storage import fsyncQueue
 from threads import ClientThread, AsyncThread
 import game
 
 
+class _ThreadedServer:
+    """ Holds the state of the running (thread per connection) server
+        * a selector waits for incoming connections, so we accept them as
+          fast as they come in, up to the listen backlog
+        * the async thread is checked when the selector times out, or
+          after a burst of connections, instead of on every accept """
+
+    def __init__(self):
+        self.asyncThread = None
+        self.stopEvent = threading.Event()
+        self.port = None
+        self.ready = threading.Event()  # set once we are accepting connections
+        self._nextThreadCheck = 0
+
+    def main(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as serverHandle:
+            serverHandle.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            serverHandle.bind((common.globals.HOST, common.globals.PORT))
+            serverHandle.listen(common.globals.LISTEN_BACKLOG)
+            serverHandle.setblocking(False)
+            self.port = serverHandle.getsockname()[1]
+
+            with selectors.DefaultSelector() as selector:
+                selector.register(serverHandle, selectors.EVENT_READ)
+                self.superviseAsyncThread()
+                self.ready.set()
+                while not self.stopEvent.is_set():
+                    self.superviseAsyncThread()
+                    if selector.select(timeout=common.globals.THREAD_CHECK_INTERVAL):
+                        self.acceptConnections(serverHandle)
+
+    def stop(self):
+        """ Stop the accept loop - can be called from any thread """
+        self.stopEvent.set()
+
+    def acceptConnections(self, serverHandle):
+        """ Accept every connection that is waiting """
+        while True:
+            try:
+                clientsock, clientAddress = serverHandle.accept()
+            except (BlockingIOError, InterruptedError):
+                return None  # nothing left to accept
+            except OSError as e:
+                logger.warning("SVR socket accept() failed - {}".format(e))
+                return None
+            clientsock.setblocking(True)
+
+            newthread = ClientThread(
+                clientsock, clientAddress, common.globals.connections.nextId()
+            )
+            common.globals.connections.add(newthread)
+            newthread.start()
+
+    def superviseAsyncThread(self):
+        """ Restart the game's async thread if it has died """
+        if time.monotonic() < self._nextThreadCheck:
+            return None
+        self._nextThreadCheck = time.monotonic() + common.globals.THREAD_CHECK_INTERVAL
+        if not threadIsRunning(self.asyncThread):
+            self.asyncThread = createAndStartAsyncThread()
+        return None
+
+
 def server(email=""):
-    asyncThread = None
+    svr = _ThreadedServer()
     logger.info("-------------------------------------------------------")
     logger.info("SVR Server Start {} (pid:{})".format(
         sys.argv[0], os.getpid()))
@@ -27,42 +93,13 @@ def server(email=""):
                                                 common.globals.PORT))
 
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as serverHandle:
-
-            serverHandle.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            serverHandle.bind((common.globals.HOST, common.globals.PORT))
-
-            while True:
-
-                if not threadIsRunning(asyncThread):
-                    asyncThread = createAndStartAsyncThread()
-
-                serverHandle.listen(1)
-                serverHandle.settimeout(60)
-
-                try:
-                    clientsock, clientAddress = serverHandle.accept()
-
-                    newthread = ClientThread(
-                        clientsock, clientAddress, common.globals.totalConnections
-                    )
-                    common.globals.connections.append(newthread)
-                    common.globals.totalConnections += 1
-                    common.globals.connections[newthread.getId()].start()
-                except OSError:
-                    # This occurs when the socket accept times out, which, since
-                    # we are listening for new connections, is about
-                    # every second or so.  Will leave this here for debugging
-                    if False:
-                        logger.warning("SVR socket accept() failed - timeout?")
-
-                time.sleep(1)
-
-            exitProg()
+        svr.main()
+        exitProg()
 
     except Terminator:
-        haltAsyncThread(game.Game(), asyncThread)
+        haltAsyncThread(game.Game(), svr.asyncThread)
         haltClientThreads()
+        haltPersister(game.Game())
         exitProg()
 
 
@@ -74,12 +111,21 @@ def haltAsyncThread(gameObj, asyncThread):
 
 
 def haltClientThreads():
-    for num, client in enumerate(common.globals.connections):
-        logger.info("SVR Halting ClientThread " + str(num))
+    for client in common.globals.connections:
+        logger.info("SVR Halting ClientThread " + str(client.getId()))
         client.terminateClientConnection()
         client.join()
 
 
+def haltPersister(gameObj):
+    """ save everything that is waiting to be written, and fsync it """
+    logger.info("SVR Flushing {} pending saves".format(
+        gameObj.getPersister().getDirtyCount()))
+    gameObj.getPersister().stop()
+    doorStates.flush()
+    fsyncQueue.sync()
+
+
 def createAndStartAsyncThread():
     asyncThread = AsyncThread()
     if asyncThread:
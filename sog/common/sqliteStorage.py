@@ -0,0 +1,313 @@
+""" sqliteStorage - keep Storage objects in one SQLite database
+
+   * SqliteBackend - a storage backend (see common.storage.FileBackend) that
+     keeps each object as a row, keyed by its class directory and id,
+     instead of as a file under DATADIR.  Paths that aren't under the data
+     dir are passed through to a fallback backend
+   * migrate - one-shot copy of the data files into a backend
+   * benchmark - compare load and save latency of two backends
+"""
+
+import contextlib
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+import jsonpickle
+
+import common.globals
+from common.metrics import latencySummary
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS objects (
+    kind TEXT NOT NULL,
+    id TEXT NOT NULL,
+    format TEXT NOT NULL,
+    data BLOB NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (kind, id, format))"""
+
+# PRAGMA synchronous for each of common.globals.SAVE_DURABILITY_LEVELS.  In
+# WAL mode, NORMAL only syncs at checkpoints, which batches the fsyncs
+SYNCHRONOUS = {"none": "OFF", "periodic": "NORMAL", "transaction": "FULL"}
+
+DATA_EXTENSIONS = [".json", ".pickle"]
+
+
+def _likePrefix(prefix):
+    """ escape a string for use as the prefix of a LIKE pattern """
+    for char in ["\\", "%", "_"]:
+        prefix = prefix.replace(char, "\\" + char)
+    return prefix + "%"
+
+
+class SqliteBackend:
+    """ Storage objects as rows in a SQLite database (WAL mode)
+        * Room/33.json is kind "Room", id "33", format "json".  Account
+          characters are kind "Account", id "<email>/<name>"
+        * each thread gets its own connection, which is closed by
+          releaseThread() when the thread is done with it (i.e. when a
+          client disconnects), or by close()
+        * transaction() groups the writes in a block into one commit """
+
+    def __init__(self, dbFile, datadir, fallback, durability=None):
+        self.dbFile = os.path.abspath(dbFile)
+        self.datadir = os.path.abspath(datadir)
+        self.fallback = fallback
+        self.durability = durability or common.globals.SAVE_DURABILITY
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        os.makedirs(os.path.dirname(self.dbFile), exist_ok=True)
+        self._db()  # create the database, so problems show up right away
+
+    def _db(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.dbFile, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=" +
+                         SYNCHRONOUS.get(self.durability, "NORMAL"))
+            conn.execute(SCHEMA)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def releaseThread(self):
+        """ close the calling thread's connection, if it has one """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return False
+        self._local.conn = None
+        with self._lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        conn.close()
+        return True
+
+    def getConnectionCount(self):
+        with self._lock:
+            return len(self._connections)
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+    def _relParts(self, path):
+        """ the path under the data dir, split on "/", or None """
+        rel = os.path.relpath(os.path.abspath(path), self.datadir)
+        if rel == os.curdir:
+            return []
+        if rel.startswith(os.pardir) or os.path.isabs(rel):
+            return None
+        return rel.replace(os.sep, "/").split("/")
+
+    def keyFor(self, filename):
+        """ return (kind, id, format) for a data file, or None if the file
+            isn't kept in the database """
+        parts = self._relParts(filename)
+        if not parts or len(parts) < 2:
+            return None
+        objId, ext = os.path.splitext("/".join(parts[1:]))
+        if ext not in DATA_EXTENSIONS:
+            return None
+        return (parts[0], objId, ext[1:])
+
+    def _dirKey(self, dirname):
+        """ return (kind, id prefix) for a directory, or None """
+        parts = self._relParts(dirname)
+        if not parts:
+            return None
+        prefix = "/".join(parts[1:])
+        return (parts[0], prefix + "/" if prefix else "")
+
+    def _pathFor(self, kind, objId, fmt):
+        return os.path.join(self.datadir, kind, *objId.split("/")) + "." + fmt
+
+    def read(self, filename, binary=True):
+        key = self.keyFor(filename)
+        if key is None:
+            return self.fallback.read(filename, binary)
+        row = self._db().execute(
+            "SELECT data FROM objects WHERE kind=? AND id=? AND format=?",
+            key).fetchone()
+        if row is None:
+            return None
+        return bytes(row[0]) if binary else bytes(row[0]).decode("utf-8")
+
+    def write(self, filename, data):
+        key = self.keyFor(filename)
+        if key is None:
+            return self.fallback.write(filename, data)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._db().execute(
+            "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)",
+            key + (data, time.time()))
+        return True
+
+    def exists(self, filename):
+        key = self.keyFor(filename)
+        if key is None:
+            return self.fallback.exists(filename)
+        return self._db().execute(
+            "SELECT 1 FROM objects WHERE kind=? AND id=? AND format=?",
+            key).fetchone() is not None
+
+    def stamp(self, filename):
+        """ (last update time, size) of an object, or None """
+        key = self.keyFor(filename)
+        if key is None:
+            return self.fallback.stamp(filename)
+        row = self._db().execute(
+            "SELECT updated, length(data) FROM objects WHERE kind=? AND id=? AND "
+            "format=?", key).fetchone()
+        return None if row is None else tuple(row)
+
+    def delete(self, filename):
+        key = self.keyFor(filename)
+        if key is None:
+            return self.fallback.delete(filename)
+        return self._db().execute(
+            "DELETE FROM objects WHERE kind=? AND id=? AND format=?",
+            key).rowcount > 0
+
+    def listDir(self, dirname):
+        """ names of the objects and "subdirectories" in dirname """
+        dirKey = self._dirKey(dirname)
+        if dirKey is None:
+            if self._relParts(dirname) == []:  # the data dir itself
+                return sorted([row[0] for row in self._db().execute(
+                    "SELECT DISTINCT kind FROM objects")])
+            return self.fallback.listDir(dirname)
+        kind, prefix = dirKey
+        names = set()
+        for objId, fmt in self._db().execute(
+                "SELECT id, format FROM objects WHERE kind=? AND id LIKE ? "
+                "ESCAPE '\\'", (kind, _likePrefix(prefix))):
+            rest = objId[len(prefix):]
+            names.add(rest.split("/")[0] if "/" in rest else rest + "." + fmt)
+        return sorted(names)
+
+    def findFiles(self, dirname, basename):
+        """ objects anywhere under dirname that have the given basename """
+        dirKey = self._dirKey(dirname)
+        baseId, ext = os.path.splitext(basename)
+        if dirKey is None or ext not in DATA_EXTENSIONS:
+            return self.fallback.findFiles(dirname, basename)
+        kind, prefix = dirKey
+        rows = self._db().execute(
+            "SELECT id FROM objects WHERE kind=? AND format=? AND "
+            "(id=? OR id LIKE ? ESCAPE '\\')",
+            (kind, ext[1:], prefix + baseId, "%/" + _likePrefix(baseId)[:-1]))
+        return [self._pathFor(kind, objId, ext[1:]) for (objId,) in rows
+                if objId.startswith(prefix)]
+
+    def removeTree(self, dirname):
+        """ remove everything under dirname - returns the number removed """
+        dirKey = self._dirKey(dirname)
+        removed = self.fallback.removeTree(dirname)  # i.e. isAdmin.txt
+        if dirKey is None:
+            return removed
+        kind, prefix = dirKey
+        return removed + self._db().execute(
+            "DELETE FROM objects WHERE kind=? AND id LIKE ? ESCAPE '\\'",
+            (kind, _likePrefix(prefix))).rowcount
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ one commit for all of the writes in the block, on this thread
+            * the writes are rolled back if the block raises, the same as
+              the files of a group commit """
+        conn = self._db()
+        if conn.in_transaction:  # nested - the outer block commits
+            yield
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def count(self):
+        return self._db().execute("SELECT COUNT(*) FROM objects").fetchone()[0]
+
+
+def findDataFiles(datadir):
+    """ yield the data files (json and pickle) under datadir """
+    for dirpath, dirnames, files in os.walk(datadir):
+        dirnames.sort()
+        for name in sorted(files):
+            if name.startswith("."):
+                continue  # temp files (see common.storage.atomicWrite)
+            if os.path.splitext(name)[1] in DATA_EXTENSIONS:
+                yield os.path.join(dirpath, name)
+
+
+def migrate(datadir, backend):
+    """ copy every data file under datadir into backend, in one transaction
+        * the files are left where they are, so you can switch back
+        * returns the number of objects copied """
+    copied = 0
+    with backend.transaction():
+        for filename in findDataFiles(datadir):
+            with open(filename, "rb") as filehandle:
+                backend.write(filename, filehandle.read())
+            copied += 1
+    return copied
+
+
+def _decode(filename, data):
+    if filename.endswith(".json"):
+        return jsonpickle.decode(data.decode("utf-8"))
+    return pickle.loads(data)
+
+
+def _timeOps(backend, filenames, iterations):
+    """ returns (load secs, save secs) lists - a load is a read and a
+        decode, a save is a write of the same content """
+    loads, saves = [], []
+    for num in range(iterations):
+        for filename in filenames:
+            startTime = time.perf_counter()
+            data = backend.read(filename)
+            _decode(filename, data)
+            loads.append(time.perf_counter() - startTime)
+            startTime = time.perf_counter()
+            backend.write(filename, data)
+            saves.append(time.perf_counter() - startTime)
+    return (loads, saves)
+
+
+def benchmark(datadir, fileBackendClass, iterations=3, limit=None):
+    """ load and save latency (in ms) of the file and sqlite backends
+        * runs against a copy of datadir, in a temp dir, so the real data
+          is never written
+        * returns {backend name: {"load": summary, "save": summary}} """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpDir:
+        benchDir = os.path.join(tmpDir, "data")
+        shutil.copytree(datadir, benchDir)
+        filenames = list(findDataFiles(benchDir))[:limit]
+        fileBackend = fileBackendClass()
+        sqliteBackend = SqliteBackend(
+            os.path.join(tmpDir, "bench.db"), benchDir, fallback=fileBackend)
+        migrate(benchDir, sqliteBackend)
+        for filename in filenames:  # warm up - the first decode imports classes
+            _decode(filename, fileBackend.read(filename))
+        for name, backend in [("file", fileBackend), ("sqlite", sqliteBackend)]:
+            loads, saves = _timeOps(backend, filenames, iterations)
+            results[name] = {"load": latencySummary(loads),
+                             "save": latencySummary(saves)}
+        sqliteBackend.close()
+    return results
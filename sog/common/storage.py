@@ -1,20 +1,476 @@
 """ common functions """
 
+import contextlib
+import copy
+import hashlib
+import itertools
 import jsonpickle
 import os
 from pathlib import Path
 import pickle
 import re
+import shutil
+import threading
+import time
 import traceback
+import weakref
 
+import common.compactJson
 from common.general import logger, dLog
+import common.globals
 from common.globals import DATADIR
+from common.metrics import saveCounts
+from common.sqliteStorage import SqliteBackend
+from common.templates import templateCache
+
+
+def contentDigest(data):
+    """ a fast fingerprint of serialized content (str or bytes) """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _fsyncPath(path):
+    """ fsync a file or directory.  Directories can't be opened on windows,
+        where the rename is already durable, so we skip them.  So are paths
+        that were removed since they were written """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        os.fsync(fd)
+    except OSError:
+        return False  # some filesystems don't support fsync on directories
+    finally:
+        os.close(fd)
+    return True
+
+
+class FsyncQueue:
+    """ Data files that were written, but not yet fsync'd (durability
+        "periodic")
+        * sync() fsyncs all of them, and then each of their directories
+          once, in a single flush cycle.  A daemon thread calls it every
+          <interval> secs, so a crash loses at most that much """
+
+    def __init__(self, interval=None):
+        self.interval = interval or common.globals.SAVE_FSYNC_INTERVAL
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._thread = None
+        self.cycles = 0
+
+    def add(self, filename):
+        with self._lock:
+            self._pending.add(filename)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._syncLoop, name="fsyncQueue", daemon=True)
+                self._thread.start()
+
+    def getPendingCount(self):
+        with self._lock:
+            return len(self._pending)
+
+    def sync(self):
+        """ fsync every pending file - returns the number of files synced """
+        with self._lock:
+            filenames, self._pending = self._pending, set()
+        if not filenames:
+            return 0
+        for filename in filenames:
+            if os.path.exists(filename):
+                _fsyncPath(filename)
+        for dirname in {os.path.dirname(f) for f in filenames}:
+            _fsyncPath(dirname)
+        with self._lock:
+            self.cycles += 1
+        return len(filenames)
+
+    def _syncLoop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sync()
+            except OSError:
+                logger.exception("FsyncQueue: sync failed")
+
+
+fsyncQueue = FsyncQueue()  # shared by all Storage objects
+if common.globals.SAVE_DURABILITY not in common.globals.SAVE_DURABILITY_LEVELS:
+    logger.warning("Unknown save durability {} - using none".format(
+        common.globals.SAVE_DURABILITY))
+_commitBatch = threading.local()  # renames waiting for a group commit
+_tmpFileSeq = itertools.count()  # keeps temp file names unique
+
+
+def atomicWrite(filename, data, durability=None):
+    """ write data (str or bytes) to filename, so that readers (and a crash)
+        see either the old content or the new content, never part of it
+        * the data goes to a temp file in the same directory, which is then
+          renamed over filename
+        * durability (common.globals.SAVE_DURABILITY_LEVELS):
+            none - no fsync.  Safe from a process crash, but not a power loss
+            periodic - fsyncs are batched by fsyncQueue
+            transaction - fsync'd before save() returns.  Inside of
+                          groupCommit(), once for the whole group """
+    durability = durability or common.globals.SAVE_DURABILITY
+    dirname = os.path.dirname(os.path.abspath(filename))
+    tmpName = os.path.join(dirname, ".{}.{}.{}.tmp".format(
+        os.path.basename(filename), os.getpid(), next(_tmpFileSeq)))
+    try:
+        with open(tmpName, "xb" if isinstance(data, bytes) else "x") as filehandle:
+            filehandle.write(data)
+            if durability == "transaction" and not _inGroupCommit():
+                filehandle.flush()
+                os.fsync(filehandle.fileno())
+        if _inGroupCommit() and durability == "transaction":
+            _commitBatch.renames.append((tmpName, filename))
+            return True
+        os.replace(tmpName, filename)
+    except BaseException:
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+        raise
+    if durability == "transaction":
+        _fsyncPath(dirname)
+    elif durability == "periodic":
+        fsyncQueue.add(filename)
+    return True
+
+
+def _inGroupCommit():
+    return getattr(_commitBatch, "renames", None) is not None
+
+
+@contextlib.contextmanager
+def groupCommit():
+    """ batch the fsyncs of the saves made, on this thread, in the block
+        * with durability "transaction", the temp files are all fsync'd,
+          then renamed, then each directory is fsync'd once - one flush
+          cycle for the group instead of one per save
+        * files aren't replaced until the block exits, and not at all if
+          the block raises
+        * if the group isn't fully committed, the onCommitFailure callbacks
+          are called, and the error is raised
+        * with the sqlite backend, the block is one database transaction """
+    if _inGroupCommit():  # nested - the outer block commits
+        yield
+        return
+    _commitBatch.renames = []
+    _commitBatch.onFailure = []
+    try:
+        with getBackend().transaction():
+            yield
+    except BaseException:
+        renames, onFailure = _endGroupCommit()
+        for tmpName, filename in renames:
+            _removeTempFile(tmpName)
+        _callFailureCallbacks(onFailure)
+        raise
+    renames, onFailure = _endGroupCommit()
+    try:
+        _commitRenames(renames)
+    except OSError:
+        _callFailureCallbacks(onFailure)
+        raise
+
+
+def onCommitFailure(func):
+    """ call func() if the group commit that this thread is in fails (i.e.
+        to forget that a save was made) - outside of a group commit, a
+        failed save raises right away, so there's nothing to do """
+    if _inGroupCommit():
+        _commitBatch.onFailure.append(func)
+
+
+def _endGroupCommit():
+    renames, onFailure = _commitBatch.renames, _commitBatch.onFailure
+    _commitBatch.renames, _commitBatch.onFailure = None, None
+    return renames, onFailure
+
+
+def _callFailureCallbacks(callbacks):
+    for func in callbacks:
+        try:
+            func()
+        except Exception:
+            logger.exception("groupCommit: failure callback raised")
+
+
+def _removeTempFile(tmpName):
+    try:
+        os.remove(tmpName)
+    except OSError:
+        pass
+
+
+def _commitRenames(renames):
+    """ the renames that fail are logged, their temp files removed, and the
+        first error is raised after the rest are committed """
+    error = None
+    for tmpName, filename in renames:
+        _fsyncPath(tmpName)
+    for tmpName, filename in renames:
+        try:
+            os.replace(tmpName, filename)
+        except OSError as err:
+            logger.exception("groupCommit: could not replace " + filename)
+            _removeTempFile(tmpName)
+            error = error or err
+    for dirname in {os.path.dirname(os.path.abspath(f)) for t, f in renames}:
+        _fsyncPath(dirname)
+    if error is not None:
+        raise error
+
+
+class FileBackend:
+    """ Storage objects as files under DATADIR (the default backend)
+        * a backend is given the data file path of each object, so that
+          backends are interchangeable.  See common.sqliteStorage """
+
+    def read(self, filename, binary=True):
+        """ return the content of a data file, or None if there isn't one """
+        try:
+            with open(filename, "rb" if binary else "r") as filehandle:
+                return filehandle.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, filename, data):
+        Path(os.path.dirname(filename)).mkdir(parents=True, exist_ok=True)
+        return atomicWrite(filename, data)
+
+    def exists(self, filename):
+        return os.path.isfile(filename)
+
+    def stamp(self, filename):
+        """ (modification time, size) of a data file, or None """
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def delete(self, filename):
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def listDir(self, dirname):
+        """ names of the files and subdirectories in dirname """
+        if not os.path.isdir(dirname):
+            return []
+        return sorted(os.listdir(dirname))
+
+    def findFiles(self, dirname, basename):
+        """ files anywhere under dirname that have the given basename """
+        found = []
+        for dirpath, dirnames, files in os.walk(dirname):
+            if basename in files:
+                found.append(os.path.join(dirpath, basename))
+        return found
+
+    def removeTree(self, dirname):
+        """ remove dirname and everything in it - returns the number of
+            directories removed """
+        if not os.path.isdir(dirname):
+            return 0
+        shutil.rmtree(dirname, ignore_errors=True)
+        return 1
+
+    def transaction(self):
+        return contextlib.nullcontext()
+
+    def releaseThread(self):
+        """ free anything the calling thread holds - files have nothing """
+        return False
+
+
+class ScratchBackend:
+    """ Storage objects under the data dir are written to a scratch dir
+        instead, so that the real data isn't changed (i.e. by load runs)
+        * reads look in the scratch dir first, and then in the base backend
+          for the real file
+        * deleting a real file hides it - the real file is left alone
+        * paths that aren't under the data dir go to the base backend """
+
+    def __init__(self, scratchdir, base, datadir=None):
+        self.scratchdir = os.path.abspath(scratchdir)
+        self.datadir = os.path.abspath(datadir or DATADIR)
+        self.base = base
+        self.scratch = FileBackend()
+        self._hidden = set()  # real files that were deleted
+        self._lock = threading.Lock()
+
+    def _scratchPath(self, path):
+        """ where the path goes in the scratch dir, or None """
+        rel = os.path.relpath(os.path.abspath(path), self.datadir)
+        if rel.startswith(os.pardir) or os.path.isabs(rel):
+            return None
+        return os.path.normpath(os.path.join(self.scratchdir, rel))
+
+    def _isHidden(self, filename):
+        with self._lock:
+            return os.path.abspath(filename) in self._hidden
+
+    def read(self, filename, binary=True):
+        scratchFile = self._scratchPath(filename)
+        if scratchFile:
+            data = self.scratch.read(scratchFile, binary)
+            if data is not None or self._isHidden(filename):
+                return data
+        return self.base.read(filename, binary)
+
+    def write(self, filename, data):
+        scratchFile = self._scratchPath(filename)
+        if not scratchFile:
+            return self.base.write(filename, data)
+        with self._lock:
+            self._hidden.discard(os.path.abspath(filename))
+        return self.scratch.write(scratchFile, data)
+
+    def exists(self, filename):
+        return self.stamp(filename) is not None
+
+    def stamp(self, filename):
+        scratchFile = self._scratchPath(filename)
+        if scratchFile:
+            stamp = self.scratch.stamp(scratchFile)
+            if stamp is not None or self._isHidden(filename):
+                return stamp
+        return self.base.stamp(filename)
+
+    def delete(self, filename):
+        scratchFile = self._scratchPath(filename)
+        if not scratchFile:
+            return self.base.delete(filename)
+        deleted = self.scratch.delete(scratchFile)
+        if not self._isHidden(filename) and self.base.exists(filename):
+            with self._lock:
+                self._hidden.add(os.path.abspath(filename))
+            deleted = True
+        return deleted
+
+    def listDir(self, dirname):
+        scratchDir = self._scratchPath(dirname)
+        if not scratchDir:
+            return self.base.listDir(dirname)
+        names = set(self.scratch.listDir(scratchDir))
+        for name in self.base.listDir(dirname):
+            if not self._isHidden(os.path.join(dirname, name)):
+                names.add(name)
+        return sorted(names)
+
+    def findFiles(self, dirname, basename):
+        scratchDir = self._scratchPath(dirname)
+        if not scratchDir:
+            return self.base.findFiles(dirname, basename)
+        found = set()
+        for scratchFile in self.scratch.findFiles(scratchDir, basename):
+            found.add(os.path.join(
+                dirname, os.path.relpath(scratchFile, scratchDir)))
+        for filename in self.base.findFiles(dirname, basename):
+            if not self._isHidden(filename):
+                found.add(filename)
+        return sorted(found)
+
+    def removeTree(self, dirname):
+        """ remove dirname from the scratch dir - real dirs are left as is """
+        scratchDir = self._scratchPath(dirname)
+        if not scratchDir:
+            return self.base.removeTree(dirname)
+        return self.scratch.removeTree(scratchDir)
+
+    def transaction(self):
+        return self.base.transaction()
+
+    def releaseThread(self):
+        return self.base.releaseThread()
+
+
+class SavedDigests:
+    """ The fingerprint and size of the content that each Storage object
+        last loaded or saved
+        * kept here, out of the objects, so that they are never serialized
+          along with them (i.e. items in a room or character inventory)
+        * entries go away with their objects """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = weakref.WeakKeyDictionary()  # obj -> (digest, size)
+
+    def get(self, obj):
+        """ return (digest, size), or (None, 0) if obj wasn't loaded or
+            saved """
+        with self._lock:
+            return self._entries.get(obj, (None, 0))
+
+    def set(self, obj, digest, size):
+        with self._lock:
+            self._entries[obj] = (digest, size)
+
+    def discard(self, obj):
+        """ forget obj's digest, so that its next save is written """
+        with self._lock:
+            self._entries.pop(obj, None)
+
+
+savedDigests = SavedDigests()  # shared by all Storage objects
+
+_backend = None
+_backendLock = threading.Lock()
+
+
+def createBackend(name=None, dbFile=None):
+    """ return a new backend - common.globals.STORAGE_BACKEND by default """
+    name = name or common.globals.STORAGE_BACKEND
+    if name == "sqlite":
+        return SqliteBackend(dbFile or common.globals.STORAGE_DB, DATADIR,
+                             fallback=FileBackend())
+    if name != "file":
+        logger.warning("Unknown storage backend {} - using file".format(name))
+    return FileBackend()
+
+
+def getBackend():
+    """ the backend that all Storage objects use """
+    global _backend
+    if _backend is None:
+        with _backendLock:
+            if _backend is None:
+                _backend = createBackend()
+    return _backend
+
+
+def setBackend(backend):
+    """ switch backends (i.e. for tests) - returns the previous backend """
+    global _backend
+    with _backendLock:
+        previous, _backend = _backend, backend
+    return previous
 
 
 class Storage:
-    """ Storage object superClass """
+    """ Storage object superClass
+        * save() is a no-op when the serialized object is the same as what
+          was last loaded or saved.  The fingerprint of that content is
+          kept in savedDigests, so it's never saved itself
+        * classes with _compactJson set save json in the compact format (see
+          common.compactJson).  Files in the old jsonpickle format are still
+          read, and are converted to the compact format when they are next
+          saved
+        * classes with _templateCache set are read through the template
+          cache (see common.templates), so each data file is only decoded
+          once, until it changes """
 
     _debugStorage = False
+    _compactJson = False
+    _templateCache = False
     attributesThatShouldntBeSaved = []
 
     def __init__(self):
@@ -22,9 +478,7 @@ class Storage:
 
     def dataFileExists(self):
         """ returns True if the file exists """
-        if os.path.isfile(self._datafile):
-            return True
-        return False
+        return getBackend().exists(self._datafile)
 
     def getDataFilename(self):
         """ returns the filename - should always be overridden """
@@ -103,10 +557,7 @@ class Storage:
 
         if self.dataFileExists():
             # read the persisted content
-            if re.search("\\.json$", filename):
-                loadedDict = self.readJsonFile(filename, logStr)
-            else:
-                loadedDict = self.readPickleFile(filename, logStr)
+            loadedDict = self.readDataFile(filename, logStr)
 
             if not loadedDict:
                 logger.error("storage.load - Could not get loaded instance")
@@ -139,6 +590,16 @@ class Storage:
 
     def save(self, logStr=""):
         """ save to persistant storage """
+        frozen = self.freeze(logStr)
+        if frozen is None:
+            return False
+        return self.writeFrozen(frozen, logStr)
+
+    def freeze(self, logStr=""):
+        """ the first half of save - serialize the object, on the calling
+            thread.  Returns (filename, serialized data), or None if the
+            object can't be saved.  The result can be handed to writeFrozen
+            on another thread (see common.persister) """
         if logStr != "":
             logStr += " "  # append a space for easy logging
 
@@ -156,7 +617,7 @@ class Storage:
                 + logStr
                 + str(self.getId())
             )
-            return False
+            return None
         if not self.isValid():  # if the instance we are saving is not valid
             logger.error(
                 logPrefix
@@ -165,43 +626,51 @@ class Storage:
                 + str(self.getId())
                 + " is not valid"
             )
-            return False
+            return None
 
         # create directory
-        path = Path(os.path.dirname(self._datafile))
-        path.mkdir(parents=True, exist_ok=True)
-
         # some attributes should not be, or can not be pickled, so we
-        # store the values before we save, then we will restore them
-        # immediately after.
-        tmpStore = {}
+        # save a shallow copy without them.  The live object is left alone,
+        # since other threads may be using it while we save.
+        frozenObj = copy.copy(self)
         for attName in self.getAttributesThatShouldntBeSaved() + [
             "_datafile",
             "_instanceDebug",
         ]:
-            try:
-                tmpStore[attName] = getattr(self, attName)
-                if hasattr(self, attName):
-                    delattr(self, attName)
+            if frozenObj.__dict__.pop(attName, None) is not None:
                 dLog(
                     logPrefix + "Ignoring " + attName + " during save",
                     self._debugStorage,
                 )
-            except AttributeError:
-                dLog(
-                    logPrefix + "Could not ignore " + attName + " during save",
-                    self._debugStorage,
-                )
 
-        # persist content - create data file
         if re.search("\\.json$", filename):
-            self.writeJSonFile(filename)
+            frozen = frozenObj.encodeJson(compact=self.savesCompactJson())
         else:
-            self.writePickleFile(filename)
+            frozen = frozenObj.encodePickle()
+        if frozen is None:
+            return None
+        return (filename, frozen)
+
+    def writeFrozen(self, frozenTuple, logStr=""):
+        """ the second half of save - write what freeze returned, unless
+            it's the same as what was last loaded or saved """
+        if logStr != "":
+            logStr += " "
+        logPrefix = self.__class__.__name__ + " save: "
+        filename, frozen = frozenTuple
+        digest = contentDigest(frozen)
+        if digest == savedDigests.get(self)[0] and getBackend().exists(filename):
+            saveCounts.record(self.__class__.__name__, written=False)
+            dLog(
+                logPrefix + "unchanged " + logStr + " - " + str(self.getId()),
+                self._debugStorage,
+            )
+            return True
 
-        # Restore attributes that we temporarily set aside when saving.
-        for attName in tmpStore.keys():
-            setattr(self, attName, tmpStore[attName])
+        self.writeDataFile(filename, frozen)
+        savedDigests.set(self, digest, len(frozen))
+        onCommitFailure(lambda: savedDigests.discard(self))
+        saveCounts.record(self.__class__.__name__, written=True)
 
         dLog(
             logPrefix + "saved " + logStr + " - " + str(self.getId()),
@@ -209,17 +678,66 @@ class Storage:
         )
         return True
 
-    def writePickleFile(self, filename):
-        with open(filename, "wb") as outputfilehandle:
-            try:
-                pickle.dump(self, outputfilehandle, pickle.DEFAULT_PROTOCOL)
-            except TypeError:
-                dLog(self.debug(), self._debugStorage)
-                traceback.print_exc()
+    def getSavedSize(self):
+        """ the size of the data that was last loaded or saved """
+        return savedDigests.get(self)[1]
+
+    def writeDataFile(self, filename, frozen):
+        """ write the serialized object, and drop its (now stale) template """
+        if isinstance(frozen, str):
+            self.writeJSonFile(filename, frozen)
+        else:
+            self.writePickleFile(filename, frozen)
+        if self._templateCache:
+            templateCache.invalidate(self.getItemId())
+
+    def readDataFile(self, filename, logStr=""):
+        """ return the dict of attributes in the data file """
+        if self._templateCache and templateCache.isEnabled():
+            return self.readTemplate(filename, logStr)
+        if re.search("\\.json$", filename):
+            return self.readJsonFile(filename, logStr)
+        return self.readPickleFile(filename, logStr)
+
+    def readTemplate(self, filename, logStr=""):
+        """ return the attributes from the template cache, reading the data
+            file if they aren't there, or if the file has changed """
+        key = self.getItemId()
+        stamp = getBackend().stamp(filename)
+        cached = templateCache.get(key, stamp)
+        if cached is not None:
+            loadedDict, extras = cached
+            if extras:
+                savedDigests.set(self, extras["digest"], extras["size"])
+            return loadedDict
+        if re.search("\\.json$", filename):
+            loadedDict = self.readJsonFile(filename, logStr)
+        else:
+            loadedDict = self.readPickleFile(filename, logStr)
+        if loadedDict:
+            digest, size = savedDigests.get(self)
+            extras = {"digest": digest, "size": size} if digest else {}
+            templateCache.put(key, stamp, loadedDict, extras)
+        return loadedDict
+
+    def encodePickle(self):
+        """ return the pickled object, or None if it can't be pickled """
+        try:
+            return pickle.dumps(self, pickle.DEFAULT_PROTOCOL)
+        except TypeError:
+            dLog(self.debug(), self._debugStorage)
+            traceback.print_exc()
+        return None
+
+    def writePickleFile(self, filename, frozen):
+        getBackend().write(filename, frozen)
 
     def readPickleFile(self, filename, logStr=""):
-        with open(filename, "rb") as inputfilehandle:
-            loadedItem = pickle.load(inputfilehandle)
+        frozen = getBackend().read(filename)
+        if frozen is None:
+            return None
+        loadedItem = pickle.loads(frozen)
+        savedDigests.set(self, contentDigest(frozen), len(frozen))
 
         pickleDict = {}
         for onevar in vars(loadedItem):
@@ -229,24 +747,35 @@ class Storage:
             pickleDict[onevar] = getattr(loadedItem, onevar)
         return pickleDict
 
-    def writeJSonFile(self, filename):
+    def savesCompactJson(self):
+        """ True if json is saved in the compact format """
+        return self._compactJson
+
+    def encodeJson(self, compact=False):
+        if compact:
+            return common.compactJson.encode(self)
         jsonpickle.set_encoder_options(
             "json", sort_keys=True, indent=4, ensure_ascii=False
         )
-        frozen = jsonpickle.encode(self, max_depth=10)
-        with open(filename, "w") as filehandle:
-            try:
-                filehandle.write(frozen)
-                # json.dump(frozen, filehandle)
-            except TypeError:
-                dLog(self.debug(), self._debugStorage)
-                traceback.print_exc()
+        return jsonpickle.encode(self, max_depth=10)
+
+    def writeJSonFile(self, filename, frozen):
+        getBackend().write(filename, frozen)
 
     def readJsonFile(self, filename, logStr=""):
         logPrefix = "readJsonFile: "
-        with open(filename, "r") as filehandle:
-            loadedItem = filehandle.read()
-            thawedDict = jsonpickle.decode(loadedItem)
+        loadedItem = getBackend().read(filename, binary=False)
+        if loadedItem is not None:
+            thawedDict, compact = common.compactJson.decode(
+                loadedItem, type(self))
+            savedDigests.set(self, contentDigest(loadedItem), len(loadedItem))
+
+            if compact:  # already a dict of attributes
+                return {
+                    key: value
+                    for key, value in thawedDict.items()
+                    if not self.attributeShouldBeIgnored(key)
+                }
 
             if isinstance(thawedDict, dict):
                 logger.warn(
@@ -341,7 +870,7 @@ class Storage:
                 + str(self.getId())
             )
             return False
-        if not os.path.isfile(filename):
+        if not self.dataFileExists():
             logger.error(
                 logPrefix
                 + " Could not delete "
@@ -351,13 +880,15 @@ class Storage:
             return False
         if self.dataFileExists():
             logger.info(logPrefix + " Preparing to delete " + logStr + " " + filename)
+            if self._templateCache:
+                templateCache.invalidate(self.getItemId())
             try:
-                os.remove(filename)
+                getBackend().delete(filename)
             except OSError as e:
                 logger.error(logPrefix + "Failed with:" + e.strerror)
-                logger.error(logPrefix + "Error code:" + e.code)
+                logger.error(logPrefix + "Error code:" + str(e.errno))
 
-            if os.path.isfile(filename):
+            if self.dataFileExists():
                 logger.error(logPrefix + " " + filename + " could not " + "be deleted")
                 return False
             else:
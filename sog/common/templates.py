@@ -0,0 +1,123 @@
+""" templates - a process-wide cache of decoded creature and object files
+
+   Creatures and objects are loaded from the same few files over and over
+   (encounters, creature inventories, room permanents).  TemplateCache
+   keeps the attributes that were read from each file, keyed by item id
+   (i.e. Creature/12), and hands out a deep copy for each load, so every
+   instance still gets its own attributes and its own postLoad (hit points,
+   random inventory, ...)
+     * entries are evicted, least recently used first, when there are more
+       than maxEntries, or when their total size (the size of their data
+       files) is over maxBytes
+     * each entry remembers the stamp (mtime and size) of its data file.  An
+       entry with a different stamp is stale, and is read again, so changes
+       made by the editor are picked up
+"""
+
+import collections
+import copy
+from datetime import datetime
+import threading
+
+import common.globals
+
+_IMMUTABLES = (str, int, float, bool, type(None), datetime)
+
+
+def clone(value):
+    """ a deep copy that shares the immutable values - creature and object
+        attributes are mostly scalars, so this is much cheaper than
+        copy.deepcopy """
+    if isinstance(value, _IMMUTABLES):
+        return value
+    if type(value) is list:
+        return [clone(oneVal) for oneVal in value]
+    if type(value) is dict:
+        return {key: clone(oneVal) for key, oneVal in value.items()}
+    return copy.deepcopy(value)
+
+
+class TemplateCache:
+    """ Decoded attribute dicts, keyed by item id
+        * get() returns a copy of the attributes, or None on a miss
+        * a maxEntries of 0 turns the cache off """
+
+    def __init__(self, maxEntries=None, maxBytes=None):
+        if maxEntries is None:
+            maxEntries = common.globals.TEMPLATE_CACHE_ENTRIES
+        if maxBytes is None:
+            maxBytes = common.globals.TEMPLATE_CACHE_BYTES
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key -> (stamp, atts, extras)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def isEnabled(self):
+        return self.maxEntries > 0
+
+    def get(self, key, stamp):
+        """ return (attributes, extras) copied from the template, or None if
+            there isn't one for this stamp of the data file """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] != stamp:
+                self.stale += 1
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return (clone(entry[1]), dict(entry[2]))
+
+    def put(self, key, stamp, attDict, extras=None):
+        """ keep a copy of attDict, as read from a data file with the given
+            stamp ((mtime, size)), as the template for key """
+        if not self.isEnabled() or stamp is None or stamp[1] > self.maxBytes:
+            return False
+        entry = (stamp, clone(attDict), dict(extras or {}))
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            self._bytes += stamp[1]
+            while len(self._entries) > self.maxEntries or self._bytes > self.maxBytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return True
+
+    def invalidate(self, key):
+        """ forget the template for key - i.e. when its file is saved """
+        with self._lock:
+            return self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._bytes -= entry[0][1]
+        return True
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions,
+            }
+
+
+templateCache = TemplateCache()  # shared by all Storage objects
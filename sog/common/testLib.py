@@ -6,18 +6,30 @@
 """
 # import doctest
 import os
+import tempfile
 import unittest
 
 import account
 import character
 import creature
 from object import ObjectFactory
-from room import RoomFactory
+from room import RoomFactory, roomTypeIndex
 from common.globals import DATADIR
+from common.doorState import doorStates
 from common.general import logger
 import common.serverLib
+from common.storage import ScratchBackend, getBackend, setBackend
 import threads
-from game import GameCmd
+from game import Game, GameCmd
+
+# door states that the tests set are kept out of the real data dir
+_doorStateDir = tempfile.TemporaryDirectory()
+doorStates.setDirectory(_doorStateDir.name)
+
+# rooms, accounts and characters that the tests save go to a scratch dir, so
+# running the tests never changes the tracked data
+_scratchDataDir = tempfile.TemporaryDirectory()
+setBackend(ScratchBackend(_scratchDataDir.name, getBackend()))
 
 
 class TestGameBase(unittest.TestCase):
@@ -229,15 +241,19 @@ class TestGameBase(unittest.TestCase):
             roomNums = self._tmpTestRoomNumbers
         # Clean up any saved room data
         for testRoomNum in roomNums:
-            testRoomFilename = os.path.abspath(
-                DATADIR + "/Room/" + str(testRoomNum) + ".json"
-            )
-            if os.path.isfile(testRoomFilename):
-                try:
-                    os.remove(testRoomFilename)
-                    logger.info("Removing test datafile " + testRoomFilename)
-                except OSError:
-                    pass
+            for roomType in ["Room", "Shop", "Guild"]:
+                testRoomFilename = os.path.abspath(
+                    DATADIR + "/" + roomType + "/" + str(testRoomNum) + ".json"
+                )
+                if getBackend().exists(testRoomFilename):
+                    try:
+                        getBackend().delete(testRoomFilename)
+                        logger.info("Removing test datafile " + testRoomFilename)
+                    except OSError:
+                        pass
+                roomTypeIndex.remove(testRoomNum, roomType.lower())
+            Game().getWarmRooms().discard(testRoomNum)
+        doorStates.discard(roomNums)  # test doors use the same numbers
 
     def tearDown(self):
         if hasattr(self, "_asyncThread"):
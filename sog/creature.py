@@ -39,6 +39,7 @@ class Creature(Item):
     _instanceDebug = False
 
     _fileextension = ".json"
+    _templateCache = True  # see common.templates
 
     creatureSpellList = ["poison", "fireball", "lightning", "befuddle"]
 
@@ -6,10 +6,14 @@
 # the game class.
 
 import cmd
+import contextlib
 from datetime import datetime
+import json
+import os
 import pprint
 import random
 import re
+import threading
 
 from combat import Combat
 from common.ipc import Ipc
@@ -17,11 +21,18 @@ from common.general import isIntStr, dateStr, logger, dLog
 from common.general import splitTargets, targetSearch, itemSort
 from common.general import getRandomItemFromList, secsSinceDate, getNeverDate
 from common.globals import maxCreaturesInRoom
+import common.globals
+from common.actors import ActorQueues
+from common.doorState import doorStates
+from common.metrics import TickMetrics, saveCounts
+from common.persister import WriteBehind
+from common.registry import RoomRegistry, SessionRegistry, WarmRoomCache
+from common.scheduler import HOLD, RETRY_SECS, Scheduler
 from common.help import enterHelp
 from creature import Creature
 from magic import Spell, SpellList, spellCanTargetSelf
 from object import ObjectFactory, isObjectFactoryType
-from room import RoomFactory, isRoomFactoryType, getRoomTypeFromFile
+from room import RoomFactory, isRoomFactoryType, getRoomTypeFromFile, roomTypeIndex
 
 
 class _Game(cmd.Cmd, Combat, Ipc):
@@ -33,10 +44,23 @@ class _Game(cmd.Cmd, Combat, Ipc):
     def __init__(self):
         """ game-wide attributes """
         self.instance = "Instance at %d" % self.__hash__()
-        self._activeRooms = []
-        self._activePlayers = []
+        self._activeRooms = RoomRegistry()
+        self._warmRooms = WarmRoomCache(  # recently emptied rooms
+            common.globals.WARM_ROOMS, common.globals.WARM_ROOM_SECS,
+            common.globals.WARM_ROOM_BYTES)
+        # held while characters join/leave rooms and rooms are (de)activated,
+        # so that a room is active if, and only if, it has characters in it
+        self._roomLock = threading.RLock()
+        self._activePlayers = SessionRegistry(lambda charObj: charObj.getAcctName())
+        self._scheduler = Scheduler()
+        self._tickMetrics = TickMetrics()
+        self._persister = WriteBehind()  # character saves, off of client threads
+        self._roomActors = None  # room number -> serial queue, when enabled
+        if common.globals.ROOM_ACTORS:
+            self.enableRoomActors()
         self._startdate = datetime.now()
         self._asyncThread = None
+        roomTypeIndex.build()  # so that room loads don't probe the data dirs
 
         self._instanceDebug = _Game._instanceDebug
         return None
@@ -59,9 +83,56 @@ class _Game(cmd.Cmd, Combat, Ipc):
         return False
 
     def asyncTasks(self):
-        """ Tasks that run in a separate thread with ~1 sec intervals """
-        self.asyncNonPlayerActions()
-        self.asyncCharacterActions()
+        """ Tasks that run in a separate thread with ~1 sec intervals
+            * only the scheduled tasks that are due are run.  Active rooms
+              and players schedule their own tasks (see scheduleRoomTasks
+              and scheduleCharacterTasks) """
+        with self._tickMetrics.tick(), self._persister.changing():
+            self._scheduler.runDue()
+
+    def getScheduler(self):
+        return self._scheduler
+
+    def getTickMetrics(self):
+        return self._tickMetrics
+
+    def getPersister(self):
+        return self._persister
+
+    def enableRoomActors(self, workers=None):
+        """ run each room's commands and async tasks on its own serial queue
+            (see common.actors) """
+        if not self._roomActors:
+            self._roomActors = ActorQueues(
+                workers or common.globals.ROOM_ACTOR_WORKERS)
+
+    def disableRoomActors(self):
+        roomActors, self._roomActors = self._roomActors, None
+        if roomActors:
+            roomActors.shutdown()
+
+    def getRoomActors(self):
+        return self._roomActors
+
+    def waitForInput(self):
+        """ prompts wait for the player's input outside of the room's turn,
+            so that the room's other commands and tasks aren't held up by a
+            player who is slow to answer (see common.ioLib.setPromptHook).
+            The turn is taken back before the command goes on """
+        roomActors = self._roomActors
+        if not roomActors:
+            return contextlib.nullcontext()
+        return roomActors.yieldTurn()
+
+    def runInRoom(self, roomObj, func):
+        """ run func, in the room's turn when room actors are enabled
+            * the room is the one that the command started in.  Commands
+              that reach into other rooms (i.e. moving) still rely on the
+              room lock for those """
+        roomActors = self._roomActors
+        if not roomActors or not roomObj:
+            return func()
+        return roomActors.call(roomObj.getId(), func)
 
     def processDeadClients(self):
         True
@@ -76,6 +147,7 @@ class _Game(cmd.Cmd, Combat, Ipc):
         gameCmd = GameCmd(client)  # each user gets their own cmd shell
 
         self.addToActivePlayerList(charObj)
+        client.getConnectionList().setCharacter(client, charObj.getName())
 
         # in-game broadcast announcing game entry
         msg = self.txtBanner(
@@ -87,13 +159,15 @@ class _Game(cmd.Cmd, Combat, Ipc):
         # add room to charObj and then display the room
         if self.joinRoom(1, charObj):
             self.charMsg(charObj, charObj.getRoom().display(charObj))
-            try:
-                gameCmd.cmdloop()  # start the game cmdloop
-            finally:
-                if client.charObj:
-                    self.leaveGame(client.charObj)
+            # start the game cmdloop
+            client.runCmdLoop(gameCmd, self.leaveGameCmdLoop)
         return False
 
+    def leaveGameCmdLoop(self, client):
+        """ Clean up after a client's game cmdloop has exited """
+        if client.charObj:
+            self.leaveGame(client.charObj)
+
     def leaveGame(self, charObj, saveChar=True):
         """ Handle details of leaving a game """
         self.leaveRoom(charObj)
@@ -103,11 +177,11 @@ class _Game(cmd.Cmd, Combat, Ipc):
 
         # final character save before throwing away charObj
         if saveChar:
-            # saveChar is False when it's a suicide
-            try:
-                charObj.save(logStr=__class__.__name__)
-            except AttributeError:
+            if not self._persister.flush(charObj):
                 logger.warning("Could not save character")
+        else:
+            # saveChar is False when it's a suicide
+            self._persister.discard(charObj)
 
         # notification and logging
         msg = self.txtBanner(
@@ -122,50 +196,70 @@ class _Game(cmd.Cmd, Combat, Ipc):
 
         # Discard charObj
         if charObj.client:
+            charObj.client.getConnectionList().setCharacter(charObj.client, None)
             charObj.client.charObj = None
         charObj = None
         return True
 
     def getCharacterList(self):
+        """ Return a snapshot list of the characters in the game """
+        return self._activePlayers.list()
+
+    def getPlayerRegistry(self):
+        """ Return the characters in the game, for lookups by id, name, and
+            account (see common.registry.SessionRegistry) """
         return self._activePlayers
 
+    def isActivePlayer(self, charObj):
+        return charObj in self._activePlayers
+
     def addToActivePlayerList(self, charObj):
         """ add character to list of characters in game """
-        if charObj not in self.getCharacterList():
-            self._activePlayers.append(charObj)
+        if self._activePlayers.add(charObj):
+            charObj.setGameHooks(self._persister, self.rescheduleVitals)
+            if charObj.client:
+                charObj.client.setPromptHook(self.waitForInput)
+            self.scheduleCharacterTasks(charObj)
 
     def removeFromActivePlayerList(self, charObj):
         """ remove character from list of characters in game """
-        if charObj in self.getCharacterList():
-            self._activePlayers.remove(charObj)
+        self._activePlayers.remove(charObj)
+        charObj.setGameHooks()
+        if charObj.client:
+            charObj.client.setPromptHook()
+        self._scheduler.cancel(("timeout", charObj))
+        self._scheduler.cancel(("vitals", charObj))
 
     def getActiveRoomList(self):
-        return self._activeRooms
+        """ Return a snapshot list of the active rooms """
+        return self._activeRooms.list()
 
     def addToActiveRooms(self, roomObj):
         """ Add room to active room list """
-        if roomObj not in self.getActiveRoomList():
-            self._activeRooms.append(roomObj)
+        previousRoom = self._activeRooms.add(roomObj)
+        if previousRoom is roomObj:
+            return True
+        if previousRoom:  # replaced another instance of the same room
+            self.cancelRoomTasks(previousRoom)
+        self.scheduleRoomTasks(roomObj)
         return True
 
     def removeFromActiveRooms(self, roomObj):
         """ Remove room from active room list """
-        if self.isActiveRoom(roomObj):
-            self._activeRooms.remove(roomObj)
+        if self._activeRooms.remove(roomObj):
+            self.cancelRoomTasks(roomObj)
         return True
 
     def isActiveRoom(self, roomObj):
         """ Return true if room is in active room list """
-        if roomObj in self.getActiveRoomList():
-            return True
-        return False
+        return roomObj in self._activeRooms
 
     def getActiveRoom(self, num):
         """ Return the roomObj for an active room, given the room number """
-        for roomObj in self.getActiveRoomList():
-            if roomObj.getId() == num:
-                return roomObj
-        return None
+        return self._activeRooms.get(num)
+
+    def getWarmRooms(self):
+        return self._warmRooms
 
     def activeRoomInfo(self):
         msg = "Active rooms: " + ", ".join(
@@ -175,16 +269,42 @@ class _Game(cmd.Cmd, Combat, Ipc):
 
     def deActivateEmptyRoom(self, roomObj):
         """ deactiveates room if empty.  Returns true if deactiveated """
-        if len(roomObj.getCharacterList()) == 0:
-            self.removeFromActiveRooms(roomObj)
-            return True
+        with self._roomLock:
+            if len(roomObj.getCharacterList()) == 0:
+                self.removeFromActiveRooms(roomObj)
+                return True
         return False
 
-    def asyncCharacterActions(self):
-        """ asyncronous actions that occur to players. """
-        for charObj in self.getCharacterList():
-            self.timeoutInactivePlayer(charObj)
-            charObj.processPoisonAndRegen()
+    def scheduleCharacterTasks(self, charObj):
+        """ schedule the async tasks for a player that joined the game """
+        self._scheduler.schedule(
+            ("timeout", charObj), 1, lambda: self.timeoutTask(charObj))
+        self._scheduler.schedule(
+            ("vitals", charObj), 0, lambda: self.vitalsTask(charObj))
+
+    def rescheduleVitals(self, charObj):
+        """ run the vitals task for an active player now - i.e. when they are
+            poisoned, so the poison doesn't wait for the next regen """
+        if self._scheduler.isScheduled(("vitals", charObj)):
+            self._scheduler.schedule(
+                ("vitals", charObj), 0, lambda: self.vitalsTask(charObj))
+
+    def timeoutTask(self, charObj, timeoutInSecs=300, clientCheckSecs=10):
+        """ scheduled task - returns the secs until the next check
+            * we check at least every clientCheckSecs, since a dead client
+              should be removed right away """
+        with self._tickMetrics.phase("timeouts"):
+            if self.timeoutInactivePlayer(charObj, timeoutInSecs):
+                return None
+        if charObj.getInputDate() == getNeverDate():
+            return clientCheckSecs
+        secsLeft = timeoutInSecs - secsSinceDate(charObj.getInputDate())
+        return max(1, min(secsLeft, clientCheckSecs))
+
+    def vitalsTask(self, charObj):
+        """ scheduled task - poison and regen """
+        with self._tickMetrics.phase("regen"):
+            return charObj.processPoisonAndRegen()
 
     def timeoutInactivePlayer(self, charObj, timeoutInSecs=300):
         """ kick character out of game if they have been inactive """
@@ -207,14 +327,92 @@ class _Game(cmd.Cmd, Combat, Ipc):
 
         return(False)
 
-    def asyncNonPlayerActions(self):
-        """ asyncronous actions that are not tied to a player. """
-        for roomObj in self.getActiveRoomList():
+    def scheduleRoomTasks(self, roomObj):
+        """ schedule the async tasks for a room that became active
+            * rooms without an encounter list never have encounters
+            * creatures only attack while there are creatures in the room """
+        if roomObj.secsUntilEncounter() is not None:
+            self.scheduleRoomTask(("encounter", roomObj), 0, self.encounterTask)
+        if roomObj.getCreatureList():
+            self.scheduleCreatureTask(roomObj)
+
+    def scheduleRoomTask(self, key, delay, task, replace=True):
+        """ schedule task(roomObj), where key is (taskName, roomObj)
+            * with room actors, the scheduler only posts the task to the
+              room's queue when it's due.  The key stays held until the
+              task has run, and then the task reschedules itself """
+        if self._roomActors:
+            return self._scheduler.schedule(
+                key, delay, lambda: self._postRoomTask(key, task), replace=replace)
+        return self._scheduler.schedule(
+            key, delay, lambda: task(key[1]), replace=replace)
+
+    def _postRoomTask(self, key, task):
+        roomActors = self._roomActors
+        if not roomActors:  # actors were turned off - run it here
+            return task(key[1])
+        tickTimes = self._tickMetrics.currentTick()
+        roomActors.post(key[1].getId(),
+                        lambda: self._runPostedRoomTask(key, task, tickTimes))
+        return HOLD  # so that replace=False doesn't schedule it twice
+
+    def _runPostedRoomTask(self, key, task, tickTimes=None):
+        roomObj = key[1]
+        if not self.isActiveRoom(roomObj):
+            self._scheduler.release(key)
+            return None  # room was deactivated while the task was queued
+        try:
+            with self._tickMetrics.forTick(tickTimes), self._persister.changing():
+                delay = task(roomObj)
+        except Exception:  # retried, as the scheduler would
+            logger.exception("Room task {} failed".format(key[0]))
+            delay = RETRY_SECS
+        if delay is not None and self.isActiveRoom(roomObj):
+            self.scheduleRoomTask(key, delay, task)
+        else:
+            self._scheduler.release(key)
+        return None
+
+    def cancelRoomTasks(self, roomObj):
+        self._scheduler.cancel(("encounter", roomObj))
+        self._scheduler.cancel(("creatures", roomObj))
+
+    def addCreatureToRoom(self, roomObj, creatureObj):
+        """ add a creature to a room - if the room is active, its creatures
+            start attacking.  Inactive rooms schedule the attacks when they
+            become active (see scheduleRoomTasks) """
+        roomObj.addCreature(creatureObj)
+        if self.isActiveRoom(roomObj):
+            self.scheduleCreatureTask(roomObj)
+
+    def scheduleCreatureTask(self, roomObj):
+        """ start the creature attack task, unless it's already scheduled """
+        self.scheduleRoomTask(
+            ("creatures", roomObj), 0, self.creatureTask, replace=False)
+
+    def encounterTask(self, roomObj):
+        """ scheduled task - returns the secs until the next encounter """
+        with self._tickMetrics.phase("deactivate"):
             if self.deActivateEmptyRoom(roomObj):
-                continue
+                return None
+        with self._tickMetrics.phase("encounter"):
             self.creatureEncounter(roomObj)
+        secsLeft = roomObj.secsUntilEncounter()
+        if secsLeft is None:
+            return None
+        return max(1, secsLeft)
+
+    def creatureTask(self, roomObj):
+        """ scheduled task - creatures attack every tick until there are
+            none left in the room """
+        with self._tickMetrics.phase("deactivate"):
+            if self.deActivateEmptyRoom(roomObj):
+                return None
+        with self._tickMetrics.phase("creaturesAttack"):
             self.creaturesAttack(roomObj)
-        return None
+        if not roomObj.getCreatureList():
+            return None
+        return common.globals.TICK_INTERVAL
 
     def roomLoader(self, roomStr):
         """ returns a roomObj, given a roomStr """
@@ -241,9 +439,10 @@ class _Game(cmd.Cmd, Combat, Ipc):
             return None
 
         # See if room is already active
-        for oneroom in self.getActiveRoomList():
-            if oneroom.getRoomNum() == roomNum:  # if the room alread exists
-                roomObj = oneroom  # use existing roomObj
+        roomObj = self.getActiveRoom(roomNum)
+
+        if not roomObj:
+            roomObj = self.takeWarmRoom(roomNum, roomType)
 
         if not roomObj:
             roomObj = RoomFactory(roomType, roomNum)  # instanciate room object
@@ -255,6 +454,17 @@ class _Game(cmd.Cmd, Combat, Ipc):
         return roomObj
         # end roomLoader
 
+    def takeWarmRoom(self, roomNum, roomType="room"):
+        """ returns a recently emptied room, with its doors and timers reset
+            (see Room.reactivate), or None """
+        roomObj = self._warmRooms.take(roomNum)
+        if not roomObj:
+            return None
+        if roomObj.getType().lower() != roomType.lower():
+            return None  # i.e. Shop/35 was asked for
+        roomObj.reactivate()
+        return roomObj
+
     def joinRoom(self, roomThing, charObj):
         """ insert player into a room
             * can accept room number or roomObj
@@ -266,8 +476,10 @@ class _Game(cmd.Cmd, Combat, Ipc):
             # roomStr can be a room number or can be in the form Shop/35
         """
         roomObj = None
+        loaded = False
         if isinstance(roomThing, int) or isinstance(roomThing, str):
             roomObj = self.roomLoader(roomThing)
+            loaded = True
         elif isRoomFactoryType(roomThing.getType()):
             roomObj = roomThing
 
@@ -275,6 +487,10 @@ class _Game(cmd.Cmd, Combat, Ipc):
             logger.error("joinRoom: Could not get roomObj")
             return False
 
+        if loaded:
+            # another thread may have activated the room while we loaded it
+            roomObj = self.getActiveRoom(roomObj.getId()) or roomObj
+
         existingRoom = charObj.getRoom()
         if existingRoom:
             if existingRoom == roomObj:  # if already in desired room
@@ -282,9 +498,12 @@ class _Game(cmd.Cmd, Combat, Ipc):
             else:
                 self.leaveRoom(charObj)  # leave the previous room
 
-        charObj.setRoom(roomObj)  # Add room to character
-        roomObj.addCharacter(charObj)  # Add character to room
-        self.addToActiveRooms(roomObj)  # Add room to active room list
+        with self._roomLock:
+            if loaded:
+                roomObj = self.getActiveRoom(roomObj.getId()) or roomObj
+            charObj.setRoom(roomObj)  # Add room to character
+            roomObj.addCharacter(charObj)  # Add character to room
+            self.addToActiveRooms(roomObj)  # Add room to active room list
         return True
 
     def leaveRoom(self, charObj):
@@ -304,12 +523,19 @@ class _Game(cmd.Cmd, Combat, Ipc):
         if charObj.getRoom().getId() == 0:  # Not a real room - just loaded?
             return True
 
-        charObj.getRoom().removeCharacter(charObj)  # remove charact from room
-        # if room's character list is empty, remove room from activeRoomList
-        if len(charObj.getRoom().getCharacterList()) == 0:
-            self.removeFromActiveRooms(charObj.getRoom())
-            charObj.getRoom().removeNonPermanents(removeTmpPermFlag=False)
-        charObj.getRoom().save()
+        roomObj = charObj.getRoom()
+        with self._roomLock:
+            roomObj.removeCharacter(charObj)  # remove charact from room
+            # if room's character list is empty, remove room from activeRoomList
+            emptied = len(roomObj.getCharacterList()) == 0
+            if emptied:
+                self.removeFromActiveRooms(roomObj)
+                roomObj.removeNonPermanents(removeTmpPermFlag=False)
+        roomObj.save()
+        with self._roomLock:
+            # keep it warm, unless someone came in while we were saving
+            if emptied and not self.getActiveRoom(roomObj.getId()):
+                self._warmRooms.put(roomObj, roomObj.getSavedSize())
         charObj.removeRoom()  # Remove room from character
         return True
 
@@ -335,25 +561,22 @@ class _Game(cmd.Cmd, Combat, Ipc):
                 roomObj = None
         return roomObj
 
-    def modifyCorrespondingDoor(self, doorObj, charObj):
+    def modifyCorrespondingDoor(self, doorObj):
         """ When a door is opened/closed on one side, the corresponing door
-            needs to be updated """
-
-        roomObj = self.getCorrespondingRoomObj(doorObj)
-
+            needs to be updated
+            * both sides are recorded in the door state table, which rooms
+              apply when they are loaded, so an inactive room on the other
+              side isn't loaded or saved
+            * if the other room is active, its door is updated in place """
+        state = doorObj.getDoorState()
+        otherDoorId = str(doorObj.getCorresspondingDoorId())
+        doorStates.set({doorObj.getId(): state, otherDoorId: state})
+
+        roomObj = self.getCorrespondingRoomObj(doorObj, activeOnly=True)
         if roomObj:
             for obj in roomObj.getInventory():
-                if obj.getId() == doorObj.getCorresspondingDoorId():
-                    if doorObj.isClosed():
-                        obj.close(charObj)
-                    else:
-                        obj.open(charObj)
-                    if doorObj.isLocked():
-                        obj.lock()
-                    else:
-                        obj.unlock()
-                    roomObj.save()
-            return True
+                if obj.getType() == "Door" and str(obj.getId()) == otherDoorId:
+                    obj.setDoorState(state)
         return True
 
     def buyTransaction(
@@ -369,6 +592,7 @@ class _Game(cmd.Cmd, Combat, Ipc):
                 roomObj.recordTransaction(obj)  # update stats
                 roomObj.recordTransaction("sale/" + str(price))
                 charObj.recordTax(roomObj.getTaxAmount(price))
+            self._persister.flush(charObj)
             self.charMsg(charObj, successTxt)
             logger.info(
                 "PURCHASE "
@@ -396,6 +620,7 @@ class _Game(cmd.Cmd, Combat, Ipc):
                 roomObj.recordTransaction(obj)  # update stats
                 roomObj.recordTransaction("purchase/" + str(price))
                 charObj.recordTax(roomObj.getTaxAmount(price))
+            self._persister.flush(charObj)
             self.charMsg(charObj, successTxt)
             logger.info(
                 "SALE "
@@ -466,13 +691,13 @@ class _Game(cmd.Cmd, Combat, Ipc):
 
         creatureObj = getRandomItemFromList(eligibleCreatureList)
         if creatureObj:
-            roomObj.addToInventory(creatureObj)
+            creatureObj.setEnterRoomTime()  # before it can attack
+            self.addCreatureToRoom(roomObj, creatureObj)
             dLog(
                 debugPrefix + str(creatureObj.describe()) + " added to room",
                 self._instanceDebug,
             )
             self.roomMsg(roomObj, creatureObj.describe() + " has arrived\n")
-            creatureObj.setEnterRoomTime()
             roomObj.setLastEncounter()
         return None
 
@@ -571,10 +796,17 @@ class GameCmd(cmd.Cmd):
         dLog("GAME cmd = " + cmd, self._instanceDebug)
         if self.precmd() == "stop":
             return True
-        stop = self.onecmd(cmd)
-        if self.postcmd(cmd) == "stop":
-            return True
-        return stop
+        return self.gameObj.runInRoom(
+            self.charObj.getRoom(), lambda: self._runcmdInTurn(cmd))
+
+    def _runcmdInTurn(self, cmd):
+        """ the changes that the command made are serialized once, when it's
+            done, while it still has the room's turn """
+        with self.gameObj.getPersister().changing():
+            stop = self.onecmd(cmd)
+            if self.postcmd(cmd) == "stop":
+                return True
+            return stop
 
     def preloop(self):
         """ functionality that get run once before the input loop begins """
@@ -586,7 +818,7 @@ class GameCmd(cmd.Cmd):
         """ cmd method override """
         # If charater has timed out or been booted from the game
         # terminate the command loop.
-        if self.charObj not in self.gameObj.getCharacterList():
+        if not self.gameObj.isActivePlayer(self.charObj):
             return("stop")
         self.charObj.setInputDate()
         if self.lastcmd != "":
@@ -596,7 +828,9 @@ class GameCmd(cmd.Cmd):
     def postcmd(self, line):
         """ cmd method override """
         if self.charObj:  # doesn't exist if there is a suicide
-            self.charObj.save(logStr=__class__.__name__)
+            # copied when the command is done, and saved by the persister's
+            # I/O thread within a few secs
+            self.gameObj.getPersister().markDirty(self.charObj)
         return(False)
 
     def emptyline(self):
@@ -1215,7 +1449,7 @@ class GameCmd(cmd.Cmd):
         if targetObj.close(charObj):
             self.selfMsg("Ok\n")
             if targetObj.getType() == "Door":
-                self.gameObj.modifyCorrespondingDoor(targetObj, charObj)
+                self.gameObj.modifyCorrespondingDoor(targetObj)
             return False
         else:
             self.selfMsg(
@@ -1306,6 +1540,7 @@ class GameCmd(cmd.Cmd):
         prompt += "Continue?"
         if self.client.promptForYN(prompt):
             charObj.bankDeposit(amount, taxRate)
+            self.gameObj.getPersister().flush(charObj)
             roomObj.recordTransaction("deposit/" + str(dAmount))
             roomObj.recordTransaction("fees/" + str(bankfee))
             self.selfMsg(roomObj.getSuccessTxt())
@@ -1701,7 +1936,7 @@ class GameCmd(cmd.Cmd):
 
         itemObj.lock()
         if itemObj.getType() == "Door":
-            self.gameObj.modifyCorrespondingDoor(itemObj, charObj)
+            self.gameObj.modifyCorrespondingDoor(itemObj)
 
         self.selfMsg("Ok\n")
 
@@ -1835,7 +2070,7 @@ class GameCmd(cmd.Cmd):
                 charObj.isHidden(),
             )
             if itemObj.getType() == "Door":
-                self.gameObj.modifyCorrespondingDoor(itemObj, charObj)
+                self.gameObj.modifyCorrespondingDoor(itemObj)
             return False
         else:
             self.selfMsg("You fail to open the door.\n")
@@ -2097,11 +2332,28 @@ class GameCmd(cmd.Cmd):
 
     def do_save(self, line):
         """ save character """
-        if self.client.charObj.save():
+        if self.gameObj.getPersister().flush(self.client.charObj):
             self.selfMsg("Saved\n")
         else:
             self.selfMsg("Could not save\n")
 
+    def do_saveinfo(self, line):
+        """ dm - show the number of saves that were written, and the number
+            that were skipped because nothing had changed
+              * saveinfo json - show the counts as json
+              * saveinfo reset - start over """
+        if not self.charObj.isDm():
+            self.selfMsg("Unknown Command\n")
+            return False
+        if line == "json":
+            self.selfMsg(json.dumps(saveCounts.snapshot(), indent=2) + "\n")
+        elif line == "reset":
+            saveCounts.reset()
+            self.selfMsg("ok\n")
+        else:
+            self.selfMsg(saveCounts.report())
+        return False
+
     def do_say(self, line):
         """ communication within room """
         if line == "":
@@ -2239,13 +2491,13 @@ class GameCmd(cmd.Cmd):
                 + " open.\n",
             )
             self.selfMsg("You smash it open!\n")
-            otherRoom = self.gameObj.getCorrespondingRoomObj(itemObj)
+            otherRoom = self.gameObj.getCorrespondingRoomObj(itemObj, activeOnly=True)
             if otherRoom:
                 self.gameObj.roomMsg(
                     otherRoom, itemObj.getSingular() + " smashes open\n"
                 )
             if itemObj.getType() == "Door":
-                self.gameObj.modifyCorrespondingDoor(itemObj, charObj)
+                self.gameObj.modifyCorrespondingDoor(itemObj)
             return False
         else:
             self.othersMsg(
@@ -2256,7 +2508,7 @@ class GameCmd(cmd.Cmd):
                 + " open.\n",
             )
             self.selfMsg("Bang! You fail to smash it open!\n")
-            otherRoom = self.gameObj.getCorrespondingRoomObj(itemObj)
+            otherRoom = self.gameObj.getCorrespondingRoomObj(itemObj, activeOnly=True)
             if otherRoom:
                 self.gameObj.roomMsg(
                     otherRoom,
@@ -2360,6 +2612,28 @@ class GameCmd(cmd.Cmd):
         """ teach another player a spell """
         self.selfMsg(line + " not implemented yet\n")
 
+    def do_tickinfo(self, line):
+        """ dm - show timing of the game's async tick
+              * tickinfo json - show the metrics as json
+              * tickinfo dump - write the json to the log directory
+              * tickinfo reset - start over """
+        if not self.charObj.isDm():
+            self.selfMsg("Unknown Command\n")
+            return False
+        tickMetrics = self.gameObj.getTickMetrics()
+        if line == "json":
+            self.selfMsg(tickMetrics.toJson() + "\n")
+        elif line == "dump":
+            filename = tickMetrics.dump(
+                os.path.join(common.globals.LOGDIR, "tickMetrics.json"))
+            self.selfMsg("Tick metrics written to " + filename + "\n")
+        elif line == "reset":
+            tickMetrics.reset()
+            self.selfMsg("ok\n")
+        else:
+            self.selfMsg(tickMetrics.report())
+        return False
+
     def do_toggle(self, line):
         """ dm command to set flags """
         if self.charObj.isDm():
@@ -2486,7 +2760,7 @@ class GameCmd(cmd.Cmd):
 
         if itemObj.unlock(keyObj):
             if itemObj.getType() == "Door":
-                self.gameObj.modifyCorrespondingDoor(itemObj, charObj)
+                self.gameObj.modifyCorrespondingDoor(itemObj)
             self.selfMsg("You unlock the lock.\n")
             self.othersMsg(
                 roomObj,
@@ -2667,6 +2941,7 @@ class GameCmd(cmd.Cmd):
         prompt += "Continue?"
         if self.client.promptForYN(prompt):
             charObj.bankWithdraw(amount, taxRate)
+            self.gameObj.getPersister().flush(charObj)
             roomObj.recordTransaction("withdrawl/" + str(wAmount))
             roomObj.recordTransaction("fees/" + str(bankfee))
             self.selfMsg(roomObj.getSuccessTxt())
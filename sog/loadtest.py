@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+""" SoG load test
+
+ Entry point to the load generation harness
+   * Start a number of simulated players (bots)
+   * Each bot logs in, creating its account and character if needed, plays
+     a number of game commands (walk, look, attack, buy...) and logs out
+   * Report latency percentiles, throughput, and error counts
+   * --inprocess runs the bots inside this process against the game, without
+     a server or sockets.  What the bots save goes to a temp dir (or to
+     --datadir), not to the real data dir
+
+Related files:
+   * common/loadLib
+"""
+
+import argparse
+
+from common.loadLib import runLoad
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Load generator for SoG")
+    parser.add_argument("--bots", type=int, default=10,
+                        help="number of simulated players")
+    parser.add_argument("--commands", type=int, default=20,
+                        help="game commands per bot")
+    parser.add_argument("--host", type=str, help="ip of server")
+    parser.add_argument("--port", type=str, help="port of server")
+    parser.add_argument("--inprocess", action="store_true",
+                        help="run the game in this process instead of connecting")
+    parser.add_argument("--ramp", type=float, default=0.0,
+                        help="seconds between bot starts")
+    parser.add_argument("--seed", type=int, help="seed for repeatable runs")
+    parser.add_argument("--runid", type=str,
+                        help="account name prefix (reuse to skip account creation)")
+    parser.add_argument("--datadir", type=str,
+                        help="where --inprocess bots save their accounts" +
+                        " (default: a temp dir that is removed when done)")
+
+    args = parser.parse_args()
+
+    stats = runLoad(args.bots, commands=args.commands, host=args.host,
+                    port=args.port, inProcess=args.inprocess, rampSecs=args.ramp,
+                    runId=args.runid, seed=args.seed, datadir=args.datadir)
+    print(stats.report())
+
+
+main()
@@ -5,6 +5,7 @@ import cmd
 from character import Character
 
 from common.general import logger, dLog
+from common.registry import SessionRegistry
 
 
 class _Lobby:
@@ -15,7 +16,7 @@ class _Lobby:
 
     def __init__(self):
         self.instance = "Instance at %d" % self.__hash__()
-        self.userList = []
+        self.userList = SessionRegistry(lambda acctObj: acctObj.getEmail())
         return None
 
     def joinLobby(self, client, testFlag=False):
@@ -23,31 +24,31 @@ class _Lobby:
         if not client.acctObj:
             return False
 
-        if client.acctObj not in self.userList:
-            self.userList.append(client.acctObj)
+        self.userList.add(client.acctObj)
 
         lobbyCmd = LobbyCmd(client)  # each user gets their own cmd shell
-        try:
-            lobbyCmd.cmdloop()  # start the lobby cmdloop
-        finally:
-            if client.acctObj in self.userList:
-                self.userList.remove(client.acctObj)
+        client.runCmdLoop(lobbyCmd, self.leaveLobby)  # start the lobby cmdloop
+
+    def leaveLobby(self, client):
+        """ Clean up after a client's lobby cmdloop has exited """
+        self.userList.remove(client.acctObj)
 
     def sendMsg(self, client):
+        userList = self.userList.list()
         prompt = "You may send a message to one the the folowing users."
-        prompt += self.showLogins()
+        prompt += self.showLogins(userList)
         prompt += "Who do you want to send a message to? "
-        inNum = client.promptForNumberInput(prompt, len(self.userList))
-        userObj = self.userList[inNum]
+        inNum = client.promptForNumberInput(prompt, len(userList))
+        userObj = userList[inNum]
         prompt = "What is the message? "
         msgBuf = client.promptForInput(prompt, "")
         if userObj.client.spoolOut(msgBuf + "\n"):
             client.spoolOut("Sent\n")
 
-    def showLogins(self):
+    def showLogins(self, userList=None):
         """ show an enumerated list of users """
         buf = "Users:\n"
-        for num, user in enumerate(self.userList):
+        for num, user in enumerate(userList or self.userList.list()):
             buf += "  (" + str(num) + ") " + user.getName() + "\n"
         return buf
 
@@ -82,15 +83,23 @@ class LobbyCmd(cmd.Cmd):
         while not stop:
             if self.client.promptForCommand(self.getCmdPrompt()):  # send/rcv
                 line = self.client.getInputStr()
-                self._lastinput = line
-                dLog("LOBBY cmd = " + line, self.lobbyObj.debug())
-                self.precmd(line)
-                stop = self.onecmd(line)
-                self.postcmd(stop, line)
+                stop = self.runcmd(line)
             else:
                 stop = True
         self.postloop()
 
+    def runcmd(self, line):
+        """ workhorse of cmdloop
+            * runcmd extracted from cmdloop so that a client can drive the
+              loop itself (i.e. the asyncio server) without prompting
+        """
+        self._lastinput = line
+        dLog("LOBBY cmd = " + line, self.lobbyObj.debug())
+        self.precmd(line)
+        stop = self.onecmd(line)
+        self.postcmd(stop, line)
+        return stop
+
     def default(self, line):
         """ cmd method override """
         logger.warn("*** Invalid lobby command: %s\n" % line)
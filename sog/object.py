@@ -7,6 +7,7 @@ import random
 import re
 
 from common.attributes import AttributeHelper
+from common.doorState import doorStates
 from common.general import logger
 from common.inventory import Inventory
 from common.item import Item
@@ -22,6 +23,7 @@ class Object(Item):
     _instanceDebug = False
 
     _fileextension = ".json"
+    _templateCache = True  # see common.templates
 
     # integer attributes
     intAttributes = ["_weight", "_value"]
@@ -1026,6 +1028,27 @@ class Door(Portal, Closable):
     def getCorresspondingDoorId(self):
         return self._correspondingDoorId
 
+    def save(self, logStr=""):
+        """ doors are only saved when they are edited - the edited state
+            replaces the door state table's """
+        if not super().save(logStr):
+            return False
+        doorStates.discard([self.getId()])
+        return True
+
+    def delete(self, logStr=""):
+        if not super().delete(logStr):
+            return False
+        doorStates.discard([self.getId()])
+        return True
+
+    def getDoorState(self):
+        """ (closed, locked) - see common.doorState """
+        return (self.isClosed(), self.isLocked())
+
+    def setDoorState(self, state):
+        self._closed, self._locked = bool(state[0]), bool(state[1])
+
     def examine(self):
         buf = super().examine()
         if self.isClosed():
@@ -7,12 +7,16 @@ import random
 
 # import re
 import textwrap
+import threading
+import time
 
-from common.storage import Storage
+from common.doorState import doorStates
+from common.storage import Storage, getBackend
 from common.attributes import AttributeHelper
 from common.general import getNeverDate, differentDay, secsSinceDate, dateStr
+from common.general import isIntStr
 from common.general import logger, dLog
-from common.inventory import Inventory
+from common.inventory import Inventory, inventoryWriteLock
 from common.item import Item
 from common.globals import DATADIR
 from object import ObjectFactory, Door, isObjectFactoryType
@@ -24,6 +28,7 @@ class Room(Item):
     _instanceDebug = False
 
     _fileextension = ".json"
+    _compactJson = True  # see common.compactJson
 
     _baseEncounterTime = 60
 
@@ -412,12 +417,47 @@ class Room(Item):
         if filename != "":
             self._datafile = filename
 
+    def save(self, logStr=""):
+        """ the saved room has the current state of its doors, so their door
+            state table entries aren't needed any more - unless a door is
+            toggled while we save, which is why the states are taken first """
+        savedDoors = self.getDoorStates()
+        if not super().save(logStr):
+            return False
+        doorStates.discardSaved(savedDoors)
+        return True
+
+    def writeDataFile(self, filename, frozen):
+        super().writeDataFile(filename, frozen)
+        roomTypeIndex.add(self.getRoomNum(), getRoomTypeOfFile(filename))
+
+    def delete(self, logStr=""):
+        self.setDataFilename()
+        roomType = getRoomTypeOfFile(self._datafile)
+        if not super().delete(logStr):
+            return False
+        roomTypeIndex.remove(self.getRoomNum(), roomType)
+        doorStates.discard(list(self.getDoorStates()))
+        return True
+
     def postLoad(self):
         """ Called by the loader - can be used for room initialization """
 
         self.initTmpAttributes()
         self.removeNonPermanents(removeTmpPermFlag=True)
         self.loadPermanents()
+        self.applyDoorStates()
+        self.closeSpringDoors()
+        return True
+
+    def reactivate(self):
+        """ Called when a warm room (see common.registry.WarmRoomCache) is
+            reused - postLoad, without the parts that read from disk
+            * permanents that were taken while the room was warm come back
+              the next time that it's loaded """
+        self.initTmpAttributes()
+        self.removeNonPermanents(removeTmpPermFlag=True)
+        self.applyDoorStates()
         self.closeSpringDoors()
         return True
 
@@ -473,13 +513,19 @@ class Room(Item):
         return characterList
 
     def addCharacter(self, charObj):
-        """ add character to list of characters in room """
-        self._characterList.append(charObj)
+        """ add character to list of characters in room
+            * copy-on-write, like the inventory """
+        with inventoryWriteLock:
+            if charObj not in self._characterList:
+                self._characterList = self._characterList + [charObj]
 
     def removeCharacter(self, charObj):
         """ remove character to list of characters in room """
-        if charObj in self._characterList:
-            self._characterList.remove(charObj)
+        with inventoryWriteLock:
+            if charObj in self._characterList:
+                newList = list(self._characterList)
+                newList.remove(charObj)
+                self._characterList = newList
 
     def getCreatureList(self):
         """ return list of creatures in room """
@@ -536,21 +582,24 @@ class Room(Item):
         self._encounterList = []
 
     def loadPermanents(self):
-        """ Load/instanciate permanents, and add them to the tmp lists """
-        idsOfPermsInRoom = [x.getItemId() for x in self.getInventory()]
-        permList = self.getPermanentList()
-        for perm in self.getPermanents(permList):
-            permId = perm.getItemId()
-            if permId not in idsOfPermsInRoom:
-                dLog(
-                    "loadPermanents: loading perm =" + str(permId), self._instanceDebug
-                )
-                self.addToInventory(perm)
-            else:
+        """ Load/instanciate permanents, and add them to the tmp lists
+            * permanents that are already in the room aren't loaded """
+        idsOfPermsInRoom = [x.getItemId().lower() for x in self.getInventory()]
+        for permId in self.getPermanentList():
+            if permId.lower() in idsOfPermsInRoom:
                 dLog(
                     "loadPermanents: perm " + str(permId) + " already exists in room",
                     self._instanceDebug,
                 )
+                continue
+            perm = self.getPermanent(permId)
+            if not perm:
+                logger.error("Could not add permanent " + permId + " to list")
+                continue
+            dLog(
+                "loadPermanents: loading perm =" + str(permId), self._instanceDebug
+            )
+            self.addToInventory(perm)
         return True
 
     def getPermanents(self, idList=[]):
@@ -611,6 +660,7 @@ class Room(Item):
         """ remove any non permanents from inventory """
         logPrefix = "removeNonPermanents: " + str(self) + str(self.getItemId()) + ": "
         itemsInRoom = self.getInventory().copy()
+        removedItems = False
 
         if removeTmpPermFlag:
             dLog(
@@ -650,14 +700,34 @@ class Room(Item):
                     self._instanceDebug,
                 )
                 self.removeFromInventory(obj)
-                self.save()
+                removedItems = True
+        if removedItems:
+            self.save()
         return True
 
-    def closeSpringDoors(self):
+    def getDoorStates(self):
+        """ {door id: (closed, locked)} for the doors in the room """
+        return {obj.getId(): obj.getDoorState() for obj in self.getInventory()
+                if isinstance(obj, Door)}
+
+    def applyDoorStates(self):
+        """ bring the doors up to date with the door state table, which has
+            the changes that were made from the other side """
         for obj in self.getInventory():
             if isinstance(obj, Door):
-                if obj.hasSpring():
-                    obj.close()
+                doorStates.apply(obj)
+
+    def closeSpringDoors(self):
+        """ spring doors close by themselves.  Both sides are recorded in
+            the door state table, the same as when a player closes a door """
+        for obj in self.getInventory():
+            if isinstance(obj, Door) and obj.hasSpring() and not obj.isClosed():
+                if obj.close():
+                    state = obj.getDoorState()
+                    changes = {obj.getId(): state}
+                    if obj.getCorresspondingDoorId():
+                        changes[obj.getCorresspondingDoorId()] = state
+                    doorStates.set(changes)
 
     def readyForEncounter(self):
         """ returns true if the room is ready for an encounter """
@@ -675,11 +745,7 @@ class Room(Item):
 
         # Check if the appropriate amount of time has pased
         if self._timeOfLastEncounter != getNeverDate():
-            secsSinceLastEncounter = secsSinceDate(self._timeOfLastEncounter)
-            pctRateAdj = (self._encounterRate - 100) / 100
-            secsAdj = self._baseEncounterTime * pctRateAdj + random.randint(-5, 5)
-            secsBetweenEncounters = self._baseEncounterTime - secsAdj
-            timeLeft = int(secsBetweenEncounters - secsSinceLastEncounter)
+            timeLeft = int(self.secsUntilEncounter() - random.randint(-5, 5))
             if timeLeft > 0:
                 dLog(
                     debugPrefix
@@ -699,6 +765,20 @@ class Room(Item):
         dLog(debugPrefix + "Room is ready for encounter", self._instanceDebug)
         return True
 
+    def secsUntilEncounter(self):
+        """ returns the secs until the room is due for an encounter, before
+            the random adjustments that readyForEncounter makes.
+            Negative if the encounter is overdue, and None if the room never
+            has encounters """
+        if not self._encounterRate or not self._encounterList:
+            return None
+        if self._timeOfLastEncounter == getNeverDate():
+            return 0
+        pctRateAdj = (self._encounterRate - 100) / 100
+        secsBetweenEncounters = (self._baseEncounterTime
+                                 - self._baseEncounterTime * pctRateAdj)
+        return secsBetweenEncounters - secsSinceDate(self._timeOfLastEncounter)
+
     def setLastEncounter(self, secs=0):
         self._timeOfLastEncounter = datetime.now() - timedelta(seconds=secs)
 
@@ -1189,16 +1269,108 @@ class Guild(Shop):
 RoomFactoryTypes = ["room", "shop", "guild"]
 
 
+def getRoomTypeDir(roomType):
+    return os.path.abspath(DATADIR + "/" + roomType.capitalize())
+
+
+def getRoomTypeOfFile(filename):
+    """ the room type of a data file (its directory) """
+    return os.path.basename(os.path.dirname(filename)).lower()
+
+
+def probeRoomTypes(num, extension=".json"):
+    """ the types that have a data file for the room number """
+    return {
+        roomType
+        for roomType in RoomFactoryTypes
+        if getBackend().exists(getRoomTypeDir(roomType) + "/" + str(num) + extension)
+    }
+
+
+class RoomTypeIndex:
+    """ Room number -> the types ("room", "shop", "guild") that have a data
+        file for it, so that finding a room's type doesn't probe the data dirs
+        * built on first use, by listing the Room, Shop, and Guild dirs
+        * rooms are added when they are saved, and removed when deleted
+        * a room number that isn't in the index is probed for, so rooms that
+          another process (the editor) creates are found.  Numbers that have
+          no data file are remembered for missingSecs, so looking up a room
+          that doesn't exist doesn't probe every time.  build() starts over,
+          i.e. if the editor deletes rooms """
+
+    def __init__(self, extension=".json", missingSecs=60, clock=time.monotonic):
+        self.extension = extension
+        self.missingSecs = missingSecs
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._types = None  # roomNum -> set of room types
+        self._missing = {}  # roomNum -> time it was found to have no data file
+
+    def build(self):
+        """ scan the data dirs - returns the number of rooms found """
+        types = {}
+        for roomType in RoomFactoryTypes:
+            for name in getBackend().listDir(getRoomTypeDir(roomType)):
+                num, ext = os.path.splitext(name)
+                if ext == self.extension and isIntStr(num):
+                    types.setdefault(int(num), set()).add(roomType)
+        with self._lock:
+            self._types = types
+            self._missing.clear()
+        return len(types)
+
+    def getType(self, num):
+        """ the room's type, in RoomFactoryTypes order, or "room" if there
+            is no data file for it """
+        found = None
+        with self._lock:
+            built = self._types is not None
+            if built:
+                found = self._types.get(num)
+            if found is None and built and num in self._missing:
+                if self._clock() - self._missing[num] < self.missingSecs:
+                    return "room"
+                del self._missing[num]
+        if not built:
+            self.build()
+            return self.getType(num)
+        if found is None:
+            found = probeRoomTypes(num, self.extension)
+            with self._lock:
+                if found:
+                    self._types.setdefault(num, set()).update(found)
+                else:
+                    self._missing[num] = self._clock()
+        for roomType in RoomFactoryTypes:
+            if roomType in found:
+                return roomType
+        return "room"
+
+    def add(self, num, roomType):
+        with self._lock:
+            self._missing.pop(num, None)
+            if self._types is not None:
+                self._types.setdefault(num, set()).add(roomType)
+
+    def remove(self, num, roomType):
+        with self._lock:
+            if self._types is not None and num in self._types:
+                self._types[num].discard(roomType)
+                if not self._types[num]:
+                    del self._types[num]
+
+
+roomTypeIndex = RoomTypeIndex()
+
+
 def getRoomTypeFromFile(num, extension=".json"):
-    returnType = "room"
+    if extension == roomTypeIndex.extension:
+        return roomTypeIndex.getType(int(num))
+    found = probeRoomTypes(num, extension)
     for roomType in RoomFactoryTypes:
-        filename = os.path.abspath(
-            DATADIR + "/" + roomType.capitalize() + "/" + str(num) + extension
-        )
-        if os.path.isfile(filename):
-            returnType = roomType
-            break
-    return returnType
+        if roomType in found:
+            return roomType
+    return "room"
 
 
 def isRoomFactoryType(item):
@@ -3,7 +3,9 @@
 # import selectors
 from signal import signal, SIGINT, SIGTERM
 
+from common.asyncServerLib import asyncServer
 from common.general import sig_handler
+import common.globals
 from common.serverLib import server
 
 # -------------
@@ -14,4 +16,7 @@ if __name__ == "__main__":
     print("Running. Press CTRL-C to exit.  (might wait for a connection)")
 
     # Run the server
-    server()
+    if common.globals.SERVER_ENGINE == "asyncio":
+        asyncServer()
+    else:
+        server()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+""" SoG storage tool
+
+ Manage the storage backend (see common/storage and common/sqliteStorage)
+   * migrate - one-shot copy of the data files under DATADIR into the SQLite
+     database (SOG_SERVER_STORAGE_DB).  The files are left in place.  Run
+     the server with SOG_SERVER_STORAGE=sqlite to use the database
+   * bench - compare load and save latency of the file and SQLite backends,
+     using a copy of DATADIR in a temp dir
+   * compact - convert the room files to the compact json format (see
+     common/compactJson) in one go.  Rooms in the old jsonpickle format are
+     also converted whenever they are saved
+   * roombench - compare load and save latency, and size, of the jsonpickle
+     and compact formats, using the rooms under DATADIR
+
+Related files:
+   * common/sqliteStorage
+   * common/compactJson
+"""
+
+import argparse
+import os
+import sys
+
+import common.compactJson
+import common.globals
+from common.sqliteStorage import SqliteBackend, benchmark, migrate
+from common.storage import FileBackend, getBackend, groupCommit
+
+ROOM_KINDS = ["Room", "Shop", "Guild"]
+
+
+def doMigrate(args):
+    backend = SqliteBackend(args.db, common.globals.DATADIR, fallback=FileBackend())
+    existing = backend.count()
+    if existing and not args.force:
+        print("{} already has {} objects - use --force to copy over them".format(
+            args.db, existing))
+        return 1
+    copied = migrate(common.globals.DATADIR, backend)
+    print("Copied {} objects from {} to {} ({} in the database)".format(
+        copied, common.globals.DATADIR, args.db, backend.count()))
+    backend.close()
+    return 0
+
+
+def doBench(args):
+    results = benchmark(common.globals.DATADIR, FileBackend,
+                        iterations=args.iterations, limit=args.limit)
+    print("Storage latency in ms ({} iterations)".format(args.iterations))
+    printLatencies("backend", results)
+    return 0
+
+
+def printLatencies(title, results):
+    ROW_FORMAT = "  {0:10} {1:5}: {2:>8} {3:>8} {4:>8} {5:>8} {6:>8}"
+    print(ROW_FORMAT.format(title, "op", "count", "mean", "p50", "p95", "max"))
+    for name, ops in results.items():
+        for op in ["load", "save"]:
+            summary = ops[op]
+            print(ROW_FORMAT.format(
+                name, op, summary["count"], summary["mean"], summary["p50"],
+                summary["p95"], summary["max"]))
+
+
+def getRoomFiles(limit=None):
+    """ the data files of all of the rooms, from the current backend """
+    filenames = []
+    for kind in ROOM_KINDS:
+        roomDir = os.path.join(common.globals.DATADIR, kind)
+        filenames += [os.path.join(roomDir, name)
+                      for name in getBackend().listDir(roomDir)
+                      if name.endswith(".json") and not name.startswith(".")]
+    return filenames[:limit]
+
+
+def doCompact(args):
+    converted = 0
+    filenames = getRoomFiles()
+    with groupCommit():
+        for filename in filenames:
+            text = getBackend().read(filename, binary=False)
+            compactText = common.compactJson.convert(text)
+            if compactText is None:
+                print("Skipping {} - not a room".format(filename))
+            elif compactText != text:
+                getBackend().write(filename, compactText)
+                converted += 1
+    print("Converted {} of {} room files to the compact format".format(
+        converted, len(filenames)))
+    return 0
+
+
+def doRoomBench(args):
+    texts = [getBackend().read(filename, binary=False)
+             for filename in getRoomFiles(args.limit)]
+    results = common.compactJson.benchmark(texts, iterations=args.iterations)
+    print("Room serializer latency in ms ({} rooms, {} iterations)".format(
+        len(texts), args.iterations))
+    printLatencies("format", results)
+    for name, result in results.items():
+        print("  {0:10} size : {1:>8} bytes".format(name, result["bytes"]))
+    return 0
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Storage tool for SoG")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    migrateParser = subparsers.add_parser(
+        "migrate", help="copy the data files into the SQLite database")
+    migrateParser.add_argument("--db", type=str, default=common.globals.STORAGE_DB,
+                               help="database file")
+    migrateParser.add_argument("--force", action="store_true",
+                               help="migrate even if the database has objects")
+    migrateParser.set_defaults(func=doMigrate)
+
+    benchParser = subparsers.add_parser(
+        "bench", help="compare file and SQLite load/save latency")
+    benchParser.add_argument("--iterations", type=int, default=3,
+                             help="times to load and save each object")
+    benchParser.add_argument("--limit", type=int,
+                             help="max number of objects to use")
+    benchParser.set_defaults(func=doBench)
+
+    compactParser = subparsers.add_parser(
+        "compact", help="convert the room files to the compact json format")
+    compactParser.set_defaults(func=doCompact)
+
+    roomBenchParser = subparsers.add_parser(
+        "roombench", help="compare jsonpickle and compact room load/save latency")
+    roomBenchParser.add_argument("--iterations", type=int, default=3,
+                                 help="times to load and save each room")
+    roomBenchParser.add_argument("--limit", type=int,
+                                 help="max number of rooms to use")
+    roomBenchParser.set_defaults(func=doRoomBench)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+sys.exit(main())
@@ -0,0 +1,101 @@
+""" test_actors """
+import threading
+import time
+import unittest
+
+from common.actors import ActorQueues
+from common.testLib import TestGameBase
+
+
+class TestActorQueues(TestGameBase):
+    def setUp(self):
+        self.banner("start", testName=__class__.__name__)
+        self.actors = ActorQueues(workers=4)
+
+    def tearDown(self):
+        self.actors.shutdown()
+        self.banner("end")
+
+    def testPostedWorkRunsInOrder(self):
+        ran = []
+
+        def work(num):
+            time.sleep(0.001)
+            ran.append(num)
+            return num
+
+        futures = [self.actors.post("room1", lambda num=num: work(num))
+                   for num in range(20)]
+        assert [future.result(10) for future in futures] == list(range(20))
+        assert ran == list(range(20))
+        assert not self.actors.isBusy("room1")
+
+    def testKeysRunInParallel(self):
+        """ a key that is stuck doesn't hold up the other keys """
+        release = threading.Event()
+        stuck = self.actors.post("room1", lambda: release.wait(10))
+        other = self.actors.post("room2", lambda: "done")
+        assert other.result(10) == "done"
+        assert not stuck.done()
+        release.set()
+        assert stuck.result(10)
+
+    def testCallWaitsForItsTurn(self):
+        events = []
+        release = threading.Event()
+
+        def slowWork():
+            release.wait(10)
+            events.append("posted")
+
+        self.actors.post("room1", slowWork)
+        callThread = threading.Thread(
+            target=lambda: events.append(
+                self.actors.call("room1", lambda: "called")), daemon=True)
+        callThread.start()
+        time.sleep(0.05)
+        assert events == []
+        release.set()
+        callThread.join(10)
+        assert events == ["posted", "called"]
+
+    def testCallIsReentrant(self):
+        result = self.actors.call(
+            "room1", lambda: self.actors.call("room1", lambda: "inner"))
+        assert result == "inner"
+        assert not self.actors.isBusy("room1")
+
+    def testYieldTurn(self):
+        """ work for the key runs while the caller has given up its turn,
+            and the caller gets the turn back before it goes on """
+        events = []
+
+        def caller():
+            with self.actors.yieldTurn():
+                self.actors.post("room1", lambda: events.append("posted")).result(10)
+            later = self.actors.post("room1", lambda: events.append("later"))
+            events.append("back")
+            return later
+
+        later = self.actors.call("room1", caller)
+        assert later.result(10) is None
+        assert events == ["posted", "back", "later"]
+        with self.actors.yieldTurn():  # no turns to give up
+            pass
+        assert not self.actors.isBusy("room1")
+
+    def testFailedWorkDoesNotBlockTheQueue(self):
+        def badWork():
+            raise ValueError("bad")
+
+        failed = self.actors.post("room1", badWork)
+        after = self.actors.post("room1", lambda: "ok")
+        assert after.result(10) == "ok"
+        assert isinstance(failed.exception(10), ValueError)
+        with self.assertRaises(ValueError):
+            self.actors.call("room1", badWork)
+        assert not self.actors.isBusy("room1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,189 @@
+""" test_asyncServer """
+import asyncio
+import socket
+import threading
+import time
+import unittest
+
+import mock
+
+from common.asyncServerLib import AsyncClient, _AsyncServer
+import common.framing as framing
+from common.general import Terminator
+from common.serverLib import haltAsyncThread
+import common.globals
+from common.testLib import TestGameBase
+
+
+class TestAsyncServer(TestGameBase):
+    def setUp(self):
+        self.banner("start", testName=__class__.__name__)
+        # raw clients don't send the framing preamble - don't wait long for it
+        patcher = mock.patch.object(common.globals, "FRAME_HANDSHAKE_TIMEOUT", 0.05)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.banner("end")
+
+    def startServer(self):
+        """ start the asyncio server in a separate thread on a random port """
+        svr = _AsyncServer()
+
+        def runServer():
+            try:
+                asyncio.run(svr.main())
+            except Terminator:
+                pass
+
+        with mock.patch.object(common.globals, "PORT", 0):
+            svrThread = threading.Thread(target=runServer, daemon=True)
+            svrThread.start()
+            assert svr.ready.wait(10), "async server did not start"
+        return (svr, svrThread)
+
+    def stopServer(self, svr, svrThread):
+        svr.stop()
+        svrThread.join(10)
+        haltAsyncThread(None, svr.asyncThread)
+        assert not svrThread.is_alive()
+
+    def recvUntil(self, sock, txt):
+        """ read until txt shows up (str) or until the server hangs up """
+        data = b""
+        target = txt.encode("utf-8") if isinstance(txt, str) else txt
+        while not target or target not in data:
+            chunk = sock.recv(common.globals.BYTES_TO_TRANSFER)
+            if not chunk:
+                break
+            data += chunk
+        if isinstance(txt, str):
+            return data.decode("utf-8")
+        return data
+
+    def testConnectAndQuit(self):
+        """ Connect, get the login prompt, and quit at the email prompt """
+        svr, svrThread = self.startServer()
+        try:
+            with socket.create_connection(("127.0.0.1", svr.port), 10) as sock:
+                out = self.recvUntil(sock, "Enter email address")
+                assert "Sog Server" in out
+                assert len(common.globals.connections) == 1
+                sock.sendall(str.encode(common.globals.NOOP_STR))
+                out = self.recvUntil(sock, common.globals.TERM_STR)
+                assert out == common.globals.TERM_STR
+                assert len(common.globals.connections) == 0
+        finally:
+            self.stopServer(svr, svrThread)
+
+    def testSessionCleanupRunsInAWorker(self):
+        """ leaving the game doesn't run on the event loop thread """
+        cleanupThreads = []
+        closeSession = AsyncClient.closeSession
+
+        cleanedUp = threading.Event()
+
+        def recordThread(client):
+            cleanupThreads.append(threading.current_thread().name)
+            closeSession(client)
+            cleanedUp.set()
+
+        svr, svrThread = self.startServer()
+        try:
+            with mock.patch.object(AsyncClient, "closeSession", recordThread):
+                with socket.create_connection(("127.0.0.1", svr.port), 10) as sock:
+                    self.recvUntil(sock, "Enter email address")
+                    sock.sendall(str.encode(common.globals.NOOP_STR))
+                    out = self.recvUntil(sock, common.globals.TERM_STR)
+                    assert out == common.globals.TERM_STR
+                assert cleanedUp.wait(10)
+            assert len(cleanupThreads) == 1
+            assert cleanupThreads[0].startswith("sogWorker")
+        finally:
+            self.stopServer(svr, svrThread)
+
+    def testFramedConnectAndQuit(self):
+        """ Same as above, but using the framed protocol """
+        svr, svrThread = self.startServer()
+        try:
+            with socket.create_connection(("127.0.0.1", svr.port), 10) as sock:
+                sock.sendall(framing.PREAMBLE)
+                decoder = framing.FrameDecoder()
+                data = self.recvUntil(sock, b"email address")
+                assert data.startswith(framing.PREAMBLE)  # handshake ack
+                frames = decoder.feed(data[len(framing.PREAMBLE):])
+                assert frames[0][0] == framing.DATA
+                assert "Sog Server" in frames[0][1]
+                sock.sendall(framing.encodeFrame(framing.NOOP))
+                frames = decoder.feed(self.recvUntil(sock, b""))
+                assert frames == [(framing.TERM, "")]
+                assert len(common.globals.connections) == 0
+        finally:
+            self.stopServer(svr, svrThread)
+
+    def testFramedPush(self):
+        """ Output spooled while a framed client is at a prompt is pushed """
+        svr, svrThread = self.startServer()
+        try:
+            with socket.create_connection(("127.0.0.1", svr.port), 10) as sock:
+                sock.sendall(framing.PREAMBLE)
+                decoder = framing.FrameDecoder()
+                data = self.recvUntil(sock, b"quit: ")
+                decoder.feed(data[len(framing.PREAMBLE):])
+                client = common.globals.connections.list()[0]
+                client.spoolOut("The ogre snarls\n")  # from the test thread
+                frames = []
+                while not frames:
+                    frames = decoder.feed(
+                        sock.recv(common.globals.BYTES_TO_TRANSFER))
+                assert frames == [(framing.PUSH, "\nThe ogre snarls\n" +
+                                   client.acctObj.emailPrompt)]
+        finally:
+            self.stopServer(svr, svrThread)
+
+    def testStuckClientIsDropped(self):
+        """ A client that stops reading is dropped once the output waiting
+            for it passes the high water mark """
+        svr, svrThread = self.startServer()
+        try:
+            with mock.patch.object(common.globals, "SPOOL_HIGH_WATER", 4096):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+                sock.settimeout(10)
+                sock.connect(("127.0.0.1", svr.port))
+                with sock:
+                    sock.sendall(framing.PREAMBLE)
+                    self.recvUntil(sock, b"quit: ")
+                    client = common.globals.connections.list()[0]
+                    # the client stops reading
+                    deadline = time.monotonic() + 10
+                    while client.isRunning() and time.monotonic() < deadline:
+                        client.spoolOut("x" * 1000 + "\n")
+                        time.sleep(0.001)
+                    assert not client.isRunning()
+                    assert client not in common.globals.connections
+        finally:
+            self.stopServer(svr, svrThread)
+
+    def testManyIdleConnections(self):
+        """ Idle connections are held by the event loop, not by threads """
+        svr, svrThread = self.startServer()
+        socks = []
+        try:
+            threadCount = threading.active_count()
+            for num in range(50):
+                sock = socket.create_connection(("127.0.0.1", svr.port), 10)
+                socks.append(sock)
+                self.recvUntil(sock, "Enter email address")
+            assert len(common.globals.connections) == 50
+            # connections waiting at the login prompt don't hold a worker
+            assert threading.active_count() <= (
+                threadCount + common.globals.ASYNC_WORKERS)
+        finally:
+            for sock in socks:
+                sock.close()
+            self.stopServer(svr, svrThread)
+
+
+if __name__ == "__main__":
+    unittest.main()
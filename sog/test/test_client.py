@@ -0,0 +1,76 @@
+""" test_client """
+import argparse
+import os
+import socket
+import sys
+import threading
+import unittest
+
+import mock
+
+from common.clientLib import Client
+import common.framing as framing
+import common.globals
+from common.testLib import TestGameBase
+
+
+class TestClient(TestGameBase):
+    def setUp(self):
+        self.banner("start", testName=__class__.__name__)
+
+    def tearDown(self):
+        self.banner("end")
+
+    def recvFrames(self, sock, decoder):
+        frames = []
+        while not frames:
+            frames = decoder.feed(sock.recv(common.globals.BYTES_TO_TRANSFER))
+        return frames
+
+    @unittest.skipIf(os.name == "nt", "select on stdin requires posix")
+    def testSelectLoop(self):
+        """ output is shown as it arrives and input is sent as it's typed """
+        svrSock, cliSock = socket.socketpair()
+        svrSock.settimeout(10)
+        stdinRead, stdinWrite = os.pipe()
+        args = argparse.Namespace(username="", password="")
+        clientObj = Client()
+        clientObj.socket = cliSock
+        clientObj.setSelectMode(True)
+        decoder = framing.FrameDecoder()
+
+        # framing handshake, with the first prompt right behind the ack
+        svrSock.sendall(framing.PREAMBLE +
+                        framing.encodeFrame(framing.DATA, "<game> "))
+        assert clientObj.startFraming()
+        assert svrSock.recv(len(framing.PREAMBLE)) == framing.PREAMBLE
+
+        with open(stdinRead, "r") as fakeStdin:
+            with mock.patch.object(sys, "stdin", fakeStdin):
+                loopThread = threading.Thread(
+                    target=clientObj.selectLoop, args=(args,), daemon=True)
+                loopThread.start()
+                try:
+                    # two lines typed at once - the second is held until
+                    # the server responds to the first
+                    os.write(stdinWrite, b"look\nsouth\n")
+                    assert self.recvFrames(svrSock, decoder) == [
+                        (framing.DATA, "look")]
+                    svrSock.sendall(
+                        framing.encodeFrame(framing.PUSH, "\nA rat arrives\n") +
+                        framing.encodeFrame(framing.DATA, "A room\n<game> "))
+                    assert self.recvFrames(svrSock, decoder) == [
+                        (framing.DATA, "south")]
+
+                    svrSock.sendall(framing.encodeFrame(framing.TERM))
+                    loopThread.join(10)
+                    assert not loopThread.is_alive()
+                    assert not clientObj.isRunning()
+                finally:
+                    os.close(stdinWrite)
+                    svrSock.close()
+                    cliSock.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
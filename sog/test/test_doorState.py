@@ -0,0 +1,115 @@
+""" test_doorState """
+import os
+import tempfile
+import time
+import unittest
+
+from common.doorState import DoorStateTable
+from common.persister import WriteBehind
+from common.testLib import TestGameBase
+
+
+class FakeDoor:
+    def __init__(self, id):
+        self.id = id
+        self.state = (False, False)
+
+    def getId(self):
+        return self.id
+
+    def setDoorState(self, state):
+        self.state = state
+
+
+class TestDoorStateTable(TestGameBase):
+    def setUp(self):
+        self.banner("start", testName=__class__.__name__)
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.dirname = os.path.join(self.tmpDir.name, "DoorState")
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+        self.banner("end")
+
+    def read(self, doorId):
+        with open(os.path.join(self.dirname, str(doorId) + ".json"), "r") as fh:
+            return fh.read()
+
+    def testSetAndGet(self):
+        table = DoorStateTable(self.dirname, WriteBehind(maxStaleness=60))
+        assert table.get(5) is None
+        assert table.set({5: (True, True), "6": (True, False)})
+        assert not table.set({5: (True, True)})  # unchanged
+        assert table.set({5: (True, False)})
+        assert table.set({5: (True, True)})
+        assert table.writes == 0  # written behind, not by the toggles
+        assert table.get("5") == (True, True)
+        assert table.flush()
+        assert table.writes == 1
+        assert sorted(os.listdir(self.dirname)) == ["5.json", "6.json"]
+        assert self.read(5) == "[true,true]"
+        assert self.read(6) == "[true,false]"
+
+        # a new table (i.e. after a restart) reads the files
+        doorObj = FakeDoor(6)
+        assert DoorStateTable(self.dirname).apply(doorObj)
+        assert doorObj.state == (True, False)
+        assert not table.apply(FakeDoor(7))
+
+    def testOnlyChangedDoorsAreWritten(self):
+        table = DoorStateTable(self.dirname, WriteBehind(maxStaleness=60))
+        table.set({5: (True, False), 6: (True, False)})
+        assert table.flush()
+        os.remove(os.path.join(self.dirname, "6.json"))
+        table.set({5: (False, False)})
+        assert table.freeze()[1] == {"5": (False, False)}
+        assert table.flush()
+        assert self.read(5) == "[false,false]"
+        assert os.listdir(self.dirname) == ["5.json"]  # 6 wasn't rewritten
+        assert table.freeze()[1] == {}
+
+    def testFailedWriteIsKept(self):
+        """ changes stay pending until a copy of them has been written """
+        table = DoorStateTable(self.dirname, WriteBehind(maxStaleness=60))
+        table.set({5: (True, False)})
+        olderCopy = table.freeze()
+        table.set({5: (False, False)})
+        table.writeFrozen(olderCopy)  # i.e. written just before the toggle
+        assert table.freeze()[1] == {"5": (False, False)}
+        assert table.flush()
+        assert table.freeze()[1] == {}
+
+    def testWrittenBehind(self):
+        """ toggles are coalesced, and written by the persister's thread """
+        table = DoorStateTable(self.dirname, WriteBehind(maxStaleness=0.05))
+        for num in range(20):
+            table.set({5: (num % 2 == 0, False)})
+        deadline = time.monotonic() + 5
+        while not table.writes and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        assert table.writes == 1
+        assert DoorStateTable(self.dirname).get(5) == (False, False)
+
+    def testDiscard(self):
+        table = DoorStateTable(self.dirname, WriteBehind(maxStaleness=60))
+        table.set({5: (True, False), 6: (False, False)})
+        assert table.discard([5, 7]) == 1
+        assert table.get(5) is None
+        assert table.flush()
+        assert os.listdir(self.dirname) == ["6.json"]
+        assert table.discard([6]) == 1
+        assert table.flush()
+        assert os.listdir(self.dirname) == []
+
+    def testDiscardSaved(self):
+        """ entries are dropped once the room is saved with the same state """
+        table = DoorStateTable(self.dirname, WriteBehind(maxStaleness=60))
+        table.set({5: (True, False), 6: (False, False)})
+        assert table.discardSaved({5: (True, False), 6: (True, True)}) == 1
+        assert table.get(5) is None
+        assert table.get(6) == (False, False)  # toggled since it was saved
+
+
+if __name__ == "__main__":
+    unittest.main()
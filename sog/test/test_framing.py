@@ -0,0 +1,283 @@
+""" test_framing """
+import socket
+import time
+import unittest
+
+import mock
+
+from common.clientLib import Client
+import common.framing as framing
+import common.globals
+from common.testLib import TestGameBase
+from threads import ClientThread
+
+
+class TestFraming(TestGameBase):
+    def setUp(self):
+        self.banner("start", testName=__class__.__name__)
+
+    def tearDown(self):
+        self.banner("end")
+
+    def testDecoderReassembly(self):
+        """ Frames split across, or combined within, recvs are reassembled """
+        bigStr = "x" * (common.globals.BYTES_TO_TRANSFER * 3) + "\n"
+        data = (framing.encodeFrame(framing.DATA, bigStr)
+                + framing.encodeFrame(framing.NOOP)
+                + framing.encodeFrame(framing.DATA, "héllo"))
+        decoder = framing.FrameDecoder()
+        frames = []
+        for num in range(0, len(data), 1000):
+            frames += decoder.feed(data[num:num + 1000])
+        assert frames == [(framing.DATA, bigStr), (framing.NOOP, ""),
+                          (framing.DATA, "héllo")]
+        assert decoder.pending() == 0
+
+        # partial header is held until the rest arrives
+        frame = framing.encodeFrame(framing.TERM)
+        assert decoder.feed(frame[:2]) == []
+        assert decoder.pending() == 2
+        assert decoder.feed(frame[2:]) == [(framing.TERM, "")]
+
+    def testDecoderErrors(self):
+        decoder = framing.FrameDecoder(maxFrameSize=10)
+        with self.assertRaises(framing.FrameError):
+            decoder.feed(framing.encodeFrame(framing.DATA, "x" * 11))
+        with self.assertRaises(framing.FrameError):
+            framing.FrameDecoder().feed(b"\x63\x00\x00\x00\x00")
+
+    def testLegacyMapping(self):
+        for txt in [common.globals.NOOP_STR, common.globals.TERM_STR,
+                    common.globals.STOP_STR, "look"]:
+            assert framing.toLegacy(*framing.fromLegacy(txt)) == txt
+        assert framing.fromLegacy(common.globals.TERM_STR) == (framing.TERM, "")
+        assert framing.preambleStatus(framing.PREAMBLE + b"x") is True
+        assert framing.preambleStatus(framing.PREAMBLE[:3]) is None
+        assert framing.preambleStatus(b"hello") is False
+
+    def testFramedClientThread(self):
+        """ Client and ClientThread negotiate framing and talk over it """
+        svrSock, cliSock = socket.socketpair()
+        clientThread = ClientThread(svrSock, ("test", 0),
+                                    common.globals.connections.nextId())
+        common.globals.connections.add(clientThread)
+        clientThread.start()
+
+        clientObj = Client()
+        clientObj.setSelectMode(False)  # receiveData reads from receiver thread
+        clientObj.socket = cliSock
+        cliSock.settimeout(10)
+        try:
+            assert clientObj.startFraming()
+            assert clientObj.isFramed()
+            assert clientObj.receiveData()
+            assert "Enter email address" in clientObj.output
+            assert clientThread.isFramed()
+
+            clientObj.input = "notAnEmail"
+            assert clientObj.sendData()
+            assert clientObj.receiveData()
+            assert "Invalid Email address" in clientObj.output
+            assert "Enter email address" in clientObj.output
+
+            clientObj.input = common.globals.TERM_STR
+            assert clientObj.sendData()
+            assert clientObj.receiveData()
+            assert clientObj.output == common.globals.TERM_STR
+            clientThread.join(10)
+            assert not clientThread.is_alive()
+            assert clientThread not in common.globals.connections
+        finally:
+            clientThread.terminateClientConnection()
+            cliSock.close()
+
+    def testPushToIdleClient(self):
+        """ Output spooled while a framed client is at a prompt is pushed """
+        svrSock, cliSock = socket.socketpair()
+        clientThread = ClientThread(svrSock, ("test", 0),
+                                    common.globals.connections.nextId())
+        common.globals.connections.add(clientThread)
+        clientThread.start()
+
+        cliSock.settimeout(10)
+        decoder = framing.FrameDecoder()
+        try:
+            cliSock.sendall(framing.PREAMBLE)
+            data = b""
+            while not data.endswith(b"Enter email address or [enter] to quit: "):
+                data += cliSock.recv(common.globals.BYTES_TO_TRANSFER)
+            frames = decoder.feed(data[len(framing.PREAMBLE):])
+            assert frames[-1][0] == framing.DATA
+
+            clientThread.spoolOut("You are hit!\n")
+            frames = []
+            while not frames:
+                frames = decoder.feed(cliSock.recv(common.globals.BYTES_TO_TRANSFER))
+            assert frames == [(framing.PUSH, "\nYou are hit!\n" +
+                               "Enter email address or [enter] to quit: ")]
+            assert clientThread._outputSpool.empty()
+
+            # raw clients don't get pushes
+            clientThread._framed = False
+            clientThread.spoolOut("Not pushed\n")
+            clientThread._framed = True
+            assert clientThread.outputSpoolContains("Not pushed")
+        finally:
+            clientThread.terminateClientConnection()
+            cliSock.close()
+
+    def startSmallBufferClient(self):
+        """ start a framed ClientThread whose socket buffers are small, and
+            return (clientThread, cliSock) once it is at the login prompt """
+        svrSock, cliSock = socket.socketpair()
+        svrSock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        cliSock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        clientThread = ClientThread(svrSock, ("test", 0),
+                                    common.globals.connections.nextId())
+        common.globals.connections.add(clientThread)
+        clientThread.start()
+        cliSock.settimeout(10)
+        cliSock.sendall(framing.PREAMBLE)
+        data = b""
+        while not data.endswith(b"to quit: "):
+            data += cliSock.recv(common.globals.BYTES_TO_TRANSFER)
+        return (clientThread, cliSock)
+
+    def testBackedUpPushIsSentLater(self):
+        """ A push that doesn't fit in the socket is finished by the push
+            thread once the client reads, without blocking the push """
+        svrSock, cliSock = socket.socketpair()
+        svrSock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        cliSock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        cliSock.settimeout(10)
+        # no session thread - the client is sitting at a prompt
+        clientThread = ClientThread(svrSock, ("test", 0),
+                                    common.globals.connections.nextId())
+        clientThread._startProtocol(True, b"")
+        clientThread._awaitingInput = True
+        clientThread._lastPrompt = b"> "
+        try:
+            lines = ["line {}: {}\n".format(num, "x" * 1000) for num in range(100)]
+            for line in lines:
+                clientThread._outputSpool.put(line)
+            assert not clientThread.pushOutput()  # returns right away
+            assert clientThread.hasUnsentOutput()
+            clientThread.requestPush()  # let the push thread finish it
+            decoder = framing.FrameDecoder()
+            frames = []
+            while not frames:
+                frames = decoder.feed(cliSock.recv(common.globals.BYTES_TO_TRANSFER))
+            assert frames == [(framing.PUSH, "\n" + "".join(lines) + "> ")]
+            assert clientThread.isRunning()
+            deadline = time.monotonic() + 10
+            while clientThread.hasUnsentOutput() and time.monotonic() < deadline:
+                time.sleep(0.01)  # the push thread is finishing up
+            assert not clientThread.hasUnsentOutput()
+        finally:
+            svrSock.close()
+            cliSock.close()
+
+    def testStuckClientIsDropped(self):
+        """ A client that stops reading is disconnected once its unsent
+            output has waited for SEND_TIMEOUT secs, and the push thread
+            never blocks on it """
+        with mock.patch.object(common.globals, "SEND_TIMEOUT", 0.2):
+            clientThread, cliSock = self.startSmallBufferClient()
+            try:
+                # the client stops reading
+                for num in range(100):
+                    clientThread._outputSpool.put("x" * 1000 + "\n")
+                clientThread.requestPush()
+                clientThread.join(10)
+                assert not clientThread.is_alive()
+                assert clientThread not in common.globals.connections
+            finally:
+                clientThread.terminateClientConnection()
+                cliSock.close()
+
+    def testBackedUpClientIsDropped(self):
+        """ A client whose unsent output passes the high water mark is
+            disconnected right away """
+        clientThread, cliSock = self.startSmallBufferClient()
+        try:
+            with mock.patch.object(common.globals, "SPOOL_HIGH_WATER", 16384):
+                for num in range(10):
+                    clientThread.spoolOut("x" * 10000 + "\n")
+                clientThread.join(10)
+                assert not clientThread.is_alive()
+                assert clientThread not in common.globals.connections
+        finally:
+            clientThread.terminateClientConnection()
+            cliSock.close()
+
+    def testRawClientThread(self):
+        """ A client that doesn't send the preamble gets the raw protocol """
+        svrSock, cliSock = socket.socketpair()
+        clientThread = ClientThread(svrSock, ("test", 0),
+                                    common.globals.connections.nextId())
+        common.globals.connections.add(clientThread)
+        with mock.patch.object(common.globals, "FRAME_HANDSHAKE_TIMEOUT", 0.05):
+            clientThread.start()
+
+            cliSock.settimeout(10)
+            try:
+                data = cliSock.recv(common.globals.BYTES_TO_TRANSFER)
+                assert data.decode("utf-8").startswith("Sog Server")
+                assert not clientThread.isFramed()
+                cliSock.sendall(str.encode(common.globals.TERM_STR))
+                data = cliSock.recv(common.globals.BYTES_TO_TRANSFER)
+                assert data.decode("utf-8") == common.globals.TERM_STR
+                clientThread.join(10)
+                assert not clientThread.is_alive()
+            finally:
+                clientThread.terminateClientConnection()
+                cliSock.close()
+
+    def testRawClientThatSendsFirst(self):
+        """ A client whose first bytes aren't the preamble doesn't wait out
+            the handshake timeout """
+        svrSock, cliSock = socket.socketpair()
+        clientThread = ClientThread(svrSock, ("test", 0),
+                                    common.globals.connections.nextId())
+        common.globals.connections.add(clientThread)
+        with mock.patch.object(common.globals, "FRAME_HANDSHAKE_TIMEOUT", 30):
+            cliSock.sendall(b"hello\n")  # i.e. typed into telnet
+            startTime = time.monotonic()
+            clientThread.start()
+
+            cliSock.settimeout(10)
+            try:
+                data = cliSock.recv(common.globals.BYTES_TO_TRANSFER)
+                assert data.decode("utf-8").startswith("Sog Server")
+                assert time.monotonic() - startTime < 10
+                assert not clientThread.isFramed()
+            finally:
+                clientThread.terminateClientConnection()
+                cliSock.close()
+
+    def testFramedClientWithOlderServer(self):
+        """ A server that talks first gets the raw protocol, and never sees
+            the preamble """
+        svrSock, cliSock = socket.socketpair()
+        svrSock.settimeout(10)
+        clientObj = Client()
+        clientObj.setSelectMode(False)
+        clientObj.socket = cliSock
+        cliSock.settimeout(10)
+        try:
+            svrSock.sendall(b"Sog Server\nEnter email address: ")
+            assert clientObj.startFraming()
+            assert not clientObj.isFramed()
+            assert clientObj.receiveData()
+            assert "Enter email address" in clientObj.output
+
+            clientObj.input = "a@b.com"
+            assert clientObj.sendData()
+            assert svrSock.recv(common.globals.BYTES_TO_TRANSFER) == b"a@b.com"
+        finally:
+            svrSock.close()
+            cliSock.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,12 @@
 """ test_game """
+import json
+import random
+import threading
 import unittest
+from unittest import mock
 
 from common.testLib import TestGameBase
+from common.doorState import doorStates
 from common.general import logger
 
 # import object
@@ -35,12 +40,250 @@ class TestGame(TestGameBase):
     # gameObj.asyncNonPlayerActions()
     # gameObj.asyncCharacterActions()
 
+    def _hopBetweenRooms(self, gameObj, charObj, rooms, seed, errors):
+        rng = random.Random(seed)
+        try:
+            for num in range(60):
+                gameObj.joinRoom(rng.choice(rooms), charObj)
+                if rng.randint(1, 4) == 1:
+                    gameObj.leaveRoom(charObj)
+            gameObj.leaveRoom(charObj)
+        except Exception as e:
+            errors.append(e)
+
+    def _tickUntil(self, gameObj, stopEvent, errors):
+        while not stopEvent.is_set():
+            try:
+                gameObj.asyncTasks()
+                for roomObj in gameObj.getActiveRoomList():
+                    gameObj.deActivateEmptyRoom(roomObj)
+            except Exception as e:
+                errors.append(e)
+
+    def testConcurrentJoinAndLeave(self):
+        """ characters hop between rooms while the async tick runs """
+        gameObj = self.getGameObj()
+        rooms = [self.createRoom(num) for num in self._tmpTestRoomNumbers[:3]]
+        charObjs = [self.createCharacter(name="hopper" + str(num))
+                    for num in range(6)]
+        errors = []
+        stopEvent = threading.Event()
+
+        tickThread = threading.Thread(
+            target=self._tickUntil, args=(gameObj, stopEvent, errors), daemon=True)
+        tickThread.start()
+        hopThreads = [
+            threading.Thread(target=self._hopBetweenRooms,
+                             args=(gameObj, charObj, rooms, num, errors), daemon=True)
+            for num, charObj in enumerate(charObjs)]
+        for hopThread in hopThreads:
+            hopThread.start()
+        for hopThread in hopThreads:
+            hopThread.join(60)
+        stopEvent.set()
+        tickThread.join(10)
+
+        assert not errors, errors
+        for roomObj in rooms:
+            assert roomObj.getCharacterList() == []
+            assert not gameObj.isActiveRoom(roomObj)
+
     def testEncounter(self):
         self.joinRoom(15)
         roomObj = self.getRoomObj()
         gameObj = self.getGameObj()
         gameObj.creatureEncounter(roomObj)
 
+    def testRoomActors(self):
+        """ with room actors, room tasks run on the room's queue and then
+            reschedule themselves """
+        gameObj = self.getGameObj()
+        scheduler = gameObj.getScheduler()
+        gameObj.enableRoomActors(workers=2)
+        try:
+            self.joinRoom(15)
+            roomObj = self.getRoomObj()
+            key = ("encounter", roomObj)
+            gameObj.scheduleRoomTask(key, 0, gameObj.encounterTask)
+            gameObj.asyncTasks()  # posts the encounter to the room's queue
+            gameObj.runInRoom(roomObj, lambda: None)  # waits for it to finish
+            assert key in scheduler
+            assert scheduler.secsUntilDue(key) > 0
+
+            gameCmdObj = self.getGameCmdObj()
+            assert not gameCmdObj.runcmd("look")
+            assert not gameObj.getRoomActors().isBusy(roomObj.getId())
+        finally:
+            gameObj.disableRoomActors()
+        assert gameObj.runInRoom(roomObj, lambda: "direct") == "direct"
+
+    def testPostedRoomTaskKeepsItsKey(self):
+        """ a room task that is waiting in the room's queue can't be
+            scheduled a second time """
+        gameObj = self.getGameObj()
+        scheduler = gameObj.getScheduler()
+        blocker = threading.Event()
+        gameObj.enableRoomActors(workers=2)
+        try:
+            self.joinRoom(15)
+            roomObj = self.getRoomObj()
+            key = ("encounter", roomObj)
+            gameObj.getRoomActors().post(roomObj.getId(), blocker.wait)
+            gameObj.scheduleRoomTask(key, 0, gameObj.encounterTask)
+            gameObj.asyncTasks()  # posted, but it waits behind the blocker
+            assert key in scheduler
+            assert not gameObj.scheduleRoomTask(
+                key, 0, gameObj.encounterTask, replace=False)
+            blocker.set()
+            gameObj.runInRoom(roomObj, lambda: None)  # waits for the task
+            assert scheduler.secsUntilDue(key) > 0
+        finally:
+            blocker.set()
+            gameObj.disableRoomActors()
+
+    def testPromptGivesUpTheRoomsTurn(self):
+        """ a player who is answering a prompt doesn't hold up the room's
+            posted tasks """
+        gameObj = self.getGameObj()
+        scheduler = gameObj.getScheduler()
+        charObj = self.getCharObj()
+        prompting, answer = threading.Event(), threading.Event()
+        results = []
+
+        def slowAnswer():
+            prompting.set()
+            answer.wait(10)
+            charObj.client.setInputStr("y")
+            return True
+
+        gameObj.enableRoomActors(workers=2)
+        try:
+            self.joinRoom(15)
+            roomObj = self.getRoomObj()
+            roomActors = gameObj.getRoomActors()
+            with mock.patch.object(charObj.client, "_sendAndReceive",
+                                   side_effect=slowAnswer):
+                cmdThread = threading.Thread(target=lambda: results.append(
+                    gameObj.runInRoom(
+                        roomObj, lambda: charObj.client.promptForYN("Sure?"))),
+                    daemon=True)
+                cmdThread.start()
+                assert prompting.wait(10)
+                key = ("encounter", roomObj)
+                gameObj.scheduleRoomTask(key, 0, gameObj.encounterTask)
+                gameObj.asyncTasks()  # posted while the prompt is pending
+                assert roomActors.post(roomObj.getId(), lambda: "ran").result(10)
+                assert scheduler.secsUntilDue(key) > 0  # the task has run
+                assert results == []  # still waiting for the answer
+                answer.set()
+                cmdThread.join(10)
+            assert results == [True]
+            assert not roomActors.isBusy(roomObj.getId())
+        finally:
+            answer.set()
+            gameObj.disableRoomActors()
+
+    def testWarmRooms(self):
+        """ emptied rooms are reactivated without loading them again """
+        gameObj = self.getGameObj()
+        warmRooms = gameObj.getWarmRooms()
+        roomNum = self._tmpTestRoomNumbers[0]
+        roomObj = self.createRoom(roomNum)
+        doorObj = self.createObject(num=99999, type="Door", name="door")
+        doorObj._permanent = True
+        doorObj._spring = True
+        roomObj.addToInventory(doorObj)
+        self.joinRoom(roomObj)
+        assert self.getRoomObj() is roomObj
+        self.joinRoom(self._testRoomNum)  # empties the room, which is saved
+        assert not gameObj.isActiveRoom(roomObj)
+
+        doorObj._closed = False
+        hits = warmRooms.snapshot()["hits"]
+        with mock.patch("room.Room.getPermanent", side_effect=AssertionError):
+            assert gameObj.roomLoader(roomNum) is roomObj  # nothing is loaded
+        assert warmRooms.snapshot()["hits"] == hits + 1
+        assert doorObj.isClosed()  # reinitialized the same as a load
+
+        # the taken room isn't warm any more, so this comes from disk
+        assert gameObj.roomLoader(roomNum) is not roomObj
+
+    def testScheduledTasks(self):
+        """ active rooms and players schedule their own async tasks """
+        gameObj = self.getGameObj()
+        charObj = self.getCharObj()
+        scheduler = gameObj.getScheduler()
+        assert ("timeout", charObj) in scheduler
+        assert ("vitals", charObj) in scheduler
+
+        self.joinRoom(15)
+        roomObj = self.getRoomObj()
+        assert ("encounter", roomObj) in scheduler
+        gameObj.encounterTask(roomObj)
+        if roomObj.getCreatureList():
+            assert ("creatures", roomObj) in scheduler
+
+        gameObj.removeFromActiveRooms(roomObj)
+        assert ("encounter", roomObj) not in scheduler
+        assert ("creatures", roomObj) not in scheduler
+        gameObj.removeFromActivePlayerList(charObj)
+        assert ("timeout", charObj) not in scheduler
+        assert ("vitals", charObj) not in scheduler
+
+    def testPoisonReschedulesVitals(self):
+        """ poison doesn't wait for the next regen """
+        gameObj = self.getGameObj()
+        charObj = self.getCharObj()
+        scheduler = gameObj.getScheduler()
+        scheduler.schedule(("vitals", charObj), 60, lambda: None)
+        charObj.setPoisoned()
+        assert scheduler.secsUntilDue(("vitals", charObj)) == 0
+        scheduler.schedule(("vitals", charObj), 60, lambda: None)
+        charObj.setPoisoned()  # already poisoned
+        assert scheduler.secsUntilDue(("vitals", charObj)) > 0
+        charObj.setPoisoned(False)
+
+    def testGameHooks(self):
+        """ players save through the game's persister while they're in the
+            game, and right away once they leave """
+        gameObj = self.getGameObj()
+        charObj = self.getCharObj()
+        persister = gameObj.getPersister()
+        persister.discard(charObj)
+        charObj.persist()
+        assert persister.isDirty(charObj)
+        assert persister.flush(charObj)
+
+        gameObj.removeFromActivePlayerList(charObj)
+        with mock.patch.object(charObj, "save", return_value=True) as save:
+            assert charObj.persist()
+            save.assert_called_once_with()
+        assert not persister.isDirty(charObj)
+        charObj.setPoisoned()  # nothing to reschedule
+        charObj.setPoisoned(False)
+        gameObj.addToActivePlayerList(charObj)
+        assert ("vitals", charObj) in gameObj.getScheduler()
+
+    def testCreatureTasks(self):
+        """ creatures attack in any room that they're in, once it's active """
+        gameObj = self.getGameObj()
+        scheduler = gameObj.getScheduler()
+        roomNum = self._tmpTestRoomNumbers[0]
+        roomObj = self.createRoom(roomNum)
+        self.joinRoom(roomObj)
+        assert ("creatures", roomObj) not in scheduler
+        creObj = self.createCreature()
+        creObj._permanent = True  # i.e. a guard
+        gameObj.addCreatureToRoom(roomObj, creObj)
+        assert ("creatures", roomObj) in scheduler
+
+        # rooms that are reactivated with creatures in them
+        self.joinRoom(self._testRoomNum)
+        assert ("creatures", roomObj) not in scheduler
+        self.joinRoom(roomNum)
+        assert self.getRoomObj() is roomObj  # from the warm rooms
+        assert ("creatures", roomObj) in scheduler
+
 
 class TestGameCmd(TestGameBase):
 
@@ -53,6 +296,63 @@ class TestGameCmd(TestGameBase):
     doorTrapAttributes = doorLockAttributes + [
         "_traplevel", "_poison", "_toll"]
 
+    def testGameCmdSavesAreWrittenBehind(self):
+        """ commands mark the character dirty instead of saving it """
+        gameObj = self.getGameObj()
+        gameCmdObj = self.getGameCmdObj()
+        charObj = self.getCharObj()
+        persister = gameObj.getPersister()
+        persister.discard(charObj)
+        assert not gameCmdObj.runcmd("look")
+        assert persister.isDirty(charObj)
+        assert persister.flush(charObj)
+        assert not persister.isDirty(charObj)
+
+        # copied once, on this thread, when the command is done, so the I/O
+        # thread never serializes a character that is being changed
+        charClass = type(charObj)
+        with mock.patch.object(charClass, "freeze", autospec=True,
+                               side_effect=charClass.freeze) as freeze:
+            assert not gameCmdObj.runcmd("look")
+            assert freeze.call_args_list == [mock.call(charObj)]
+            persister.flushAll()
+            assert not persister.isDirty(charObj)
+            assert mock.call(charObj) not in freeze.call_args_list[1:]
+
+        # so do money and damage, which go through the persister too
+        charObj.addCoins(10)
+        charObj.takeDamage(0)
+        assert persister.isDirty(charObj)
+        assert persister.flush(charObj)
+
+    def testGameCmdTickInfo(self):
+        gameObj = self.getGameObj()
+        gameCmdObj = self.getGameCmdObj()
+        charObj = self.getCharObj()
+        gameObj.asyncTasks()
+
+        assert not gameCmdObj.do_tickinfo("")
+        assert "Unknown Command" in charObj.client.popOutSpool()
+        charObj.setDm()
+        gameCmdObj.do_tickinfo("")
+        assert "Tick metrics" in charObj.client.popOutSpool()
+        gameCmdObj.do_tickinfo("json")
+        assert json.loads(charObj.client.popOutSpool())["ticks"] >= 1
+
+    def testGameCmdSaveInfo(self):
+        gameCmdObj = self.getGameCmdObj()
+        charObj = self.getCharObj()
+        charObj.setDm()
+        gameCmdObj.do_saveinfo("reset")
+        charObj.client.popOutSpool()
+        charObj.save()
+        charObj.save()
+        gameCmdObj.do_saveinfo("json")
+        counts = json.loads(charObj.client.popOutSpool())["classes"]["Character"]
+        assert counts["skipped"] >= 1
+        gameCmdObj.do_saveinfo("")
+        assert "skipped" in charObj.client.popOutSpool()
+
     def testGameCmdInstanciation(self):
         gameCmdObj = self.getGameCmdObj()
         out = "Could not instanciate the gameCmd object"
@@ -208,6 +508,54 @@ class TestGameCmd(TestGameBase):
         roomObj2.addToInventory(doorObj2)
         return roomObj1, roomObj2, doorObj1, doorObj2
 
+    def testDoorsInInactiveRooms(self):
+        """ the far side of a door is updated without loading its room """
+        gameObj = self.getGameObj()
+        gameCmdObj = self.getGameCmdObj()
+        (roomObj1, roomObj2, doorObj1, doorObj2) = self.doorTestSetUp()
+        assert roomObj2.save()
+        self.joinRoom(room=roomObj1)
+        assert not gameObj.isActiveRoom(roomObj2)
+
+        with mock.patch.object(gameObj, "roomLoader", side_effect=AssertionError):
+            assert not gameCmdObj.do_close("door1")
+        assert doorObj1.isClosed()
+        assert doorStates.get(99996) == (True, False)
+        assert doorStates.get(99997) == (True, False)
+
+        loadedRoom = gameObj.roomLoader(99993)
+        loadedDoor = loadedRoom.getInventoryByType("Door")[0]
+        assert loadedDoor.getId() == 99996
+        assert loadedDoor.isClosed()
+
+        # the room file has the state once the room is saved
+        assert loadedRoom.save()
+        assert doorStates.get(99996) is None
+        assert doorStates.get(99997) == (True, False)
+
+    def testDoorEditsReplaceDoorStates(self):
+        """ editing or deleting a door or room drops its door states """
+        (roomObj1, roomObj2, doorObj1, doorObj2) = self.doorTestSetUp()
+        doorStates.set({99996: (True, False), 99997: (True, True)})
+        with mock.patch("common.storage.Storage.save", return_value=True):
+            assert doorObj1.save()  # i.e. from the editor
+        assert doorStates.get(99997) is None
+        assert roomObj2.save()  # saved while the door was open
+        assert doorStates.get(99996) == (True, False)
+        assert roomObj2.delete()
+        assert doorStates.get(99996) is None
+
+    def testSpringDoorsUpdateDoorStates(self):
+        """ a spring door that closes when its room loads closes both sides """
+        (roomObj1, roomObj2, doorObj1, doorObj2) = self.doorTestSetUp()
+        doorObj2._spring = True
+        assert roomObj2.save()
+        loadedRoom = self.createRoom(num=99993)
+        assert loadedRoom.load()
+        assert loadedRoom.getInventoryByType("Door")[0].isClosed()
+        assert doorStates.get(99996) == (True, False)
+        assert doorStates.get(99997) == (True, False)
+
     def testDoorsInActiveRooms(self):
         ''' Set up a pair of doors and verify that door actions work '''
         gameObj = self.getGameObj()
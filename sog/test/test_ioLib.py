@@ -0,0 +1,123 @@
+""" test_ioLib """
+import socket
+import threading
+import unittest
+
+from common.ioLib import OutputBuffer, lastLine, sendChunks, sendNoWait
+from common.testLib import TestGameBase
+
+
+class TestIoLib(TestGameBase):
+    def setUp(self):
+        self.banner("start", testName=__class__.__name__)
+
+    def tearDown(self):
+        self.banner("end")
+
+    def testOutputBuffer(self):
+        buf = OutputBuffer()
+        assert buf.empty()
+        buf.put("You hit the ")
+        buf.put("orc\n")
+        buf.put(42)
+        assert buf.size() == len("You hit the orc\n42")
+        assert buf.contains("orc")
+        assert not buf.contains("goblin")
+        assert buf.pop() == "You hit the orc\n42"
+        assert buf.empty()
+        assert buf.size() == 0
+        assert buf.pop() == ""
+
+    def testOutputBufferHasMsg(self):
+        """ exact match lookups, including messages with regex characters """
+        buf = OutputBuffer(highWater=30)
+        buf.put("Others arrive (?), but wander off.\n")
+        assert buf.hasMsg("Others arrive (?), but wander off.\n")
+        assert not buf.hasMsg("Others arrive")
+        buf.put("x" * 25)  # pushes the first message out
+        assert not buf.hasMsg("Others arrive (?), but wander off.\n")
+        buf.put("x" * 2)
+        buf.put("x" * 2)
+        assert buf.hasMsg("xx")
+        buf.pop()
+        assert not buf.hasMsg("xx")
+
+    def testOutputBufferHighWater(self):
+        """ oldest chunks are dropped once the buffer is over the limit """
+        buf = OutputBuffer(highWater=10)
+        for num in range(10):
+            buf.put(str(num) * 4)
+        assert buf.size() <= 10
+        assert buf.pop() == "[output truncated]\n88889999"
+        buf.put("0000")
+        assert buf.pop() == "0000"  # nothing was dropped this time
+
+        # a single message that is bigger than the limit is kept
+        buf.put("x" * 20)
+        assert buf.pop() == "x" * 20
+
+    def testLastLine(self):
+        assert lastLine([b"line1\n", b"<game", b"> "]) == b"<game> "
+        assert lastLine([b"line1\nline2\n"]) == b""
+        assert lastLine([b"no newline"]) == b"no newline"
+        assert lastLine([]) == b""
+
+    def testSendChunks(self):
+        """ all chunks arrive intact and in order, even with partial sends """
+        chunks = [(str(num) * 1000).encode("utf-8") for num in range(300)]
+        chunks.append(b"")
+        expected = b"".join(chunks)
+        svrSock, cliSock = socket.socketpair()
+        received = bytearray()
+
+        def reader():
+            while len(received) < len(expected):
+                data = cliSock.recv(65536)
+                if not data:
+                    break
+                received.extend(data)
+
+        readerThread = threading.Thread(target=reader, daemon=True)
+        readerThread.start()
+        try:
+            sendChunks(svrSock, chunks)
+            readerThread.join(10)
+            assert bytes(received) == expected
+        finally:
+            svrSock.close()
+            cliSock.close()
+
+    def testSendChunksTimeout(self):
+        """ a send to a peer that isn't reading gives up at the deadline """
+        svrSock, cliSock = socket.socketpair()
+        try:
+            with self.assertRaises(socket.timeout):
+                sendChunks(svrSock, [b"x" * 65536] * 100, timeout=0.1)
+            assert svrSock.gettimeout() is None  # still a blocking socket
+        finally:
+            svrSock.close()
+            cliSock.close()
+
+    def testSendNoWait(self):
+        """ sends what the peer will take, and hands back the rest """
+        chunks = [(str(num % 10) * 1000).encode("utf-8") for num in range(1000)]
+        expected = b"".join(chunks)
+        svrSock, cliSock = socket.socketpair()
+        cliSock.settimeout(10)
+        try:
+            left = sendNoWait(svrSock, chunks)
+            assert left  # more than fits in the socket buffers
+            received = bytearray()
+            while left:
+                received.extend(cliSock.recv(65536))
+                left = sendNoWait(svrSock, left)
+            while len(received) < len(expected):
+                received.extend(cliSock.recv(65536))
+            assert bytes(received) == expected
+        finally:
+            svrSock.close()
+            cliSock.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+""" test_loadLib """
+import os
+import tempfile
+import unittest
+
+from common.general import logger
+import common.globals
+from common.loadLib import BotBrain, LoadStats, runLoad, cleanupAccounts
+from common.testLib import TestGameBase
+
+
+class TestLoadLib(TestGameBase):
+    def setUp(self):
+        self.banner("start", testName=__class__.__name__)
+        self.runId = "ut" + str(common.globals.connections.nextId())
+        self.addCleanup(cleanupAccounts, self.runId)
+
+    def tearDown(self):
+        self.banner("end")
+
+    def testBrain(self):
+        brain = BotBrain(0, self.runId, commands=1, actions=["look"])
+        assert brain.respond("Welcome\nEnter email address: ") == brain.email
+        assert brain.respond("Create new account? [y/N]: ") == "y"
+        assert brain.respond("[lobby] ") == "play"
+        assert brain.respond("A room\n<game> ") == "look"
+        assert brain.respond("<game> ") == "exit"
+        assert brain.respond("[lobby] ") == "quit"
+        assert brain.respond("Enter email address: ") is None
+        assert brain.isDone()
+
+    def testStats(self):
+        stats = LoadStats()
+        for num in range(1, 101):
+            stats.record(num / 1000)
+        stats.error("command")
+        stats.stop()
+        assert stats.getCommandCount() == 100
+        assert stats.percentile(50) in [0.050, 0.051]
+        assert stats.percentile(100) == 0.1
+        assert "Errors          : 1" in stats.report()
+
+    def testInProcessLoad(self):
+        """ a few bots create accounts and characters, and play the game """
+        stats = runLoad(3, commands=5, inProcess=True, runId=self.runId, seed=1)
+        logger.info(stats.report())
+        assert stats.botsFinished == 3
+        assert stats.getCommandCount() > 0
+        assert "login" not in stats.getErrors()
+        for client in common.globals.connections:
+            assert not str(client).startswith("IB")
+        # the accounts were saved to a temp dir, not to the real data dir
+        assert cleanupAccounts(self.runId) == 0
+
+    def testInProcessLoadDataDir(self):
+        """ bots save their accounts in the given data dir """
+        with tempfile.TemporaryDirectory() as datadir:
+            stats = runLoad(1, commands=1, inProcess=True, runId=self.runId,
+                            seed=1, datadir=datadir)
+            assert stats.botsFinished == 1
+            accounts = os.listdir(os.path.join(datadir, "Account"))
+            assert "loadbot{}-0@example.com".format(self.runId) in accounts
+        assert cleanupAccounts(self.runId) == 0
+
+
+if __name__ == "__main__":
+    unittest.main()
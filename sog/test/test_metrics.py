@@ -0,0 +1,104 @@
+""" test_metrics """
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from common.metrics import latencySummary, RollingHistogram, TickMetrics
+from common.testLib import TestGameBase
+
+
+class TestMetrics(TestGameBase):
+    def setUp(self):
+        self.banner("start", testName=__class__.__name__)
+
+    def tearDown(self):
+        self.banner("end")
+
+    def testRollingHistogram(self):
+        hist = RollingHistogram(window=10)
+        for num in range(20):
+            hist.add(num / 1000)
+        data = hist.snapshot()
+        assert data["count"] == 20
+        assert data["window"] == 10  # only the last 10 samples
+        assert data["max"] == 19.0
+        assert sum(data["buckets"].values()) == 10
+        assert data["buckets"]["<=10"] == 1
+        assert data["buckets"]["<=25"] == 9
+
+    def testLatencySummary(self):
+        assert latencySummary([])["count"] == 0
+        data = latencySummary([num / 1000 for num in range(10, 0, -1)])
+        assert data == {"count": 10, "mean": 5.5, "p50": 5.0, "p95": 10.0,
+                        "max": 10.0}
+
+    def testTickPhases(self):
+        tickMetrics = TickMetrics(budgetSecs=0.01, slowSecs=0.005)
+        with tickMetrics.tick():
+            for num in range(3):  # i.e. once per room
+                with tickMetrics.phase("encounter"):
+                    time.sleep(0.005)
+        with tickMetrics.tick():
+            with tickMetrics.phase("regen"):
+                pass
+        tickMetrics.recordLag(0.2)
+
+        data = json.loads(tickMetrics.toJson())
+        assert data["ticks"] == 2
+        assert data["overruns"] == 1
+        assert data["slowTicks"] == 1
+        assert data["lastLagMs"] == 200.0
+        # phase times are totals per tick
+        assert data["phases"]["encounter"]["max"] >= 15
+        assert data["phases"]["encounter"]["count"] == 2
+        assert "creaturesAttack" in tickMetrics.report()
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            filename = tickMetrics.dump(os.path.join(tmpDir, "tick.json"))
+            with open(filename) as filehandle:
+                assert json.load(filehandle)["ticks"] == 2
+
+        tickMetrics.reset()
+        assert tickMetrics.snapshot()["ticks"] == 0
+
+    def testPhasesOnOtherThreads(self):
+        """ work handed to another thread is credited to the tick that it
+            was handed off in """
+        tickMetrics = TickMetrics(budgetSecs=1, slowSecs=1)
+        lateStart = threading.Event()
+
+        def worker(tickTimes, phaseName, waitFor=None):
+            if waitFor:
+                waitFor.wait(10)
+            with tickMetrics.forTick(tickTimes):
+                with tickMetrics.phase(phaseName):
+                    time.sleep(0.005)
+
+        with tickMetrics.tick():
+            tickTimes = tickMetrics.currentTick()
+            onTime = threading.Thread(target=worker,
+                                      args=(tickTimes, "encounter"))
+            late = threading.Thread(target=worker,
+                                    args=(tickTimes, "regen", lateStart))
+            onTime.start()
+            late.start()
+            onTime.join(10)
+        with tickMetrics.tick():  # the next tick has none of its phases
+            pass
+        lateStart.set()
+        late.join(10)
+        assert tickMetrics.currentTick() is None
+
+        phases = tickMetrics.snapshot()["phases"]
+        assert phases["encounter"]["count"] == 2
+        assert phases["encounter"]["max"] >= 5
+        # the late phase is recorded on its own, instead of in a later tick
+        assert phases["regen"]["count"] == 3
+        assert phases["regen"]["max"] >= 5
+
+
+if __name__ == "__main__":
+    unittest.main()
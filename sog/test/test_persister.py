@@ -0,0 +1,179 @@
+""" test_persister """
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from common.persister import WriteBehind
+from common.storage import atomicWrite
+from common.testLib import TestGameBase
+
+
+class FakeStorage:
+    """ counts saves, and can be told to fail """
+
+    def __init__(self, name):
+        self.name = name
+        self.state = 0
+        self.saves = 0
+        self.written = None
+        self.saved = threading.Event()
+        self.raiseOnSave = False
+        self.raiseOnFreeze = 0
+        self.freezes = 0
+        self.filename = None  # if set, the save is written there
+
+    def __str__(self):
+        return self.name
+
+    def freeze(self):
+        self.freezes += 1
+        if self.raiseOnFreeze:
+            self.raiseOnFreeze -= 1
+            raise RuntimeError("dictionary changed size during iteration")
+        return self.state
+
+    def writeFrozen(self, frozen):
+        if self.raiseOnSave:
+            raise OSError("disk full")
+        if self.filename:
+            atomicWrite(self.filename, str(frozen), "transaction")
+        self.saves += 1
+        self.written = frozen
+        self.saved.set()
+        return True
+
+
+class TestWriteBehind(TestGameBase):
+    def setUp(self):
+        self.banner("start", testName=__class__.__name__)
+        self.persister = WriteBehind(maxStaleness=0.05)
+
+    def tearDown(self):
+        self.persister.stop()
+        self.banner("end")
+
+    def testSavesAreCoalesced(self):
+        obj = FakeStorage("char1")
+        for num in range(50):
+            self.persister.markDirty(obj)
+        assert self.persister.isDirty(obj)
+        assert obj.saved.wait(5)
+        time.sleep(0.1)
+        assert obj.saves == 1
+        assert obj.freezes == 1  # serialized once, for the coalesced save
+        assert not self.persister.isDirty(obj)
+        assert self.persister.marks == 50
+        assert self.persister.saves == 1
+
+    def testFlushSavesRightAway(self):
+        obj = FakeStorage("char1")
+        self.persister.markDirty(obj)
+        assert self.persister.flush(obj)
+        assert obj.saves == 1
+        assert not self.persister.isDirty(obj)
+        assert self.persister.flush(obj)  # saved, even though it's not dirty
+        assert obj.saves == 2
+
+    def testDiscardAndStop(self):
+        persister = WriteBehind(maxStaleness=60)
+        kept, discarded = FakeStorage("kept"), FakeStorage("discarded")
+        persister.markDirty(kept)
+        persister.markDirty(discarded)
+        persister.discard(discarded)
+        assert persister.getDirtyCount() == 1
+        assert persister.stop() == 1
+        assert kept.saves == 1
+        assert discarded.saves == 0
+
+    def testFailedSaveIsRetried(self):
+        obj = FakeStorage("char1")
+        obj.raiseOnSave = True
+        assert not self.persister.flush(obj)
+        assert self.persister.isDirty(obj)
+        assert self.persister.failures == 1
+        obj.raiseOnSave = False
+        assert obj.saved.wait(5)
+        assert obj.saves == 1
+
+    def testFailedCommitIsRetried(self):
+        persister = WriteBehind(maxStaleness=60)
+        tmpDir = tempfile.TemporaryDirectory()
+        obj = FakeStorage("char1")
+        obj.filename = os.path.join(tmpDir.name, "char1.json")
+        os.makedirs(os.path.join(obj.filename, "notEmpty"))  # can't replace
+        persister.markDirty(obj)
+        assert persister.flushAll() == 0
+        assert persister.isDirty(obj)
+        assert persister.saves == 0
+        assert persister.failures == 1
+        os.rmdir(os.path.join(obj.filename, "notEmpty"))
+        os.rmdir(obj.filename)
+        assert persister.stop() == 1
+        with open(obj.filename, "r") as filehandle:
+            assert filehandle.read() == "0"
+        tmpDir.cleanup()
+
+    def testCopyIsTakenWhenDue(self):
+        """ marking obj dirty doesn't serialize it - the I/O thread takes a
+            copy when the save is due, and an older copy is never written
+            over a newer one """
+        persister = WriteBehind(maxStaleness=60)
+        obj = FakeStorage("char1")
+        obj.state = 1
+        persister.markDirty(obj)
+        obj.state = 2  # changed after it was marked
+        assert obj.freezes == 0
+        assert persister.stop() == 1
+        assert obj.written == 2
+
+        olderCopy = persister._freeze(obj)
+        obj.state = 3
+        assert persister.flush(obj)
+        assert obj.written == 3
+        assert persister._write(obj, olderCopy)  # skipped
+        assert obj.written == 3
+        assert obj.saves == 2
+
+    def testChangesAreCopiedByTheBlock(self):
+        """ objs marked dirty in a changing() block are copied once, when
+            it exits, on the thread that changed them """
+        persister = WriteBehind(maxStaleness=60)
+        obj, flushed = FakeStorage("char1"), FakeStorage("char2")
+        with persister.changing():
+            with persister.changing():  # part of the outer block
+                obj.state = 1
+                persister.markDirty(obj)
+            obj.state = 2
+            persister.markDirty(obj)
+            persister.markDirty(flushed)
+            assert persister.flush(flushed)  # nothing left to copy
+            assert not persister.isDirty(obj)
+            assert obj.freezes == 0
+        assert persister.isDirty(obj)
+        assert obj.freezes == 1
+        assert flushed.freezes == 1
+        obj.state = 3  # i.e. changed by another thread, after the copy
+        assert persister.stop() == 1
+        assert obj.written == 2
+        assert obj.freezes == 1  # the I/O thread didn't serialize it
+
+    def testFreezeIsRetried(self):
+        obj = FakeStorage("char1")
+        obj.raiseOnFreeze = 2
+        assert self.persister.flush(obj)
+        obj.raiseOnFreeze = 10
+        assert not self.persister.flush(obj)
+        assert self.persister.failures == 1
+
+    def testWriteThrough(self):
+        persister = WriteBehind(maxStaleness=0)
+        obj = FakeStorage("char1")
+        persister.markDirty(obj)
+        assert obj.saves == 1
+        assert persister.getDirtyCount() == 0
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,194 @@
+""" test_registry """
+import unittest
+
+from common.registry import ConnectionRegistry, RoomRegistry, SessionRegistry
+from common.registry import WarmRoomCache
+from common.testLib import TestGameBase
+
+
+class FakeClient:
+    def __init__(self, id):
+        self.id = id
+        self.msgs = []
+
+    def getId(self):
+        return self.id
+
+    def spoolOut(self, txt):
+        self.msgs.append(txt)
+
+
+class FakeRoom:
+    def __init__(self, num):
+        self.num = num
+
+    def getId(self):
+        return self.num
+
+
+class FakeChar:
+    def __init__(self, name, email):
+        self.name = name
+        self.email = email
+
+    def getId(self):
+        return self.email + "/" + self.name
+
+    def getName(self):
+        return self.name
+
+    def getAcctName(self):
+        return self.email
+
+
+class TestRegistry(TestGameBase):
+    def setUp(self):
+        self.banner("start", testName=__class__.__name__)
+
+    def tearDown(self):
+        self.banner("end")
+
+    def testIdsAreNeverReused(self):
+        reg = ConnectionRegistry()
+        client1 = FakeClient(reg.nextId())
+        reg.add(client1)
+        assert reg.remove(client1)
+        assert not reg.remove(client1)
+        client2 = FakeClient(reg.nextId())
+        reg.add(client2)
+        assert client2.getId() != client1.getId()
+        assert reg.get(client2.getId()) is client2
+        assert reg.get(client1.getId()) is None
+        assert client2 in reg
+        assert client1 not in reg
+        assert len(reg) == 1
+
+    def testIndexes(self):
+        reg = ConnectionRegistry()
+        clients = [FakeClient(reg.nextId()) for num in range(3)]
+        for client in clients:
+            reg.add(client)
+        reg.setAccount(clients[0], "a@example.com")
+        reg.setAccount(clients[1], "a@example.com")
+        reg.setAccount(clients[2], "b@example.com")
+        reg.setCharacter(clients[0], "Bilbo")
+        assert set(reg.getByAccount("a@example.com")) == set(clients[:2])
+        assert reg.getByCharacter("bilbo") is clients[0]
+
+        # re-indexing and removal clean up the old entries
+        reg.setCharacter(clients[0], "Frodo")
+        assert reg.getByCharacter("Bilbo") is None
+        assert reg.getByCharacter("FRODO") is clients[0]
+        reg.remove(clients[0])
+        assert reg.getByCharacter("Frodo") is None
+        assert reg.getByAccount("a@example.com") == [clients[1]]
+        reg.setAccount(clients[1], None)
+        assert reg.getByAccount("a@example.com") == []
+
+        # clients that aren't registered aren't indexed
+        stranger = FakeClient(99)
+        assert not reg.setCharacter(stranger, "Sauron")
+        assert reg.getByCharacter("Sauron") is None
+
+    def testIterationIsASnapshot(self):
+        reg = ConnectionRegistry()
+        for num in range(5):
+            reg.add(FakeClient(reg.nextId()))
+        for client in reg:
+            reg.remove(client)
+        assert len(reg) == 0
+
+    def testDirectMessage(self):
+        """ direct messages can target a connection id or a character """
+        reg = ConnectionRegistry()
+        target = FakeClient(reg.nextId())
+        reg.add(target)
+        reg.setCharacter(target, "Bilbo")
+        clientObj = self.createClientAndAccount()
+        clientObj.getConnectionList = lambda: reg
+        assert clientObj.directMessage("hi", str(target.getId()))
+        assert clientObj.directMessage("hello", "bilbo")
+        assert not clientObj.directMessage("hello", "nobody")
+        assert len(target.msgs) == 2
+
+    def testRoomRegistry(self):
+        reg = RoomRegistry()
+        rooms = [FakeRoom(num) for num in [5, 3, 9]]
+        for roomObj in rooms:
+            assert reg.add(roomObj) is None
+        assert reg.add(rooms[0]) is rooms[0]  # already active
+        assert reg.get(3) is rooms[1]
+        assert reg.list() == rooms  # in the order they became active
+        assert rooms[2] in reg
+
+        # another instance of room 3 replaces the first one
+        newRoom3 = FakeRoom(3)
+        assert reg.add(newRoom3) is rooms[1]
+        assert rooms[1] not in reg
+        assert not reg.remove(rooms[1])
+        assert reg.get(3) is newRoom3
+
+        # rooms can be removed while we loop
+        for roomObj in reg:
+            assert reg.remove(roomObj)
+        assert len(reg) == 0
+        assert reg.get(5) is None
+
+    def testWarmRoomCache(self):
+        now = [0]
+        cache = WarmRoomCache(maxRooms=2, gracePeriod=60, maxBytes=100,
+                              clock=lambda: now[0])
+        rooms = [FakeRoom(num) for num in [5, 3, 9]]
+        assert cache.put(rooms[0], 10)
+        assert cache.put(rooms[1], 10)
+        assert cache.take(5) is rooms[0]
+        assert cache.take(5) is None  # taken rooms aren't warm any more
+        assert cache.put(rooms[0], 10)
+        assert cache.put(rooms[2], 10)  # 3 was emptied first, so it's evicted
+        assert cache.take(3) is None
+        assert not cache.put(rooms[1], 101)  # too big to keep
+        assert cache.put(rooms[1], 85)  # over maxBytes, so 5 is evicted
+        assert cache.take(5) is None
+        assert len(cache) == 2
+
+        now[0] = 30
+        assert cache.put(rooms[0], 5)  # 9 is evicted
+        now[0] = 61  # 3 was emptied more than 60 secs ago
+        assert cache.take(3) is None
+        assert cache.take(5) is rooms[0]
+        assert cache.snapshot() == {"rooms": 0, "bytes": 0, "hits": 2,
+                                    "misses": 4, "expired": 1, "evictions": 3}
+        assert not WarmRoomCache(0, 60, 100).put(rooms[0], 1)
+
+    def testSessionRegistry(self):
+        reg = SessionRegistry(lambda charObj: charObj.getAcctName())
+        bilbo = FakeChar("Bilbo", "a@example.com")
+        bill = FakeChar("Bill", "b@example.com")
+        frodo = FakeChar("Frodo", "a@example.com")
+        for charObj in [bilbo, bill, frodo]:
+            assert reg.add(charObj)
+        assert not reg.add(bilbo)
+        assert len(reg) == 3
+
+        assert bill in reg
+        assert FakeChar("Bill", "b@example.com") not in reg  # by identity
+        assert reg.get("b@example.com/Bill") is bill
+        assert reg.getByName("BILL") is bill
+        assert reg.getByName("bil") is None
+        assert reg.findByName("bil") is bilbo  # first to join
+        assert reg.findByName("f") is frodo
+        assert set(reg.getByAccount("a@example.com")) == {bilbo, frodo}
+
+        assert reg.remove(bilbo)
+        assert not reg.remove(bilbo)
+        assert reg.findByName("bil") is bill
+        assert reg.getByAccount("a@example.com") == [frodo]
+        assert reg.list() == [bill, frodo]
+        for charObj in reg:
+            reg.remove(charObj)
+        assert reg.findByName("f") is None
+        assert not reg._byPrefix
+
+
+if __name__ == "__main__":
+    unittest.main()
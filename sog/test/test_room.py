@@ -1,9 +1,15 @@
 """ test_room """
+import json
+import os
 import unittest
+from unittest import mock
 
 from common.testLib import TestGameBase
 from common.general import logger, targetSearch, getNeverDate
-from room import RoomFactory
+from common.metrics import saveCounts
+from common.storage import getBackend, groupCommit
+import common.compactJson
+from room import RoomFactory, RoomTypeIndex, getRoomTypeFromFile, roomTypeIndex
 
 
 class TestRoom(TestGameBase):
@@ -20,6 +26,28 @@ class TestRoom(TestGameBase):
         roomObj._desc = "test room"
         assert roomObj.isValid()
 
+    def testLoadPermanents(self):
+        """ permanents that are already in the room aren't loaded again """
+        roomObj = RoomFactory("room", self.num)
+        doorObj = self.createObject(num=99999, type="Door", name="door")
+        roomObj.addToInventory(doorObj)
+        roomObj.addPermanent("door/99999")
+        with mock.patch("room.Room.getPermanent", side_effect=AssertionError):
+            assert roomObj.loadPermanents()
+        assert roomObj.getInventory() == [doorObj]
+
+    def testSavedDigestsArentSaved(self):
+        """ the fingerprints of loaded items don't end up in the room file """
+        roomObj = self.createRoom(self._tmpTestRoomNumbers[0])
+        roomObj.addPermanent("portal/1")
+        assert roomObj.loadPermanents()
+        assert len(roomObj.getInventory()) == 1
+        assert roomObj.save()
+        text = getBackend().read(roomObj._datafile, binary=False)
+        assert "townhall" in text
+        assert "_savedDigest" not in text
+        assert "_savedSize" not in text
+
     def displayAndInfo(self, roomObj, loginfo=True):
         """ test and log a room's description and info """
         roomDisplay = roomObj.display(self.getCharObj())
@@ -153,6 +181,186 @@ class TestRoom(TestGameBase):
         assert roomObj.o == 319
         assert hasattr(roomObj, "_order")
 
+    def testUnchangedRoomIsNotRewritten(self):
+        """ save only writes the data file when the content has changed """
+        roomNum = self._tmpTestRoomNumbers[0]
+        roomObj = self.createRoom(roomNum)
+        saveCounts.reset()
+        assert roomObj.save()
+        assert roomObj.save()
+        assert saveCounts.snapshot()["classes"]["Room"] == {
+            "written": 1, "skipped": 1}
+
+        # a fresh load knows what's on disk
+        loadedObj = RoomFactory("room", roomNum)
+        assert loadedObj.load()
+        assert loadedObj.save()
+        assert saveCounts.snapshot()["classes"]["Room"]["skipped"] == 2
+
+        loadedObj._desc = "in a changed test room"
+        assert loadedObj.save()
+        assert saveCounts.snapshot()["classes"]["Room"]["written"] == 2
+        reloadedObj = RoomFactory("room", roomNum)
+        assert reloadedObj.load()
+        assert reloadedObj._desc == "in a changed test room"
+
+    def testSavesDontChangeTheDataDir(self):
+        """ rooms that the tests save go to a scratch dir (see testLib) """
+        roomObj = self.getRoomObj()
+        with open(roomObj._datafile, "r") as filehandle:
+            realText = filehandle.read()
+        desc = roomObj._desc
+        roomObj._desc = "in a room that the tests changed"
+        try:
+            assert roomObj.save()
+            with open(roomObj._datafile, "r") as filehandle:
+                assert filehandle.read() == realText
+            assert "the tests changed" in getBackend().read(
+                roomObj._datafile, binary=False)
+        finally:
+            roomObj._desc = desc
+            roomObj.save()
+
+    def createShop(self, roomNum):
+        shopObj = RoomFactory("shop", roomNum)
+        shopObj._shortDesc = "in a short test shop"
+        shopObj._desc = "in a long test shop"
+        shopObj._catalog = ["Armor/2", "Weapon/2"]
+        shopObj._dailyCoinLedger["sale"] = 5
+        swordObj = self.createObject(type="Weapon", name="sword")
+        swordObj._permanent = True
+        shopObj.addToInventory(swordObj)
+        return shopObj
+
+    def testCompactJson(self):
+        """ rooms are saved in the compact format, and old files still load """
+        roomNum = self._tmpTestRoomNumbers[0]
+        shopObj = self.createShop(roomNum)
+        assert shopObj.save()
+        text = getBackend().read(shopObj._datafile, binary=False)
+        assert text.startswith('{\n"sog/compact": 1,\n"py/class": "room.Shop"')
+        assert '"_catalog": ["Armor/2","Weapon/2"]' in text  # plain json
+        assert '"_lastTransactionDate": {"sog/datetime":' in text
+        # inventory items are written from their attributes too
+        assert '"_inventory": [{"py/class":"object.Weapon",' in text
+        assert '"_datafile"' not in text and '"_instanceDebug"' not in text
+        assert "sog/pickled" not in text
+
+        loadedObj = RoomFactory("shop", roomNum)
+        assert loadedObj.load()
+        assert loadedObj._catalog == ["Armor/2", "Weapon/2"]
+        assert loadedObj._dailyCoinLedger["sale"] == 5
+        assert loadedObj._lastTransactionDate == shopObj._lastTransactionDate
+        assert [obj.getName() for obj in loadedObj.getInventory()] == ["sword"]
+        swordObj = loadedObj.getInventory()[0]
+        assert type(swordObj).__name__ == "Weapon"
+        assert swordObj.getValue() == 100 and swordObj.isPermanent()
+        text = getBackend().read(shopObj._datafile, binary=False)
+        assert loadedObj.save()  # unchanged, so it isn't rewritten
+        assert getBackend().read(shopObj._datafile, binary=False) == text
+
+    def testFailedGroupCommitIsRewritten(self):
+        """ a save that isn't committed isn't skipped as unchanged later """
+        roomNum = self._tmpTestRoomNumbers[0]
+        shopObj = self.createShop(roomNum)
+        assert shopObj.save()
+        shopObj._shortDesc = "in a renamed shop"
+        with mock.patch("common.globals.SAVE_DURABILITY", "transaction"):
+            with mock.patch("os.replace", side_effect=OSError("disk full")):
+                with self.assertRaises(OSError):
+                    with groupCommit():
+                        assert shopObj.save()
+        text = getBackend().read(shopObj._datafile, binary=False)
+        assert "in a renamed shop" not in text
+        assert shopObj.save()
+        text = getBackend().read(shopObj._datafile, binary=False)
+        assert "in a renamed shop" in text
+
+    def testCompactJsonDeclaredTypes(self):
+        """ declared attributes are saved, and loaded, as their types """
+        roomNum = self._tmpTestRoomNumbers[0]
+        shopObj = self.createShop(roomNum)
+        shopObj._encounterRate = "40"  # i.e. typed in by an editor
+        shopObj._safe = 1
+        assert shopObj.save()
+        text = getBackend().read(shopObj._datafile, binary=False)
+        assert '"_encounterRate": 40,' in text
+        assert '"_safe": true,' in text
+
+        text = text.replace('"_encounterRate": 40,', '"_encounterRate": "45",')
+        text = text.replace('"_shortDesc": "in a short test shop",',
+                            '"_shortDesc": 7,')
+        getBackend().write(shopObj._datafile, text)
+        loadedObj = RoomFactory("shop", roomNum)
+        assert loadedObj.load()
+        assert loadedObj._encounterRate == 45
+        assert loadedObj._shortDesc == "7"
+        assert loadedObj._safe is True
+
+    def testOldJsonFormat(self):
+        """ files in the old jsonpickle format are converted when saved """
+        roomNum = self._tmpTestRoomNumbers[0]
+        shopObj = self.createShop(roomNum)
+        shopObj.setDataFilename()
+        oldText = shopObj.encodeJson()
+        assert not common.compactJson.isCompact(json.loads(oldText))
+        getBackend().write(shopObj._datafile, oldText)
+
+        compactText = common.compactJson.convert(oldText)
+        assert common.compactJson.convert(compactText) == compactText
+        assert len(compactText) < len(oldText)
+
+        loadedObj = RoomFactory("shop", roomNum)
+        assert loadedObj.load()
+        assert loadedObj._catalog == ["Armor/2", "Weapon/2"]
+        assert loadedObj.save()  # unchanged, but it's rewritten as compact
+        text = getBackend().read(shopObj._datafile, binary=False)
+        assert common.compactJson.isCompact(json.loads(text))
+        convertedObj = RoomFactory("shop", roomNum)
+        assert convertedObj.load()
+        assert convertedObj._catalog == ["Armor/2", "Weapon/2"]
+        assert [obj.getName() for obj in convertedObj.getInventory()] == ["sword"]
+
+    def testRoomTypeIndex(self):
+        """ room types come from the index, not from probing the data dirs """
+        roomNum = self._tmpTestRoomNumbers[0]
+        assert roomTypeIndex.build() > 200
+        with mock.patch("room.probeRoomTypes", side_effect=AssertionError):
+            assert getRoomTypeFromFile(33) == "room"
+            assert getRoomTypeFromFile(130) == "shop"
+            roomObj = RoomFactory("room", 130)
+            roomObj.setDataFilename()
+            assert roomObj._datafile.endswith(os.path.join("Shop", "130.json"))
+            shopObj = self.createShop(roomNum)
+        assert getRoomTypeFromFile(roomNum) == "room"  # new rooms are probed
+        with mock.patch("room.probeRoomTypes", side_effect=AssertionError):
+            assert getRoomTypeFromFile(roomNum) == "room"  # once
+            assert shopObj.save()
+            assert getRoomTypeFromFile(roomNum) == "shop"
+            assert shopObj.delete()
+        assert getRoomTypeFromFile(roomNum) == "room"
+
+        # the index is built on first use, i.e. by the editor, which doesn't
+        # create a Game
+        with mock.patch("room.roomTypeIndex", RoomTypeIndex()):
+            roomObj = RoomFactory("room", 1)
+            assert roomObj.load()
+            assert getRoomTypeFromFile(130) == "shop"
+
+        # missing rooms are probed again once missingSecs have passed
+        now = [0]
+        index = RoomTypeIndex(missingSecs=60, clock=lambda: now[0])
+        index.build()
+        with mock.patch("room.probeRoomTypes", return_value=set()) as probe:
+            assert index.getType(roomNum) == "room"
+            assert index.getType(roomNum) == "room"
+            assert probe.call_count == 1
+            now[0] = 61
+            assert index.getType(roomNum) == "room"
+            assert probe.call_count == 2
+            index.add(roomNum, "guild")
+            assert index.getType(roomNum) == "guild"
+
     def testRoomShop(self):
         tmpRoomNum = 99999
         roomObj = RoomFactory("Shop", tmpRoomNum)  # instanciate room object
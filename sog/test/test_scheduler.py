@@ -0,0 +1,122 @@
+""" test_scheduler """
+import unittest
+
+from common.scheduler import HOLD, Scheduler
+from common.testLib import TestGameBase
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestScheduler(TestGameBase):
+    def setUp(self):
+        self.banner("start", testName=__class__.__name__)
+        self.clock = FakeClock()
+        self.sched = Scheduler(clock=self.clock)
+        self.ran = []
+
+    def tearDown(self):
+        self.banner("end")
+
+    def task(self, name, nextDelay=None):
+        def callback():
+            self.ran.append(name)
+            return nextDelay
+        return callback
+
+    def testOnlyDueTasksRun(self):
+        self.sched.schedule("a", 5, self.task("a"))
+        self.sched.schedule("b", 1, self.task("b"))
+        assert self.sched.runDue() == 0
+        self.clock.now += 1
+        assert self.sched.runDue() == 1
+        assert self.ran == ["b"]
+        assert self.sched.nextDue() == 4
+        self.clock.now += 10
+        assert self.sched.runDue() == 1
+        assert self.ran == ["b", "a"]
+        assert len(self.sched) == 0
+
+    def testRecurringTask(self):
+        self.sched.schedule("regen", 0, self.task("regen", nextDelay=3))
+        for sec in range(7):
+            self.sched.runDue()
+            self.clock.now += 1
+        assert self.ran == ["regen"] * 3
+        assert "regen" in self.sched
+
+    def testCancelAndReplace(self):
+        self.sched.schedule("a", 1, self.task("a"))
+        self.sched.schedule("b", 1, self.task("b"))
+        assert self.sched.cancel("a")
+        assert not self.sched.cancel("a")
+        # replace=False leaves the existing task alone
+        assert not self.sched.schedule("b", 10, self.task("b2"), replace=False)
+        self.sched.schedule("c", 1, self.task("c"))
+        self.sched.schedule("c", 3, self.task("c2"))
+        self.clock.now += 2
+        self.sched.runDue()
+        assert self.ran == ["b"]
+        self.clock.now += 2
+        self.sched.runDue()
+        assert self.ran == ["b", "c2"]
+
+    def testTaskCancelsItself(self):
+        def callback():
+            self.ran.append("x")
+            self.sched.cancel("x")
+            return 1
+        self.sched.schedule("x", 0, callback)
+        self.sched.runDue()
+        assert "x" not in self.sched
+
+    def testHeldKeyStaysScheduled(self):
+        """ a held key isn't run again, but it can't be scheduled twice """
+        self.sched.schedule("h", 0, self.task("h", nextDelay=HOLD))
+        assert self.sched.runDue() == 1
+        self.clock.now += 5
+        assert self.sched.runDue() == 0
+        assert "h" in self.sched
+        assert not self.sched.schedule("h", 0, self.task("h2"), replace=False)
+        assert self.sched.release("h")
+        assert not self.sched.release("h")
+        assert "h" not in self.sched
+
+        # scheduling a held key again takes it off hold
+        self.sched.schedule("h", 0, self.task("h", nextDelay=HOLD))
+        self.sched.runDue()
+        self.sched.schedule("h", 1, self.task("h3"))
+        assert not self.sched.release("h")
+        self.clock.now += 1
+        self.sched.runDue()
+        assert self.ran == ["h", "h", "h3"]
+
+    def testFailingTaskIsRetried(self):
+        def callback():
+            self.ran.append("boom")
+            raise ValueError("boom")
+        self.sched.schedule("boom", 0, callback)
+        self.sched.runDue()
+        assert "boom" in self.sched
+        self.clock.now += 1
+        self.sched.runDue()
+        assert self.ran == ["boom", "boom"]
+
+    def testTickCostScalesWithDueTasks(self):
+        for num in range(10000):
+            self.sched.schedule(num, 300, self.task(num))
+        self.sched.schedule("due", 0, self.task("due"))
+        assert self.sched.runDue() == 1
+        # cancelled entries don't pile up in the heap
+        for num in range(10000):
+            self.sched.schedule(num, 300, self.task(num))
+        assert len(self.sched._heap) <= 2 * len(self.sched) + 64
+
+
+if __name__ == "__main__":
+    unittest.main()
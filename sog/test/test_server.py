@@ -0,0 +1,67 @@
+""" test_server """
+import socket
+import threading
+import time
+import unittest
+
+import mock
+
+import common.globals
+from common.serverLib import _ThreadedServer, haltAsyncThread
+from common.testLib import TestGameBase
+
+
+class TestServer(TestGameBase):
+    def setUp(self):
+        self.banner("start", testName=__class__.__name__)
+        # raw clients don't send the framing preamble - don't wait long for it
+        patcher = mock.patch.object(common.globals, "FRAME_HANDSHAKE_TIMEOUT", 0.05)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.banner("end")
+
+    def startServer(self):
+        """ start the threaded server in a separate thread on a random port """
+        svr = _ThreadedServer()
+        with mock.patch.object(common.globals, "PORT", 0):
+            svrThread = threading.Thread(target=svr.main, daemon=True)
+            svrThread.start()
+            assert svr.ready.wait(10), "server did not start"
+        return (svr, svrThread)
+
+    def stopServer(self, svr, svrThread):
+        svr.stop()
+        svrThread.join(10)
+        haltAsyncThread(None, svr.asyncThread)
+        for client in common.globals.connections:
+            client.terminateClientConnection()
+        assert not svrThread.is_alive()
+
+    def testConnectionBurst(self):
+        """ a burst of connections is accepted without a per-accept delay """
+        svr, svrThread = self.startServer()
+        socks = []
+        try:
+            assert svr.asyncThread.is_alive()
+            startTime = time.monotonic()
+            for num in range(20):
+                socks.append(socket.create_connection(("127.0.0.1", svr.port), 10))
+            for sock in socks:
+                data = b""
+                while b"Enter email address" not in data:
+                    chunk = sock.recv(common.globals.BYTES_TO_TRANSFER)
+                    assert chunk
+                    data += chunk
+            # used to be at least 1 second per connection
+            assert time.monotonic() - startTime < 10
+            assert len(common.globals.connections) == 20
+        finally:
+            for sock in socks:
+                sock.close()
+            self.stopServer(svr, svrThread)
+
+
+if __name__ == "__main__":
+    unittest.main()
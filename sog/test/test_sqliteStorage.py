@@ -0,0 +1,117 @@
+""" test_sqliteStorage """
+import os
+import tempfile
+import threading
+import unittest
+
+from common.globals import DATADIR
+from common.sqliteStorage import SqliteBackend, migrate
+from common.storage import FileBackend, setBackend
+from common.testLib import TestGameBase
+from room import RoomFactory
+
+
+class TestSqliteBackend(TestGameBase):
+    def setUp(self):
+        self.banner("start", testName=__class__.__name__)
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.datadir = os.path.join(self.tmpDir.name, "data")
+        self.backend = SqliteBackend(os.path.join(self.tmpDir.name, "sog.db"),
+                                     self.datadir, fallback=FileBackend())
+
+    def tearDown(self):
+        self.backend.close()
+        self.tmpDir.cleanup()
+        self.banner("end")
+
+    def path(self, *parts):
+        return os.path.join(self.datadir, *parts)
+
+    def testReadWriteDelete(self):
+        roomFile = self.path("Room", "33.json")
+        assert self.backend.keyFor(roomFile) == ("Room", "33", "json")
+        assert not self.backend.exists(roomFile)
+        assert self.backend.read(roomFile) is None
+        self.backend.write(roomFile, "{}")
+        assert self.backend.exists(roomFile)
+        assert self.backend.read(roomFile) == b"{}"
+        assert self.backend.read(roomFile, binary=False) == "{}"
+        assert not os.path.exists(roomFile)  # it's in the database
+        assert self.backend.delete(roomFile)
+        assert not self.backend.exists(roomFile)
+        assert not self.backend.delete(roomFile)
+
+    def testThreadConnectionsAreReleased(self):
+        """ client threads close their connection when they're done """
+        roomFile = self.path("Room", "33.json")
+        count = self.backend.getConnectionCount()
+
+        def clientThread():
+            self.backend.write(roomFile, "{}")
+            assert self.backend.getConnectionCount() == count + 1
+            assert self.backend.releaseThread()
+            assert not self.backend.releaseThread()
+
+        oneThread = threading.Thread(target=clientThread)
+        oneThread.start()
+        oneThread.join(10)
+        assert self.backend.getConnectionCount() == count
+        assert self.backend.read(roomFile) == b"{}"
+
+    def testListAndFind(self):
+        acctDir = self.path("Account")
+        self.backend.write(self.path("Account", "a@b.com", "account.pickle"), b"a")
+        self.backend.write(self.path("Account", "a@b.com", "Bingo.pickle"), b"b")
+        self.backend.write(self.path("Account", "c_d@b.com", "Bongo.pickle"), b"c")
+        self.backend.write(self.path("Room", "1.json"), "{}")
+        assert self.backend.listDir(self.datadir) == ["Account", "Room"]
+        assert self.backend.listDir(acctDir) == ["a@b.com", "c_d@b.com"]
+        assert self.backend.listDir(self.path("Account", "a@b.com")) == [
+            "Bingo.pickle", "account.pickle"]
+        assert self.backend.findFiles(acctDir, "Bingo.pickle") == [
+            self.path("Account", "a@b.com", "Bingo.pickle")]
+        assert self.backend.findFiles(acctDir, "Bing.pickle") == []
+        assert self.backend.removeTree(self.path("Account", "c_d@b.com")) == 1
+        assert self.backend.listDir(acctDir) == ["a@b.com"]
+
+    def testPathsOutsideOfTheDataDirAreFiles(self):
+        outside = os.path.join(self.tmpDir.name, "other", "1.json")
+        self.backend.write(outside, "{}")
+        assert os.path.isfile(outside)
+        assert self.backend.read(outside) == b"{}"
+        assert self.backend.keyFor(self.path("Account", "a@b.com", "isAdmin.txt")) \
+            is None
+
+    def testMigrate(self):
+        os.makedirs(self.path("Room"))
+        for num in range(3):
+            with open(self.path("Room", str(num) + ".json"), "w") as filehandle:
+                filehandle.write("room " + str(num))
+        with open(self.path("Room", ".1.json.tmp"), "w") as filehandle:
+            filehandle.write("partial")  # leftover temp files are skipped
+        assert migrate(self.datadir, self.backend) == 3
+        assert self.backend.count() == 3
+        assert self.backend.read(self.path("Room", "2.json")) == b"room 2"
+
+    def testStorageObjects(self):
+        """ rooms save to and load from the database """
+        backend = SqliteBackend(os.path.join(self.tmpDir.name, "real.db"),
+                                DATADIR, fallback=FileBackend())
+        previous = setBackend(backend)
+        try:
+            roomNum = self._tmpTestRoomNumbers[0]
+            roomObj = self.createRoom(roomNum)
+            assert roomObj.save()
+            assert not os.path.exists(roomObj._datafile)
+            loadedObj = RoomFactory("room", roomNum)
+            assert loadedObj.load()
+            assert loadedObj._desc == roomObj._desc
+            assert loadedObj.delete()
+            assert not loadedObj.dataFileExists()
+        finally:
+            setBackend(previous)
+            backend.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
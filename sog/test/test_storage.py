@@ -0,0 +1,137 @@
+""" test_storage """
+import os
+import tempfile
+import unittest
+
+from common.storage import FileBackend, FsyncQueue, ScratchBackend
+from common.storage import atomicWrite, fsyncQueue, groupCommit
+from common.storage import onCommitFailure
+from common.testLib import TestGameBase
+
+
+class TestAtomicWrite(TestGameBase):
+    def setUp(self):
+        self.banner("start", testName=__class__.__name__)
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpDir.name, "1.json")
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+        self.banner("end")
+
+    def read(self):
+        with open(self.filename, "r") as filehandle:
+            return filehandle.read()
+
+    def testReplacesTheFile(self):
+        for durability in ["none", "periodic", "transaction"]:
+            atomicWrite(self.filename, "content " + durability, durability)
+            assert self.read() == "content " + durability
+        atomicWrite(self.filename, b"bytes", "none")
+        assert self.read() == "bytes"
+        assert os.listdir(self.tmpDir.name) == ["1.json"]  # no temp files
+
+    def testFailedWriteLeavesTheOldFile(self):
+        atomicWrite(self.filename, "old", "none")
+        with self.assertRaises(TypeError):
+            atomicWrite(self.filename, 42, "none")
+        assert self.read() == "old"
+        assert os.listdir(self.tmpDir.name) == ["1.json"]
+
+    def testGroupCommit(self):
+        atomicWrite(self.filename, "old", "none")
+        otherFilename = os.path.join(self.tmpDir.name, "2.json")
+        with groupCommit():
+            atomicWrite(self.filename, "new", "transaction")
+            with groupCommit():  # nested blocks are part of the outer one
+                atomicWrite(otherFilename, "other", "transaction")
+            assert self.read() == "old"  # not replaced until the commit
+            assert not os.path.exists(otherFilename)
+        assert self.read() == "new"
+        assert os.path.exists(otherFilename)
+        assert sorted(os.listdir(self.tmpDir.name)) == ["1.json", "2.json"]
+
+    def testFailedGroupCommit(self):
+        otherFilename = os.path.join(self.tmpDir.name, "2.json")
+        os.makedirs(os.path.join(self.filename, "notEmpty"))  # can't replace
+        failures = []
+        with self.assertRaises(OSError):
+            with groupCommit():
+                atomicWrite(self.filename, "new", "transaction")
+                atomicWrite(otherFilename, "other", "transaction")
+                onCommitFailure(lambda: failures.append(1))
+        assert failures == [1]
+        assert os.path.isdir(self.filename)
+        with open(otherFilename, "r") as filehandle:  # the rest are committed
+            assert filehandle.read() == "other"
+        assert sorted(os.listdir(self.tmpDir.name)) == ["1.json", "2.json"]
+
+    def testRaisingBlockIsNotCommitted(self):
+        failures = []
+        with self.assertRaises(ValueError):
+            with groupCommit():
+                atomicWrite(self.filename, "new", "transaction")
+                onCommitFailure(lambda: failures.append(1))
+                raise ValueError("oops")
+        assert failures == [1]
+        assert os.listdir(self.tmpDir.name) == []  # no temp files
+
+    def testPeriodicSyncsAreBatched(self):
+        queue = FsyncQueue(interval=3600)
+        queue.add(self.filename)
+        queue.add(self.filename)
+        queue.add(os.path.join(self.tmpDir.name, "2.json"))  # doesn't exist
+        assert queue.getPendingCount() == 2
+        assert queue.sync() == 2
+        assert queue.getPendingCount() == 0
+        assert queue.cycles == 1
+        assert queue.sync() == 0
+
+        atomicWrite(self.filename, "content", "periodic")
+        assert fsyncQueue.getPendingCount() >= 1
+        fsyncQueue.sync()
+
+
+class TestScratchBackend(TestGameBase):
+    def setUp(self):
+        self.banner("start", testName=__class__.__name__)
+        self.realDir = tempfile.TemporaryDirectory()
+        self.scratchDir = tempfile.TemporaryDirectory()
+        self.realFile = os.path.join(self.realDir.name, "Room", "1.json")
+        FileBackend().write(self.realFile, "real")
+        self.backend = ScratchBackend(self.scratchDir.name, FileBackend(),
+                                      datadir=self.realDir.name)
+
+    def tearDown(self):
+        self.realDir.cleanup()
+        self.scratchDir.cleanup()
+        self.banner("end")
+
+    def testWritesGoToTheScratchDir(self):
+        backend = self.backend
+        assert backend.read(self.realFile, binary=False) == "real"
+        backend.write(self.realFile, "changed")
+        newFile = os.path.join(self.realDir.name, "Account", "a@b.com", "c.pickle")
+        backend.write(newFile, b"new")
+        assert backend.read(self.realFile, binary=False) == "changed"
+        assert backend.read(newFile) == b"new"
+        assert backend.listDir(os.path.join(self.realDir.name, "Account")) == [
+            "a@b.com"]
+        assert backend.findFiles(self.realDir.name, "c.pickle") == [newFile]
+        # the real data dir is untouched
+        assert FileBackend().read(self.realFile, binary=False) == "real"
+        assert os.listdir(self.realDir.name) == ["Room"]
+
+    def testDeleteHidesTheRealFile(self):
+        backend = self.backend
+        assert backend.delete(self.realFile)
+        assert not backend.exists(self.realFile)
+        assert backend.read(self.realFile) is None
+        assert backend.listDir(os.path.dirname(self.realFile)) == []
+        assert FileBackend().exists(self.realFile)
+        backend.write(self.realFile, "again")
+        assert backend.read(self.realFile, binary=False) == "again"
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+""" test_templates """
+import unittest
+
+from common.storage import Storage, getBackend
+from common.templates import TemplateCache, templateCache
+from common.testLib import TestGameBase
+from creature import Creature
+
+
+class TestTemplateCache(TestGameBase):
+    def setUp(self):
+        self.banner("start", testName=__class__.__name__)
+
+    def tearDown(self):
+        self.banner("end")
+
+    def testCopiesAreIndependent(self):
+        cache = TemplateCache(maxEntries=10, maxBytes=1000)
+        assert cache.get("Creature/1", (1, 10)) is None
+        assert cache.put("Creature/1", (1, 10), {"_name": "bug", "_list": [1]},
+                         {"_savedDigest": b"x"})
+        attDict, extras = cache.get("Creature/1", (1, 10))
+        assert attDict == {"_name": "bug", "_list": [1]}
+        assert extras == {"_savedDigest": b"x"}
+        attDict["_list"].append(2)
+        assert cache.get("Creature/1", (1, 10))[0]["_list"] == [1]
+        assert cache.get("Creature/1", (2, 10)) is None  # the file changed
+        assert cache.get("Creature/1", (1, 10)) is None
+        assert cache.snapshot()["hits"] == 2
+        assert cache.snapshot()["stale"] == 1
+
+    def testEviction(self):
+        cache = TemplateCache(maxEntries=2, maxBytes=100)
+        cache.put("Weapon/1", (1, 10), {})
+        cache.put("Weapon/2", (1, 10), {})
+        assert cache.get("Weapon/1", (1, 10)) is not None  # 2 is the oldest
+        cache.put("Weapon/3", (1, 10), {})
+        assert cache.get("Weapon/2", (1, 10)) is None
+        assert cache.snapshot()["entries"] == 2
+
+        cache.put("Weapon/4", (1, 95), {})  # over maxBytes
+        assert cache.snapshot() == {"entries": 1, "bytes": 95, "hits": 1,
+                                    "misses": 1, "stale": 0, "evictions": 3}
+        assert not cache.put("Weapon/5", (1, 101), {})  # too big to keep
+        assert not TemplateCache(maxEntries=0).put("Weapon/6", (1, 1), {})
+
+    def testCreatureLoads(self):
+        """ creatures are cloned from the template until the file changes """
+        creObj = self.createCreature(name="templatebug")
+        creObj.setDataFilename()
+        try:
+            assert creObj.save()
+            loadedObj = Creature(creObj.getId())
+            assert loadedObj.load()
+            hits = templateCache.snapshot()["hits"]
+            otherObj = Creature(creObj.getId())
+            assert otherObj.load()
+            assert templateCache.snapshot()["hits"] > hits
+            assert otherObj.getName() == "templatebug"
+            otherObj._itemCatalog.append("Armor/2")
+            assert loadedObj._itemCatalog == ["Armor/1", "Weapon/1"]
+
+            # saving replaces the template
+            creObj._name = "savedbug"
+            assert creObj.save()
+            savedObj = Creature(creObj.getId())
+            assert savedObj.load()
+            assert savedObj.getName() == "savedbug"
+
+            # so does a change made outside of this process, i.e. the editor
+            text = getBackend().read(creObj._datafile, binary=False)
+            getBackend().write(creObj._datafile,
+                               text.replace("savedbug", "editedbug") + " ")
+            editedObj = Creature(creObj.getId())
+            assert editedObj.load()
+            assert editedObj.getName() == "editedbug"
+        finally:
+            Storage.delete(creObj)  # Creature.delete doesn't remove the file
+
+
+if __name__ == "__main__":
+    unittest.main()
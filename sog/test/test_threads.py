@@ -0,0 +1,51 @@
+""" test_threads """
+import time
+import unittest
+
+from common.testLib import TestGameBase
+from threads import AsyncThread
+
+
+class TestAsyncThread(TestGameBase):
+    def setUp(self):
+        self.banner("start", testName=__class__.__name__)
+
+    def tearDown(self):
+        self.banner("end")
+
+    def testOnSchedule(self):
+        """ a tick's duration doesn't push back the next tick """
+        asyncThread = AsyncThread(interval=1, policy="skip")
+        assert asyncThread.getNextTick(100, 100.3) == (101, 0)
+
+    def testOverrunPolicies(self):
+        # the tick that was due at 100 ran until 102.5
+        asyncThread = AsyncThread(interval=1, policy="skip")
+        assert asyncThread.getNextTick(100, 102.5) == (103, 2)
+
+        asyncThread = AsyncThread(interval=1, policy="stretch")
+        assert asyncThread.getNextTick(100, 102.5) == (102.5, 0)
+
+        for policy in ["bogus", "catchup"]:  # catchup was dropped
+            asyncThread = AsyncThread(interval=1, policy=policy)
+            assert asyncThread.policy == "skip"
+
+    def testSubSecondTicks(self):
+        asyncThread = AsyncThread(interval=0.05)
+        tickMetrics = asyncThread.gameObj.getTickMetrics()
+        ticksBefore = tickMetrics.snapshot()["ticks"]
+        asyncThread.start()
+        try:
+            time.sleep(0.5)
+        finally:
+            asyncThread.halt()
+            asyncThread.join(5)
+        assert not asyncThread.is_alive()
+        ticks = tickMetrics.snapshot()["ticks"] - ticksBefore
+        assert 5 <= ticks <= 12
+        lastRunTime, lag = asyncThread.getLastRunTime(withLag=True)
+        assert lag < 0.5
+
+
+if __name__ == "__main__":
+    unittest.main()
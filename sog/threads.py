@@ -1,10 +1,13 @@
 """ threads.py - server side client and async thread classes
+    * NetworkClient - superClass for clients connected over the network
     * ClientThread - uses existing (or spins up) lobby/game instance
     * AsyncThread - uses existing (or spins up) game instance
+    * PushThread - sends spooled output to idle ClientThreads
     * Note: threads must be started before use"""
 
 from datetime import datetime
 import os
+import selectors
 import socket
 import threading
 import time
@@ -12,8 +15,11 @@ import time
 import account
 from common.attributes import AttributeHelper
 from common.ioLib import ServerIo
-from common.general import logger
+from common.general import isIntStr, logger
+import common.framing
 import common.globals
+from common.registry import ConnectionRegistry
+from common.storage import getBackend
 import game
 import lobby
 
@@ -117,6 +123,29 @@ class ClientBase(ServerIo, AttributeHelper):
                     return True
             return False
 
+    def runCmdLoop(self, cmdObj, cleanupFunc=None):
+        """ Run a cmd shell (lobby/game) until it exits, then clean up
+            * threaded clients block here for the life of the shell
+            * may be overwritten in subClass, where the shell is driven one
+              command at a time (i.e. asyncServerLib.AsyncClient)
+        """
+        try:
+            cmdObj.cmdloop()
+        finally:
+            if cleanupFunc:
+                cleanupFunc(self)
+
+    def releaseGameObjs(self):
+        """ Leave the game (saving the character) and drop the references to
+            the lobby/game/account objects """
+        self.getConnectionList().setAccount(self, None)
+        self.lobbyObj = None
+        if self.charObj:
+            self.gameObj.leaveGame(self.charObj, saveChar=True)
+            self.charObj = None
+        self.gameObj = None
+        self.acctObj = None
+
     def getCmdPrompt(self):
         if self.isArea("game"):
             sp = "<"
@@ -143,10 +172,10 @@ class ClientBase(ServerIo, AttributeHelper):
         return promptStr
 
     def getConnectionList(self):
-        """ All connections to the game
+        """ All connections to the game (see common.registry)
             * intended to be overwritten in subClass, which uses client/server
         """
-        return []
+        return ConnectionRegistry()
 
     def broadcast(self, data, header=None):
         """ output a message to all users """
@@ -185,17 +214,19 @@ class ClientBase(ServerIo, AttributeHelper):
         if data[-1] != "\n":  # Add newline if needed
             data += "\n"
 
-        # toDo: this should be a name search, instead of a number from 'who'
-        if self.isNum(who):
+        # 'who' is a connection id or the name of a character in the game
+        if isIntStr(who):
+            client = self.getConnectionList().get(int(who))
+        else:
+            client = self.getConnectionList().getByCharacter(who)
+        if client:
             if not header:
                 header = (
                     self.txtBanner("Private message from " + self.acctObj.getEmail())
                     + "\n> "
                 )
-            for client in self.getConnectionList():
-                if client.id == int(who):
-                    client.spoolOut(header + data)
-                    sentCount += 1
+            client.spoolOut(header + data)
+            sentCount += 1
 
         if sentCount:
             return True
@@ -209,18 +240,56 @@ class ClientBase(ServerIo, AttributeHelper):
         return False
 
 
-class ClientThread(threading.Thread, ClientBase):
+class NetworkClient(ClientBase):
+    """ SuperClass for clients that are connected over the network
+        * Real account logins and the shared list of connections
+        * Subclassed by ClientThread and asyncServerLib.AsyncClient"""
+
+    def __init__(self, address, id):
+        ClientBase.__init__(self)
+        self.address = address
+        self.id = id
+        self._running = True
+
+    def acctLogin(self, email=None):
+        """ Login - return true if successful """
+        loggedIn = False
+        if self.acctObj.login(email):
+            loggedIn = True
+            self.getConnectionList().setAccount(self, self.acctObj.getEmail())
+        else:
+            logger.warning("{} Authentication failed".format(self))
+            self.acctObj = None
+
+        if loggedIn:
+            return True
+        return False
+
+    def isRunning(self):
+        if not self._running:
+            return False
+        return True
+
+    def getId(self):
+        return self.id
+
+    def getConnectionList(self):
+        return common.globals.connections
+
+    def removeConnectionFromList(self):
+        if self.getConnectionList().remove(self):
+            logger.info("{} Client connection terminated".format(self))
+
+
+class ClientThread(threading.Thread, NetworkClient):
     """ Main client thread of the server
         * All non network, non-thread features should be part of the
           ClientBase superClass"""
 
     def __init__(self, socket, address, id):
         threading.Thread.__init__(self, daemon=True, target=self.serverLoop)
-        ClientBase.__init__(self)
+        NetworkClient.__init__(self, address, id)
         self.socket = socket
-        self.address = address
-        self.id = id
-        self._running = True
         self.identifier = "CT" + str(id) + str(address)
 
     def __str__(self):
@@ -232,6 +301,7 @@ class ClientThread(threading.Thread, ClientBase):
         """ This is the main entry point into the app """
         logger.info(str(self) + " Client connection established")
         try:
+            self.negotiateFraming()
             while True:  # Server loop
                 self.welcome("Sog Server\n")
                 self.acctObj = account.Account(self)
@@ -244,21 +314,9 @@ class ClientThread(threading.Thread, ClientBase):
             self.terminateClientConnection()
         finally:
             self.terminateClientConnection()
+            getBackend().releaseThread()  # i.e. this thread's db connection
         return None
 
-    def acctLogin(self):
-        """ Login - return true if successful """
-        loggedIn = False
-        if self.acctObj.login():
-            loggedIn = True
-        else:
-            logger.warning("{} Authentication failed".format(self))
-            self.acctObj = None
-
-        if loggedIn:
-            return True
-        return False
-
     def mainLoop(self):
         """ Main loop of program
             * Launch lobby loop
@@ -267,41 +325,26 @@ class ClientThread(threading.Thread, ClientBase):
         if self.acctObj:
             self.acctObj.logout()
         self.acctObj = None
-
-    def isRunning(self):
-        if not self._running:
-            return False
-        return True
+        self.getConnectionList().setAccount(self, None)
 
     def getSock(self):
         return self.socket
 
-    def getId(self):
-        return self.id
-
-    def getConnectionList(self):
-        return common.globals.connections
-
-    def removeConnectionFromList(self):
-        if self in self.getConnectionList():
-            logger.info("{} Client connection terminated".format(self))
-            common.globals.connections.remove(self)
-            common.globals.totalConnections -= 1
+    def requestPush(self):
+        """ Override ServerIo - this thread is blocked waiting for input, so
+            hand the push off to the shared push thread """
+        PushThread().schedule(self)
 
     def terminateClientConnection(self):
         """ terminate the connection and clean up loose ends """
         if self._running:
             self.removeConnectionFromList()
             self._running = False
-            self.lobbyObj = None
-            if self.charObj:
-                self.gameObj.leaveGame(self.charObj, saveChar=True)
-                self.charObj = None
-            self.gameObj = None
-            self.acctObj = None
+            self.releaseGameObjs()
 
             try:
-                self.socket.sendall(str.encode(common.globals.TERM_STR))
+                self.socket.settimeout(common.globals.SEND_TIMEOUT)
+                self.socket.sendall(self._encodeForClient(common.framing.TERM))
                 self.socket.shutdown(socket.SHUT_RDWR)
                 self.socket.close()
             except OSError:
@@ -312,16 +355,35 @@ class ClientThread(threading.Thread, ClientBase):
 
 
 class AsyncThread(threading.Thread):
-    """ a separate worker thread for handling asyncronous tasks """
-
-    def __init__(self):
+    """ a separate worker thread for handling asyncronous tasks
+        * ticks run at a fixed rate (common.globals.TICK_INTERVAL), on the
+          monotonic clock, so the time a tick takes doesn't push back the
+          ticks that follow it
+        * when a tick overruns the start of the next one, TICK_OVERRUN_POLICY
+          decides what happens:
+            skip - drop the missed ticks and wait for the next boundary
+            stretch - start the next tick now, and space the following
+                      ticks from there
+          There's no policy that runs the missed ticks back to back.  The
+          game's tasks are scheduled by due time (see common.scheduler), so
+          an overdue task runs once, late, and extra ticks would find
+          nothing to do """
+
+    def __init__(self, interval=None, policy=None):
         self.gameObj = game.Game()  # create/use the single game instance
         self.gameObj._asyncThread = self
         self._debugAsync = False
         self._startdate = datetime.now()
-        self._stopFlag = False
+        self._stopEvent = threading.Event()
         self._lastRunTime = datetime.now()
+        self._lastLag = 0.0  # secs that the last tick started late
         self.identifier = "AT0('async thread')"
+        self.interval = interval or common.globals.TICK_INTERVAL
+        self.policy = policy or common.globals.TICK_OVERRUN_POLICY
+        if self.policy not in common.globals.TICK_OVERRUN_POLICIES:
+            logger.warning("{} Unknown tick policy {} - using skip".format(
+                self, self.policy))
+            self.policy = "skip"
         threading.Thread.__init__(self, daemon=True, target=self._asyncLoop)
 
     def __str__(self):
@@ -334,14 +396,154 @@ class AsyncThread(threading.Thread):
         if self._debugAsync:
             logger.debug("{} AsyncThread._asyncMain".format(self))
         logger.info("{} Thread started (pid: {})".format(self, os.getpid()))
-        while not self._stopFlag:
+        tickMetrics = self.gameObj.getTickMetrics()
+        nextTick = time.monotonic()
+        while not self._stopEvent.is_set():
+            self._lastLag = max(0.0, time.monotonic() - nextTick)
+            tickMetrics.recordLag(self._lastLag)
             self.gameObj.asyncTasks()
             self._lastRunTime = datetime.now()
-            time.sleep(1)
+            nextTick, skipped = self.getNextTick(nextTick, time.monotonic())
+            if skipped:
+                tickMetrics.recordSkipped(skipped)
+            self._stopEvent.wait(max(0.0, nextTick - time.monotonic()))
+
+    def getNextTick(self, lastTick, now):
+        """ Given the scheduled start of the last tick, and the time that it
+            ended, return (start of the next tick, number of ticks skipped) """
+        nextTick = lastTick + self.interval
+        if now <= nextTick:
+            return (nextTick, 0)  # on schedule
+        if self.policy == "stretch":
+            return (now, 0)
+        missed = int((now - nextTick) // self.interval) + 1
+        return (nextTick + missed * self.interval, missed)  # skip
 
     def halt(self):
-        self._stopFlag = True
+        self._stopEvent.set()
         logger.info("{} Halting thread".format(self))
 
-    def getLastRunTime(self):
+    def getLastRunTime(self, withLag=False):
+        """ returns the time that the last tick finished.  With withLag,
+            returns (time, secs that the last tick started late) """
+        if withLag:
+            return (self._lastRunTime, self._lastLag)
         return(self._lastRunTime)
+
+
+class _PushThread(threading.Thread):
+    """ a single worker thread that pushes output to idle clients
+        * ClientThreads spend most of their time blocked in recv, so output
+          spooled by other threads (combat, broadcasts, etc) is delivered
+          from here instead of waiting for the client's next command
+        * a client is only queued once, no matter how many times it is
+          scheduled before the push happens
+        * a push never blocks on one client: clients whose session thread
+          is sending are skipped (it pushes the rest itself), and sends
+          don't wait for the client.  Output that a client's socket won't
+          take yet is held by the client (see ServerIo.pushOutput), and a
+          selector tells us when it can be sent.  A client that stops
+          reading is disconnected once that output backs up past
+          SPOOL_HIGH_WATER bytes or SEND_TIMEOUT secs """
+
+    def __init__(self):
+        self._scheduled = {}  # client -> None, in the order scheduled
+        self._lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._blocked = {}  # client -> socket, waiting for it to be writable
+        # schedule() wakes up the selector by writing to this socket pair
+        self._wakeRecv, self._wakeSend = socket.socketpair()
+        self._wakeRecv.setblocking(False)
+        self._wakeSend.setblocking(False)
+        self._selector.register(self._wakeRecv, selectors.EVENT_READ)
+        self.identifier = "PT0('push thread')"
+        threading.Thread.__init__(self, daemon=True, target=self._pushLoop)
+
+    def __str__(self):
+        """ Connection/Thread ID Str - often used as a prefix for logging """
+        return self.identifier
+
+    def schedule(self, client):
+        with self._lock:
+            if client in self._scheduled:
+                return None
+            self._scheduled[client] = None
+            wakeUp = len(self._scheduled) == 1
+        if wakeUp:
+            try:
+                self._wakeSend.send(b"\0")
+            except OSError:
+                pass  # full, so a wake up is already pending
+        return None
+
+    def _pushLoop(self):
+        logger.info("{} Thread started (pid: {})".format(self, os.getpid()))
+        while True:
+            # check on blocked clients now and then, so that one that never
+            # becomes writable still gets dropped after SEND_TIMEOUT secs
+            timeout = common.globals.SEND_TIMEOUT / 2 if self._blocked else None
+            events = self._selector.select(timeout)
+            for key, mask in events:
+                if key.fileobj is self._wakeRecv:
+                    self._clearWakeUp()
+                else:
+                    self._push(key.data)
+            if not events:
+                for client in list(self._blocked):
+                    self._push(client)
+            with self._lock:
+                clients = list(self._scheduled)
+                self._scheduled.clear()
+            for client in clients:
+                self._push(client)
+
+    def _clearWakeUp(self):
+        try:
+            while self._wakeRecv.recv(common.globals.BYTES_TO_TRANSFER):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _push(self, client):
+        """ push to the client, and wait for its socket to be writable if
+            some of the output is left over """
+        client.pushOutput()
+        if client.isRunning() and client.hasUnsentOutput():
+            if client not in self._blocked:
+                self._forgetStoppedClients()
+                try:
+                    self._selector.register(
+                        client.getSock(), selectors.EVENT_WRITE, client)
+                except (KeyError, ValueError, OSError):
+                    return None  # socket was closed
+                self._blocked[client] = client.getSock()
+        elif client in self._blocked:
+            self._unregister(client)
+        return None
+
+    def _forgetStoppedClients(self):
+        """ unregister clients that have gone away, so that their sockets'
+            file descriptors can be registered again when they are reused """
+        for client in list(self._blocked):
+            if not client.isRunning():
+                self._unregister(client)
+
+    def _unregister(self, client):
+        try:
+            self._selector.unregister(self._blocked.pop(client))
+        except (KeyError, ValueError, OSError):
+            pass
+
+
+_pushThread = None
+_pushThreadLock = threading.Lock()
+
+
+def PushThread():
+    """ return the push thread, starting it if needed """
+    global _pushThread
+    with _pushThreadLock:
+        if not _pushThread or not _pushThread.is_alive():
+            _pushThread = _PushThread()
+            _pushThread.start()
+    return _pushThread